@@ -0,0 +1,111 @@
+"""
+Builds the transitive closure of a SNOMED CT hierarchy ahead of time, and benchmarks building it, loading it
+from the cache and expanding codes with it.
+
+Building the closure of a full release takes around a minute, so it is best done once, offline, rather than
+the first time SnomedHierarchy.load() is called in a notebook. To build the cache for a release:
+
+    python benchmarks/snomed_closure.py --relationships sct2_Relationship_Snapshot_INT_20240101.txt --cache-dir snomed_cache
+
+SnomedHierarchy.load() with the same relationships file and cache directory then loads the saved closure.
+Without --relationships, a synthetic RF2 relationships file of the size of a full release is made and used:
+
+    python benchmarks/snomed_closure.py --concepts 350000
+
+Run with the package installed (pip install -e .).
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import polars as pl
+
+from tretools.codelists.snomed_hierarchy import IS_A_RELATIONSHIP, SnomedHierarchy
+
+
+# The concept ids of the synthetic hierarchy start here, so they look like SNOMED concept ids
+FIRST_CONCEPT_ID = 100000000
+
+
+def make_relationships(path: str, concepts: int, second_parent_share: float = 0.3, seed: int = 1) -> int:
+    """
+    Writes a synthetic RF2 relationships file. Every concept but the first has a random parent among the
+    concepts before it, and some have a second parent, so the hierarchy is a DAG like SNOMED CT.
+
+    Args:
+        path (str): The path to write the file to.
+        concepts (int): The number of concepts.
+        second_parent_share (float, optional): The share of concepts with a second parent. Defaults to 0.3.
+        seed (int, optional): The seed of the random parents. Defaults to 1.
+
+    Returns:
+        int: The number of relationships.
+    """
+    rng = random.Random(seed)
+    sources, destinations = [], []
+    for concept in range(1, concepts):
+        sources.append(concept)
+        destinations.append(rng.randrange(0, concept))
+        if rng.random() < second_parent_share:
+            sources.append(concept)
+            destinations.append(rng.randrange(0, concept))
+
+    relationships = len(sources)
+    pl.DataFrame({
+        "id": range(relationships),
+        "effectiveTime": [20240101] * relationships,
+        "active": [1] * relationships,
+        "moduleId": [900000000000207008] * relationships,
+        "sourceId": [FIRST_CONCEPT_ID + source for source in sources],
+        "destinationId": [FIRST_CONCEPT_ID + destination for destination in destinations],
+        "relationshipGroup": [0] * relationships,
+        "typeId": [IS_A_RELATIONSHIP] * relationships,
+        "characteristicTypeId": [900000000000011006] * relationships,
+        "modifierId": [900000000000451002] * relationships,
+    }).write_csv(path, separator="\t")
+    return relationships
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--relationships", help="An RF2 relationships file. Defaults to a synthetic file.")
+    parser.add_argument("--cache-dir", help="The directory to save the closure in. Defaults to a temporary directory.")
+    parser.add_argument("--concepts", type=int, default=350_000, help="The number of concepts in the synthetic file.")
+    parser.add_argument("--codes", type=int, default=1_000, help="The number of codes to expand.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        relationships_path = args.relationships
+        if relationships_path is None:
+            relationships_path = os.path.join(work_dir, "sct2_Relationship_Snapshot_synthetic.txt")
+            relationships = make_relationships(relationships_path, args.concepts)
+            print(f"Made a synthetic hierarchy of {args.concepts} concepts and {relationships} relationships")
+        cache_dir = args.cache_dir or os.path.join(work_dir, "cache")
+
+        start = time.perf_counter()
+        hierarchy = SnomedHierarchy.load(relationships_path, cache_dir)
+        print(f"Build or load: {time.perf_counter() - start:.2f}s")
+        for line in hierarchy.log:
+            print(line)
+
+        # Load again from the file, as a new process would
+        SnomedHierarchy._loaded.clear()
+        start = time.perf_counter()
+        hierarchy = SnomedHierarchy.load(relationships_path, cache_dir)
+        print(f"Load from the cache: {time.perf_counter() - start:.2f}s")
+
+        ancestors = hierarchy.closure["ancestor"].unique()
+        codes = ancestors.sample(min(args.codes, ancestors.len()), seed=1)
+        start = time.perf_counter()
+        descendants = hierarchy.descendants(codes)
+        print(f"Expand {codes.len()} codes to {descendants.shape[0]} descendants: {time.perf_counter() - start:.3f}s")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,4 +16,5 @@ setup(
     author_email="c.morton@qmul.ac.uk",
     python_requires=">=3.8",
     install_requires=["polars", "setuptools"],
+    extras_require={"zstd": ["zstandard"]},
 )
@@ -2,9 +2,13 @@ import pytest
 
 from tretools.codelists.codelist import Codelist
 from tretools.codelists.codelist_types import CodelistType
+from tretools.codelists.mapping import SnomedToIcd10Mapping
+from tretools.codelists.snomed_hierarchy import SnomedHierarchy
 from tretools.codelists.errors import InvalidSNOMEDCodeError, InvalidProcessingRequest, InvalidICD10CodeError, RepeatedCodeError, InvalidDataShapeError
 
 import csv
+import os
+import polars as pl
 
 
 # Path to the codelists
@@ -153,12 +157,48 @@ def test_if_x_code_conditions_not_met():
     expected_result = [{'code': 'A01X', 'term': 'Disease A - 1'}, {'code': 'A02.1', 'term': 'Disease A - 2'}]
     assert data.data == expected_result
 
+def test_x_code_not_added_to_x_chapter_code():
+    # X01 is in the X chapter, so it already contains an X and no X code is added
+    data = Codelist.from_data([{'code': 'X01', 'term': 'Disease X - 1'}, {'code': 'A01', 'term': 'Disease A - 1'}], "ICD10", add_x_codes=True)
+    assert data.data == [{'code': 'X01', 'term': 'Disease X - 1'}, {'code': 'A01', 'term': 'Disease A - 1'}, {'code': 'A01X', 'term': 'Disease A - 1'}]
+
 def test_repeated_code_codelist():
     with pytest.raises(RepeatedCodeError) as e:
         data = Codelist("tests/codelists/test_data/repeated_code_snomed_codelist.csv", CodelistType.SNOMED.value)
     
     assert "Repeated code found: 100000002" in str(e.value)
 
+def test_all_invalid_codes_reported_together():
+    with open("tests/codelists/test_data/test_invalid_codes.csv", "w") as f:
+        f.write("code,term\nA01,Disease A - 1\nA012.1,Disease A - 2\nA02,Disease A - 3\nA03A,Disease A - 4\n")
+
+    with pytest.raises(InvalidICD10CodeError) as e:
+        Codelist("tests/codelists/test_data/test_invalid_codes.csv", CodelistType.ICD10.value)
+
+    assert str(e.value) == "Invalid ICD10 code: A012.1 for term: Disease A - 2; Invalid ICD10 code: A03A for term: Disease A - 4"
+    os.remove("tests/codelists/test_data/test_invalid_codes.csv")
+
+
+def test_all_repeated_codes_reported_together():
+    with open("tests/codelists/test_data/test_repeated_codes.csv", "w") as f:
+        f.write("code,term\nA01,Disease A - 1\nA02,Disease A - 2\nA01,Disease A - 3\nA02,Disease A - 4\nA02,Disease A - 5\n")
+
+    with pytest.raises(RepeatedCodeError) as e:
+        Codelist("tests/codelists/test_data/test_repeated_codes.csv", CodelistType.ICD10.value)
+
+    assert str(e.value) == "Repeated code found: A01; Repeated code found: A02"
+    os.remove("tests/codelists/test_data/test_repeated_codes.csv")
+
+
+def test_codes_validated_together_match_single_code_validation():
+    codes = ["A01", "A01X", "A01.1", "A011111", "A1", "001", "A010.1", "A01A", "A01X1", "A01.", "A01.21", "100000001", "10001", ""]
+    validators = {"SNOMED": Codelist.validate_snomed_code, "ICD10": Codelist.validate_icd10_code, "OPCS": Codelist.validate_opcs_code}
+
+    for codelist_type, validate in validators.items():
+        observed = pl.select(Codelist._valid_codes(pl.Series(codes), codelist_type)).to_series().to_list()
+        assert observed == [validate(code) for code in codes]
+
+
 def test_data_shape_codelist():
     with pytest.raises(InvalidDataShapeError) as e:
         data = Codelist("tests/codelists/test_data/extra_columns_snomed_codelist.csv", CodelistType.SNOMED.value)
@@ -244,3 +284,61 @@ def test_SNOMED_to_ICD10_map_with_repeats_3_digits():
 
 
 
+
+
+def test_SNOMED_to_ICD10_mapping_one_to_many():
+    with open("tests/codelists/test_data/test_one_to_many_map.csv", "w") as f:
+        f.write("conceptId,mapTarget,ICD10_3digit\n100000001,A011,A01\n100000001,B011,B01\n100000002,A02.1,A02\n")
+    data = Codelist(GOOD_SNOMED_PATH, "SNOMED")
+    mapped_data = data.map_snomed_to_icd10(data, "tests/codelists/test_data/test_one_to_many_map.csv")
+
+    # both ICD10 codes of 100000001 are kept
+    assert mapped_data.data == [
+        {'code': 'A011', 'term': 'Mapped from SNOMED Code: 100000001, Term: Disease A - 1'},
+        {'code': 'B011', 'term': 'Mapped from SNOMED Code: 100000001, Term: Disease A - 1'},
+        {'code': 'A02.1', 'term': 'Mapped from SNOMED Code: 100000002, Term: Disease A - 2'},
+    ]
+    assert mapped_data.codes == {"A011", "B011", "A02.1"}
+    assert mapped_data.path is None
+
+    os.remove("tests/codelists/test_data/test_one_to_many_map.csv")
+
+
+def test_SNOMED_to_ICD10_mapping_loaded_once():
+    mapping_file = 'tests/codelists/test_data/snomed_to_icd_map.csv'
+    mapping = SnomedToIcd10Mapping.load(mapping_file)
+    assert SnomedToIcd10Mapping.load(mapping_file) is mapping
+
+    # a loaded mapping table can be passed instead of the path
+    data = Codelist(GOOD_SNOMED_to_be_ICD10_PATH, "SNOMED")
+    assert data.map_snomed_to_icd10(data, mapping).data == data.map_snomed_to_icd10(data, mapping_file).data
+
+
+def test_codelist_from_data():
+    data = Codelist.from_data([{'code': 'A01', 'term': 'Disease A - 1'}, {'code': 'A02', 'term': 'Disease A - 2'}], "ICD10", add_x_codes=True)
+    assert data.data == CORRECT_ICD_DATA_WITH_X
+    assert data.codes == {"A01", "A01X", "A02", "A02X"}
+
+    with pytest.raises(InvalidICD10CodeError) as e:
+        Codelist.from_data([{'code': '100000001', 'term': 'Disease A - 1'}], "ICD10")
+    assert "Invalid ICD10 code: 100000001 for term: Disease A - 1" in str(e.value)
+
+
+def test_expand_snomed_descendants():
+    hierarchy = SnomedHierarchy.build("tests/codelists/test_data/snomed_relationships.txt")
+    data = Codelist(GOOD_SNOMED_PATH, "SNOMED")
+    expanded_data = Codelist.expand_snomed_descendants(data, hierarchy)
+
+    # 100000002 is in the codelist already, and 100000005 is a descendant of both codes, so it is added once
+    assert expanded_data.data == [
+        {'code': '100000001', 'term': 'Disease A - 1'},
+        {'code': '100000002', 'term': 'Disease A - 2'},
+        {'code': '100000003', 'term': 'Descendant of SNOMED Code: 100000001, Term: Disease A - 1'},
+        {'code': '100000004', 'term': 'Descendant of SNOMED Code: 100000001, Term: Disease A - 1'},
+        {'code': '100000005', 'term': 'Descendant of SNOMED Code: 100000001, Term: Disease A - 1'},
+    ]
+    assert expanded_data.codes == {"100000001", "100000002", "100000003", "100000004", "100000005"}
+
+    with pytest.raises(InvalidProcessingRequest) as e:
+        Codelist.expand_snomed_descendants(Codelist(GOOD_ICD10_PATH, "ICD10"), hierarchy)
+    assert "Only SNOMED codelists can be expanded to their descendants." in str(e.value)
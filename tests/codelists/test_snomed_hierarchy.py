@@ -0,0 +1,76 @@
+import pytest
+
+import os
+import shutil
+
+from tretools.codelists.snomed_hierarchy import SnomedHierarchy
+from tretools.codelists.errors import InvalidSNOMEDHierarchyError
+
+
+RELATIONSHIPS_PATH = "tests/codelists/test_data/snomed_relationships.txt"
+CACHE_DIR = "tests/codelists/test_data/snomed_cache"
+
+
+def test_build_closure():
+    hierarchy = SnomedHierarchy.build(RELATIONSHIPS_PATH)
+
+    # inactive and non "is a" relationships are left out, and 100000005 has two parents, 3 steps below 100000001
+    assert hierarchy.closure.rows() == [
+        (100000001, 100000002),
+        (100000001, 100000003),
+        (100000001, 100000004),
+        (100000001, 100000005),
+        (100000002, 100000004),
+        (100000002, 100000005),
+        (100000003, 100000005),
+        (100000004, 100000005),
+        (200000001, 200000002),
+    ]
+    assert "in 3 rounds, with 6 relationships and 9 ancestor-descendant pairs" in hierarchy.log[-1]
+
+
+def test_build_closure_with_cycle():
+    cycle_path = "tests/codelists/test_data/snomed_relationships_cycle.txt"
+    with open(RELATIONSHIPS_PATH, "r") as f:
+        lines = f.readlines()
+    with open(cycle_path, "w") as f:
+        f.writelines(lines)
+        f.write("1008\t20240101\t1\t900000000000207008\t100000001\t100000005\t0\t116680003\t900000000000011006\t900000000000451002\n")
+
+    with pytest.raises(InvalidSNOMEDHierarchyError) as e:
+        SnomedHierarchy.build(cycle_path)
+    assert "is its own ancestor" in str(e.value)
+
+    os.remove(cycle_path)
+
+
+def test_build_closure_bad_path():
+    with pytest.raises(FileNotFoundError) as e:
+        SnomedHierarchy.build("tests/codelists/test_data/no_relationships.txt")
+    assert "Could not find SNOMED relationships file" in str(e.value)
+
+
+def test_load_caches_closure():
+    hierarchy = SnomedHierarchy.load(RELATIONSHIPS_PATH, CACHE_DIR)
+    assert SnomedHierarchy.load(RELATIONSHIPS_PATH, CACHE_DIR) is hierarchy
+
+    # the closure is saved, and read back with a memory map by a new process
+    saved = os.listdir(CACHE_DIR)
+    assert len(saved) == 1 and saved[0].startswith("snomed_closure_")
+    read_hierarchy = SnomedHierarchy.read(os.path.join(CACHE_DIR, saved[0]))
+    assert read_hierarchy.closure.rows() == hierarchy.closure.rows()
+    assert "using a memory map" in read_hierarchy.log[-1]
+
+    shutil.rmtree(CACHE_DIR)
+    SnomedHierarchy._loaded.clear()
+
+
+def test_descendants():
+    hierarchy = SnomedHierarchy.build(RELATIONSHIPS_PATH)
+
+    assert hierarchy.descendants([100000002]).rows() == [(100000002, 100000004), (100000002, 100000005)]
+    assert hierarchy.descendants([200000001, 100000004, 100000005]).rows() == [
+        (100000004, 100000005),
+        (200000001, 200000002),
+    ]
+    assert hierarchy.descendants([]).is_empty()
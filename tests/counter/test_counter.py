@@ -1,7 +1,11 @@
+import os
+import shutil
 import pytest
+import polars as pl
 
-from tretools.counter.counter import EventCounter, categorise_age
-from tretools.counter.errors import MismatchBetweenDatasetAndCodelist
+from tretools.counter.code_index import CodePrefixIndex
+from tretools.counter.counter import EventCounter, age_range_expr, categorise_age, code_filter, code_ranges, gender_label_expr, select_first_events
+from tretools.counter.errors import MismatchBetweenDatasetAndCodelist, PrefixMatchNotSupported
 from tretools.codelists.codelist import Codelist
 from tretools.datasets.processed_dataset import ProcessedDataset
 
@@ -43,6 +47,199 @@ def test_count_events():
     assert "There are 2 people in the dataset for the codelist" in counter.counts["test_count"]["log"][3]
 
 
+def test_count_events_lazy_parquet():
+    codelist = Codelist("tests/codelists/test_data/good_snomed_codelist.csv", "SNOMED")
+
+    # write the data to parquet, and count the events from a lazy scan of the file
+    dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+    dataset.write_to_parquet("tests/test_data/primary_care/test_counter.parquet", row_group_size=2)
+    lazy_dataset = ProcessedDataset(path="tests/test_data/primary_care/test_counter.parquet", dataset_type="primary_care", coding_system="SNOMED", lazy=True)
+
+    counter = EventCounter(dataset)
+    counter.count_events("test_count", codelist)
+    lazy_counter = EventCounter(lazy_dataset)
+    lazy_counter.count_events("test_count", codelist)
+
+    assert "There are 7 events in the dataset" in lazy_counter.counts["test_count"]["log"][0]
+    assert lazy_counter.counts["test_count"]["patient_count"] == 2
+    assert lazy_counter.counts["test_count"]["event_count"] == 4
+    assert lazy_counter.counts["test_count"]["nhs_numbers"].sort("nhs_number").frame_equal(counter.counts["test_count"]["nhs_numbers"].sort("nhs_number"))
+
+    os.remove("tests/test_data/primary_care/test_counter.parquet")
+
+
+def test_code_filter_skips_parquet_row_groups(capfd):
+    # the codes are sorted into 4 row groups: [100000001, 100000001], [100000001, 100000002],
+    # [200000001, 200000001] and [200000001]
+    dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+    dataset.write_to_parquet("tests/test_data/primary_care/test_code_filter.parquet", row_group_size=2)
+
+    # polars reports whether each row group is read or skipped when it is verbose
+    capfd.readouterr()
+    pl.Config.set_verbose(True)
+    try:
+        data = pl.scan_parquet("tests/test_data/primary_care/test_code_filter.parquet").filter(code_filter([200000001])).collect()
+    finally:
+        pl.Config.set_verbose(False)
+    messages = capfd.readouterr().err
+
+    # only the 2 row groups with the code are read
+    assert data["code"].to_list() == [200000001, 200000001, 200000001]
+    assert messages.count("can be skipped, the statistics were sufficient") == 2
+    assert messages.count("must be read, statistics not sufficient") == 2
+
+    os.remove("tests/test_data/primary_care/test_code_filter.parquet")
+
+
+def test_count_events_partitioned():
+    codelist = Codelist("tests/codelists/test_data/good_icd_codelist.csv", "ICD10")
+
+    # write the data partitioned by ICD10 stem, and count the events from the partitions
+    dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system="ICD10")
+    dataset.write_to_partitions("tests/test_data/barts_health/test_counter", prefix_length=3)
+    partitioned_dataset = ProcessedDataset(path="tests/test_data/barts_health/test_counter", dataset_type="secondary_care", coding_system="ICD10", lazy=True)
+
+    # only the A01 and A02 partitions are read, and there is no A02 partition
+    assert partitioned_dataset._partition_files(["A01", "A02"]) == [os.path.join("tests/test_data/barts_health/test_counter", "code_prefix=A01", "data.parquet")]
+
+    counter = EventCounter(dataset)
+    counter.count_events("test_count", codelist)
+    partitioned_counter = EventCounter(partitioned_dataset)
+    partitioned_counter.count_events("test_count", codelist)
+
+    assert "There are 10 events in the dataset" in partitioned_counter.counts["test_count"]["log"][0]
+    assert partitioned_counter.counts["test_count"]["patient_count"] == counter.counts["test_count"]["patient_count"] == 2
+    assert partitioned_counter.counts["test_count"]["event_count"] == counter.counts["test_count"]["event_count"] == 2
+
+    shutil.rmtree("tests/test_data/barts_health/test_counter")
+
+
+def test_count_events_batch():
+    dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+    codelists = {
+        "disease_a": Codelist("tests/codelists/test_data/good_snomed_codelist.csv", "SNOMED"),
+        "disease_a_1": Codelist.from_data([{"code": "100000001", "term": "Disease A - 1"}], "SNOMED"),
+        "disease_b": Codelist.from_data([{"code": "200000001", "term": "Disease B - 1"}], "SNOMED"),
+        "no_events": Codelist.from_data([{"code": "300000001", "term": "Disease C - 1"}], "SNOMED"),
+    }
+
+    batch_counter = EventCounter(dataset)
+    batch_counter.count_events_batch(codelists)
+
+    # the counts are the same as counting each codelist on its own
+    for name, codelist in codelists.items():
+        counter = EventCounter(dataset)
+        counter.count_events(name, codelist)
+        expected, observed = counter.counts[name], batch_counter.counts[name]
+        assert observed["event_count"] == expected["event_count"]
+        assert observed["patient_count"] == expected["patient_count"]
+        assert set(observed["code"]) == set(expected["code"])
+        assert observed["nhs_numbers"].sort("nhs_number").frame_equal(expected["nhs_numbers"].sort("nhs_number"))
+
+    assert batch_counter.counts["disease_a"]["event_count"] == 4
+    assert batch_counter.counts["disease_b"]["patient_count"] == 2
+    assert batch_counter.counts["no_events"]["event_count"] == 0
+    assert batch_counter.counts["no_events"]["nhs_numbers"].columns == ["nhs_number", "code", "date"]
+    assert "Counting events for 4 codelists in one pass" in batch_counter.log[1]
+    assert "There are 7 events in the dataset for the 4 codelists" in batch_counter.log[2]
+    assert [step.step for step in batch_counter.steps] == ["EventCounter.count_events_batch"]
+
+
+def test_count_events_batch_lazy_with_prefix_match():
+    dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system="ICD10")
+    dataset.write_to_parquet("tests/test_data/barts_health/test_batch_counter.parquet", row_group_size=2)
+    lazy_dataset = ProcessedDataset(path="tests/test_data/barts_health/test_batch_counter.parquet", dataset_type="secondary_care", coding_system="ICD10", lazy=True)
+    codelists = {
+        "disease_a": Codelist("tests/codelists/test_data/good_icd_codelist.csv", "ICD10"),
+        "disease_c": Codelist.from_data([{"code": "C01", "term": "Disease C - 1"}], "ICD10"),
+    }
+
+    counter = EventCounter(lazy_dataset)
+    counter.count_events_batch(codelists, prefix_match=True)
+
+    assert counter.counts["disease_a"]["matched_codes"] == ["A01", "A01X"]
+    assert counter.counts["disease_a"]["event_count"] == 4
+    assert counter.counts["disease_a"]["patient_count"] == 3
+    assert counter.counts["disease_c"]["matched_codes"] == ["C01", "C01.1"]
+    assert counter.counts["disease_c"]["event_count"] == 2
+    assert counter.counts["disease_c"]["patient_count"] == 1
+
+    os.remove("tests/test_data/barts_health/test_batch_counter.parquet")
+
+
+def test_count_events_batch_mismatched_coding_system():
+    dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+    codelists = {
+        "snomed": Codelist("tests/codelists/test_data/good_snomed_codelist.csv", "SNOMED"),
+        "icd10": Codelist("tests/codelists/test_data/good_icd_codelist.csv", "ICD10"),
+    }
+
+    with pytest.raises(MismatchBetweenDatasetAndCodelist) as e:
+        EventCounter(dataset).count_events_batch(codelists)
+    assert "Coding system of dataset (SNOMED) does not match coding system of codelist (ICD10)" in str(e.value)
+
+
+def test_select_first_events():
+    data = pl.DataFrame({
+        "nhs_number": ["A", "A", "A", "B", "B", "C"],
+        "code": [300, 200, 100, 100, 100, 500],
+        "date": ["2020-01-02", "2020-01-01", "2020-01-01", "2019-05-05", "2018-05-05", "2021-01-01"],
+    })
+
+    # A has two events on its first date, so the lowest code is picked
+    observed = select_first_events(data).sort("nhs_number")
+    assert observed.columns == ["nhs_number", "code", "date"]
+    assert observed.rows() == [("A", 100, "2020-01-01"), ("B", 100, "2018-05-05"), ("C", 500, "2021-01-01")]
+
+    observed = select_first_events(data.with_columns(pl.lit("count").alias("count_name")), by=["count_name", "nhs_number"])
+    assert observed.columns == ["count_name", "nhs_number", "code", "date"]
+    assert observed.shape == (3, 4)
+
+
+def test_code_ranges():
+    assert code_ranges([3, 1, 2]) == [(1, 1), (2, 2), (3, 3)]
+    assert code_ranges([1, 2, 3, 100, 101, 1000], max_ranges=3) == [(1, 3), (100, 101), (1000, 1000)]
+    assert code_ranges(["E10", "E11", "I21", "I22", "J45"], max_ranges=3) == [("E10", "E11"), ("I21", "I22"), ("J45", "J45")]
+
+
+def test_count_events_prefix_match():
+    codelist = Codelist("tests/codelists/test_data/good_icd_codelist.csv", "ICD10")
+    dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system="ICD10")
+
+    counter = EventCounter(dataset)
+    counter.count_events("exact", codelist)
+    assert counter.counts["exact"]["event_count"] == 2
+
+    # A01 also counts A01X, and the index of the codes in the dataset is only built once
+    counter.count_events("prefix", codelist, prefix_match=True)
+    counter.count_events("prefix_again", codelist, prefix_match=True)
+    assert counter.counts["prefix"]["matched_codes"] == ["A01", "A01X"]
+    assert counter.counts["prefix"]["event_count"] == 4
+    assert counter.counts["prefix"]["patient_count"] == 3
+    assert "matched_codes" not in counter.counts["exact"]
+    assert sum("Built an index of the" in line for line in counter.log) == 1
+    assert "Prefix matching the 2 codes in the codelist matched 2 codes in the dataset" in counter.log[-3]
+
+
+def test_count_events_prefix_match_with_snomed():
+    codelist = Codelist("tests/codelists/test_data/good_snomed_codelist.csv", "SNOMED")
+    dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+
+    with pytest.raises(PrefixMatchNotSupported) as e:
+        EventCounter(dataset).count_events("test_count", codelist, prefix_match=True)
+    assert "Prefix matching is only supported for ICD10 and OPCS codelists" in str(e.value)
+
+
+def test_code_prefix_index():
+    index = CodePrefixIndex(["A01", "A010", "A01.1", "A01X", "A02", "A0", "B01", None, "A01"])
+
+    assert index.match("A01") == ["A01", "A01.1", "A010", "A01X"]
+    assert index.match("A0") == ["A0", "A01", "A01.1", "A010", "A01X", "A02"]
+    assert index.match("A01.") == ["A01.1"]
+    assert index.match("C") == []
+    assert index.match_all(["B01", "A02", "A02"]) == ["A02", "B01"]
+
+
 def test_count_events_mismatched_coding_system():
     with pytest.raises(MismatchBetweenDatasetAndCodelist) as e:
         # load codelist with icd10 codes
@@ -67,3 +264,16 @@ def test_categorise_age():
     assert categorise_age(80) == "75-84"
     assert categorise_age(90) == "85+"
     assert categorise_age(10) == "<18"
+
+
+def test_age_range_expr():
+    ages = [None, 0, 17, 18, 24, 25, 34, 35, 54, 55, 64, 65, 84, 85, 110]
+    observed = pl.DataFrame({"age_at_event": ages}).select(age_range_expr())["age_at_event"].to_list()
+
+    # the same ranges as categorise_age, including at the edges of each range
+    assert observed == [None] + [categorise_age(age) for age in ages[1:]]
+
+
+def test_gender_label_expr():
+    observed = pl.DataFrame({"gender": [1, 2, 2, None, 9]}).select(gender_label_expr())["gender"].to_list()
+    assert observed == ["M", "F", "F", None, None]
@@ -1,8 +1,10 @@
 import pytest
 import os
 import csv
+import json
+import polars as pl
 
-from tretools.datasets.base import Dataset
+from tretools.datasets.base import Dataset, MAX_PARQUET_ROW_GROUPS
 from tretools.datasets.errors import DatasetPathNotCorrect, DatasetPathNotCorrect, WriteOptionsInvalid, UnsupportedFileType
 
 
@@ -79,7 +81,7 @@ def test_raises_error_if_not_csv_or_feather_txt():
     with pytest.raises(UnsupportedFileType) as e:
         ingested_data = Dataset(path="tests/test_data/primary_care/fake_data.xlsx", dataset_type="primary_care", coding_system="SNOMED")
 
-    assert "File type not supported. Must be either .csv, .txt or .arrow" in str(e.value)
+    assert "File type not supported. Must be either .csv, .txt, .arrow or .parquet" in str(e.value)
 
 
 def test_writes_csv():
@@ -115,6 +117,112 @@ def test_write_to_feather():
     os.remove("tests/test_data/primary_care/test_data.arrow")
 
 
+def test_write_to_feather_for_memory_map():
+    ingested_data = Dataset(path="tests/test_data/primary_care/processed_data.arrow", dataset_type="primary_care", coding_system="SNOMED")
+    ingested_data.data = pl.concat([ingested_data.data, ingested_data.data], rechunk=False)
+    assert ingested_data.data.n_chunks() == 2
+
+    # write to feather as a single uncompressed block per column
+    ingested_data.write_to_feather("tests/test_data/primary_care/test_data.arrow", for_memory_map=True)
+
+    loaded_data = Dataset(path="tests/test_data/primary_care/test_data.arrow", dataset_type="primary_care", coding_system="SNOMED")
+    assert "Loaded data from tests/test_data/primary_care/test_data.arrow using a memory map" in loaded_data.log[0]
+    assert loaded_data.data.n_chunks() == 1
+    assert loaded_data.data.frame_equal(ingested_data.data)
+
+    # overwriting the file that is memory-mapped does not change the loaded data
+    loaded_data.data.head(1).write_ipc("tests/test_data/primary_care/other_data.arrow")
+    Dataset(path="tests/test_data/primary_care/other_data.arrow", dataset_type="primary_care", coding_system="SNOMED").write_to_feather("tests/test_data/primary_care/test_data.arrow")
+    assert loaded_data.data.frame_equal(ingested_data.data)
+
+    # delete the files
+    os.remove("tests/test_data/primary_care/test_data.arrow")
+    os.remove("tests/test_data/primary_care/other_data.arrow")
+
+
+def test_write_to_parquet():
+    ingested_data = Dataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+
+    # write to parquet, sorted by code
+    ingested_data.write_to_parquet("tests/test_data/primary_care/test_data.parquet", row_group_size=2)
+    assert "Data written to tests/test_data/primary_care/test_data.parquet, sorted by code in row groups of 2 rows" in ingested_data.log[-1]
+
+    # read the parquet file back in, both eagerly and lazily
+    loaded_data = Dataset(path="tests/test_data/primary_care/test_data.parquet", dataset_type="primary_care", coding_system="SNOMED")
+    assert loaded_data.data.frame_equal(ingested_data.data.sort("code"))
+    assert loaded_data.data["code"].to_list() == [100000001, 100000001, 100000001, 100000002, 200000001, 200000001, 200000001]
+
+    scanned_data = Dataset(path="tests/test_data/primary_care/test_data.parquet", dataset_type="primary_care", coding_system="SNOMED", lazy=True)
+    assert scanned_data.data.filter(pl.col("code") == 100000002).collect().shape == (1, 3)
+
+    # delete the file
+    os.remove("tests/test_data/primary_care/test_data.parquet")
+
+
+def test_write_to_feather_with_options():
+    ingested_data = Dataset(path="tests/test_data/primary_care/processed_data.arrow", dataset_type="primary_care", coding_system="SNOMED", memory_map=False)
+
+    # compressed, sorted and split into record batches of 3 rows
+    ingested_data.write_to_feather("tests/test_data/primary_care/test_data.arrow", compression="zstd", chunk_size=3, sort=True, write_summary=True)
+    assert "Data written to tests/test_data/primary_care/test_data.arrow with zstd compression" in ingested_data.log[-2]
+    assert "Summary of 7 rows written to tests/test_data/primary_care/test_data.arrow.summary.json" in ingested_data.log[-1]
+
+    loaded_data = pl.read_ipc("tests/test_data/primary_care/test_data.arrow", memory_map=False)
+    assert loaded_data.frame_equal(ingested_data.data.sort(["nhs_number", "code", "date"]))
+
+    # the summary answers basic questions without reading the data
+    summary = Dataset.read_summary("tests/test_data/primary_care/test_data.arrow")
+    assert summary["rows"] == 7
+    assert summary["patients"] == 3
+    assert summary["codes"] == 3
+    assert summary["first_date"] == "2013-06-03"
+    assert summary["last_date"] == "2020-05-22"
+
+    os.remove("tests/test_data/primary_care/test_data.arrow")
+    os.remove("tests/test_data/primary_care/test_data.arrow.summary.json")
+
+
+def test_write_to_feather_with_wrong_options():
+    ingested_data = Dataset(path="tests/test_data/primary_care/processed_data.arrow", dataset_type="primary_care", coding_system="SNOMED")
+
+    with pytest.raises(WriteOptionsInvalid) as e:
+        ingested_data.write_to_feather("tests/test_data/primary_care/test_data.arrow", compression="brotli")
+    assert "Invalid compression for a feather file: brotli" in str(e.value)
+
+    with pytest.raises(WriteOptionsInvalid) as e:
+        ingested_data.write_to_feather("tests/test_data/primary_care/test_data.arrow", for_memory_map=True, compression="lz4")
+    assert "A feather file for a memory map must be uncompressed and written as a single chunk" in str(e.value)
+
+    assert not os.path.exists("tests/test_data/primary_care/test_data.arrow")
+
+
+def test_write_to_csv_with_gzip():
+    ingested_data = Dataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+
+    # a .gz path is written compressed, and can be read back in
+    ingested_data.write_to_csv("tests/test_data/primary_care/test_data.csv.gz", sort=True, compression_level=1)
+    loaded_data = Dataset(path="tests/test_data/primary_care/test_data.csv.gz", dataset_type="primary_care", coding_system="SNOMED")
+    assert loaded_data.data.frame_equal(ingested_data.data.sort(["nhs_number", "code", "date"]))
+
+    with pytest.raises(WriteOptionsInvalid) as e:
+        ingested_data.write_to_csv("tests/test_data/primary_care/test_data.csv", compression_level=1)
+    assert "A compression level can only be given for a .gz or .zst file" in str(e.value)
+
+    os.remove("tests/test_data/primary_care/test_data.csv.gz")
+
+
+def test_read_summary_without_summary():
+    with pytest.raises(DatasetPathNotCorrect) as e:
+        Dataset.read_summary("tests/test_data/primary_care/processed_data.arrow")
+    assert "No summary found for Dataset: tests/test_data/primary_care/processed_data.arrow" in str(e.value)
+
+
+def test_read_from_feather_without_memory_map():
+    loaded_data = Dataset(path="tests/test_data/primary_care/processed_data.arrow", dataset_type="primary_care", coding_system="SNOMED", memory_map=False)
+    assert loaded_data.data.shape == (7, 4)
+    assert loaded_data.log[0].endswith("Loaded data from tests/test_data/primary_care/processed_data.arrow")
+
+
 def test_read_from_csv():
     # read the csv back in
     loaded_data = Dataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
@@ -145,4 +253,127 @@ def test_read_from_txt_with_wrong_separator():
     with pytest.raises(Exception) as e:
         loaded_data = Dataset(path="tests/test_data/nhs_digital/fake_data.txt", dataset_type="nhs_digital", coding_system="ICD10")
 
-    assert "Unable to determine the file separator." in str(e.value)
\ No newline at end of file
+    assert "Unable to determine the file separator." in str(e.value)
+
+def test_from_dataframe():
+    data = pl.DataFrame({"nhs_number": ["A", "B"], "code": ["A01", "A02"], "date": ["2020-01-01", "2021-01-01"]})
+    dataset = Dataset.from_dataframe(data, dataset_type="primary_care", coding_system="ICD10", log=["test log"])
+
+    assert dataset.data.shape == (2, 3)
+    assert dataset.dataset_type == "primary_care"
+    assert dataset.coding_system == "ICD10"
+    assert dataset.path is None
+    assert dataset.log == ["test log"]
+
+
+def test_schema_is_inferred_from_a_sample():
+    observed_dataset = Dataset(path="tests/test_data/primary_care/procedures_with_scientific_notation.csv", dataset_type="primary_care", coding_system="SNOMED")
+    schema = observed_dataset._sniff_schema("tests/test_data/primary_care/procedures_with_scientific_notation.csv", ",")
+
+    assert schema["dtypes"] == {"pseudo_nhs_number": "Utf8", "id": "Int64", "clinical_effective_date": "Utf8",
+                                "original_code": "Float64", "original_term": "Utf8"}
+    # The scientific notation column is read as floats and cast to integers
+    assert schema["scientific_notation"] == ["original_code"]
+    assert observed_dataset.data["original_code"].dtype == pl.Int64
+
+
+def test_lazy_and_batched_reads_cast_rows_after_the_sample():
+    path = "tests/test_data/primary_care/late_text_code.csv"
+    # the code column is all integers in the sample, and has text in the last row
+    pl.DataFrame({
+        "nhs_number": ["A"] * 10001,
+        "code": [str(100000000 + i) for i in range(10000)] + ["EMIS123"],
+        "date": ["2020-01-01"] * 10001,
+    }).write_csv(path)
+
+    # the eager read falls back to strings, while the lazy and batched reads keep the sampled types and
+    # turn the value that does not fit into a null instead of failing
+    eager_data = Dataset(path=path, dataset_type="primary_care", coding_system="SNOMED").data
+    assert eager_data["code"][-1] == "EMIS123"
+
+    lazy_dataset = Dataset(path=path, dataset_type="primary_care", coding_system="SNOMED", lazy=True)
+    lazy_data = lazy_dataset.data.collect()
+    assert lazy_data["code"].dtype == pl.Int64
+    assert lazy_data["code"][-1] is None
+    assert lazy_data.head(10000).select(pl.all().cast(pl.Utf8)).frame_equal(eager_data.head(10000))
+
+    batches = list(lazy_dataset._iter_batches(4000))
+    assert len(batches) > 1
+    assert pl.concat(batches).frame_equal(lazy_data)
+
+    os.remove(path)
+
+
+def test_persisted_schema_is_replaced_when_rows_after_the_sample_do_not_fit():
+    path = "tests/test_data/primary_care/late_text_code.csv"
+    schema_path = f"{path}.schema.json"
+    # the code column is all integers in the sample, and has text in the last row
+    pl.DataFrame({
+        "nhs_number": ["A"] * 10001,
+        "code": [str(100000000 + i) for i in range(10000)] + ["EMIS123"],
+        "date": ["2020-01-01"] * 10001,
+    }).write_csv(path)
+
+    first_dataset = Dataset(path=path, dataset_type="primary_care", coding_system="SNOMED", persist_schema=True)
+    assert any("the schema saved for tests/test_data/primary_care/late_text_code.csv was replaced" in line for line in first_dataset.log)
+    with open(schema_path) as f:
+        assert json.load(f)["dtypes"]["code"] == "Utf8"
+
+    # the second load reads the file once with the saved schema, into the same data
+    second_dataset = Dataset(path=path, dataset_type="primary_care", coding_system="SNOMED", persist_schema=True)
+    assert not any("was replaced" in line for line in second_dataset.log)
+    assert second_dataset.data.frame_equal(first_dataset.data)
+    assert second_dataset.data["code"][-1] == "EMIS123"
+
+    os.remove(path)
+    os.remove(schema_path)
+
+
+def test_write_to_parquet_limits_row_groups(capfd):
+    path = "tests/test_data/primary_care/test_row_groups.parquet"
+    data = pl.DataFrame({
+        "nhs_number": ["A"] * 1100,
+        "code": [100000000 + i for i in range(1100)],
+        "date": ["2020-01-01"] * 1100,
+    })
+    dataset = Dataset.from_dataframe(data, dataset_type="primary_care", coding_system="SNOMED")
+
+    # 1,100 row groups of 1 row would be too many, so the row groups are made larger
+    dataset.write_to_parquet(path, row_group_size=1)
+    assert "sorted by code in row groups of 3 rows" in dataset.log[-1]
+
+    # polars reports whether each row group is read or skipped when it is verbose
+    capfd.readouterr()
+    pl.Config.set_verbose(True)
+    try:
+        filtered = pl.scan_parquet(path).filter(pl.col("code") == 100000500).collect()
+    finally:
+        pl.Config.set_verbose(False)
+    messages = capfd.readouterr().err
+    # only the row group with the code is read, out of about 1100 / 3 row groups
+    assert filtered.shape == (1, 3)
+    assert messages.count("must be read, statistics not sufficient") == 1
+    skipped = messages.count("can be skipped, the statistics were sufficient")
+    assert 300 < skipped < MAX_PARQUET_ROW_GROUPS
+
+    os.remove(path)
+
+
+def test_persisted_schema_is_reused():
+    path = "tests/test_data/primary_care/procedures.csv"
+    schema_path = f"{path}.schema.json"
+    Dataset(path=path, dataset_type="primary_care", coding_system="SNOMED", persist_schema=True)
+    assert os.path.exists(schema_path)
+
+    # Change the saved schema to check it is used instead of inferring the schema again
+    with open(schema_path) as f:
+        schema = json.load(f)
+    schema["dtypes"]["original_code"] = "Utf8"
+    with open(schema_path, "w") as f:
+        json.dump(schema, f)
+
+    observed_dataset = Dataset(path=path, dataset_type="primary_care", coding_system="SNOMED")
+    assert observed_dataset.data["original_code"].dtype == pl.Utf8
+    assert observed_dataset.data["original_code"][0] == "100000001"
+
+    os.remove(schema_path)
@@ -0,0 +1,104 @@
+import os
+import shutil
+
+from tretools.datasets.cache import ProcessedDatasetCache
+
+
+COLUMN_MAPS = {"original_code": "code", "clinical_effective_date": "date", "pseudo_nhs_number": "nhs_number"}
+
+
+def test_cache_miss_then_hit():
+    cache = ProcessedDatasetCache("tests/test_data/cache")
+    processed_dataset = cache.process_dataset("tests/test_data/primary_care/procedures.csv", "primary_care", "SNOMED",
+                                              deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+    assert "Processed data for tests/test_data/primary_care/procedures.csv stored in the cache" in processed_dataset.log[-1]
+    assert len(cache.index) == 1
+
+    # a new cache on the same directory loads the stored dataset and its log
+    cache = ProcessedDatasetCache("tests/test_data/cache")
+    cached_dataset = cache.process_dataset("tests/test_data/primary_care/procedures.csv", "primary_care", "SNOMED",
+                                           deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+    assert "Loaded processed data for tests/test_data/primary_care/procedures.csv from the cache" in cached_dataset.log[-1]
+    assert cached_dataset.log[:-1] == processed_dataset.log[:-1]
+    assert cached_dataset.data.sort(["nhs_number", "code", "date"]).frame_equal(processed_dataset.data.sort(["nhs_number", "code", "date"]))
+
+    # different options are a different entry
+    cache.process_dataset("tests/test_data/primary_care/procedures.csv", "primary_care", "SNOMED",
+                          deduplication_options=["nhs_number", "code"], column_maps=COLUMN_MAPS)
+    assert len(cache.index) == 2
+
+    shutil.rmtree("tests/test_data/cache")
+
+
+def test_cache_changed_file_is_processed_again():
+    shutil.copy("tests/test_data/primary_care/procedures.csv", "tests/test_data/primary_care/procedures_copy.csv")
+    cache = ProcessedDatasetCache("tests/test_data/cache")
+    cache.process_dataset("tests/test_data/primary_care/procedures_copy.csv", "primary_care", "SNOMED",
+                          deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+
+    # change the file
+    with open("tests/test_data/primary_care/procedures_copy.csv", "a") as f:
+        f.write("\n")
+    processed_dataset = cache.process_dataset("tests/test_data/primary_care/procedures_copy.csv", "primary_care", "SNOMED",
+                                              deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+    assert "stored in the cache" in processed_dataset.log[-1]
+    assert len(cache.index) == 2
+
+    # invalidating the file removes both of its entries
+    assert cache.invalidate("tests/test_data/primary_care/procedures_copy.csv") == 2
+    assert cache.index == {}
+    assert os.listdir("tests/test_data/cache") == ["cache_index.json"]
+
+    os.remove("tests/test_data/primary_care/procedures_copy.csv")
+    shutil.rmtree("tests/test_data/cache")
+
+
+def test_cache_with_content_hash():
+    cache = ProcessedDatasetCache("tests/test_data/cache", hash_contents=True)
+    cache.process_dataset("tests/test_data/primary_care/procedures.csv", "primary_care", "SNOMED",
+                          deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+
+    # a copy of the file has the same contents, so it is loaded from the cache
+    shutil.copy("tests/test_data/primary_care/procedures.csv", "tests/test_data/primary_care/procedures_copy.csv")
+    cached_dataset = cache.process_dataset("tests/test_data/primary_care/procedures_copy.csv", "primary_care", "SNOMED",
+                                           deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+    assert "from the cache" in cached_dataset.log[-1]
+
+    os.remove("tests/test_data/primary_care/procedures_copy.csv")
+    shutil.rmtree("tests/test_data/cache")
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ProcessedDatasetCache("tests/test_data/cache", max_size_mb=0)
+    cache.process_dataset("tests/test_data/primary_care/procedures.csv", "primary_care", "SNOMED",
+                          deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+    first_key = list(cache.index)[0]
+    cache.process_dataset("tests/test_data/primary_care/procedures.csv", "primary_care", "SNOMED",
+                          deduplication_options=["nhs_number", "code"], column_maps=COLUMN_MAPS)
+
+    # the cache is over its limit, so only the entry just added is kept
+    assert len(cache.index) == 1
+    assert first_key not in cache.index
+    assert not os.path.exists(f"tests/test_data/cache/{first_key}.arrow")
+
+    shutil.rmtree("tests/test_data/cache")
+
+
+def test_cache_with_shards():
+    shards = ["tests/test_data/primary_care/good_procedures_with_multiples.csv", "tests/test_data/primary_care/procedures_with_mixed_dates.csv"]
+    cache = ProcessedDatasetCache("tests/test_data/cache")
+    processed_dataset = cache.process_dataset(shards, "primary_care", "SNOMED",
+                                              deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+    assert "stored in the cache" in processed_dataset.log[-1]
+
+    # the shards are cached as one dataset, keyed on every shard
+    cached_dataset = cache.process_dataset(shards, "primary_care", "SNOMED",
+                                           deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+    assert "Loaded processed data" in cached_dataset.log[-1]
+    assert cached_dataset.data.shape == processed_dataset.data.shape
+
+    # removing the cached datasets of one shard removes the dataset it is part of
+    assert cache.invalidate(shards[1]) == 1
+    assert len(cache.index) == 0
+
+    shutil.rmtree("tests/test_data/cache")
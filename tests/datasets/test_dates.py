@@ -0,0 +1,103 @@
+import datetime
+import polars as pl
+
+from tretools.datasets.dates import DATE_FORMATS, detect_date_formats, parse_dates, format_counts_message, map_distinct
+
+
+EXAMPLE_DATES = {
+    "%Y%m%d": "20181005",
+    "%F": "2018-10-05",
+    "%F %T": "2018-10-05 12:15:30",
+    "%d/%m/%Y": "05/11/2018",
+    "%d-%m-%Y": "12-02-2019",
+    "%FT%T": "2020-05-22T08:45:50",
+    "%d.%m.%Y": "21.11.2012",
+    "%d-%m-%Y %H:%M": "03-06-2013 15:23",
+    "%d-%m-%Y %H:%M:%S": "19-10-2015 17:25:00",
+    "%B %d, %Y": "July 19, 2016",
+    "%Y-%m-%d %H:%M": "2016-08-20 07:10",
+    "%d/%m/%Y %H:%M": "19/10/2015 17:25",
+    "%FT%TZ": "2016-08-20T07:10:00Z",
+}
+
+
+def _parse_with_all_formats(dates: pl.Series) -> pl.Series:
+    return dates.to_frame("date").select(
+        pl.coalesce([pl.col("date").str.strptime(pl.Date, date_format, strict=False) for date_format in DATE_FORMATS])
+    ).to_series()
+
+
+def test_date_formats_do_not_overlap():
+    # Each example can only be parsed by its own format
+    for expected_format, example in EXAMPLE_DATES.items():
+        dates = pl.Series("date", [example])
+        assert detect_date_formats(dates) == [expected_format]
+
+
+def test_ambiguous_date_is_parsed_by_the_first_format():
+    # "18-10-05" is the 5th of October of year 18 with "%F", and the 18th of October of year 5 with "%d-%m-%Y"
+    dates = pl.Series("date", ["18-10-05"])
+    assert detect_date_formats(dates) == ["%F", "%d-%m-%Y"]
+    assert DATE_FORMATS.index("%F") < DATE_FORMATS.index("%d-%m-%Y")
+
+    converted, counts = parse_dates(dates)
+    assert converted[0] == datetime.date(18, 10, 5)
+    assert counts == {"%F": 1}
+
+
+def test_detect_date_formats():
+    dates = pl.Series("date", ["2018-10-05", "05/11/2018", None, "2019-01-01"])
+    assert detect_date_formats(dates) == ["%F", "%d/%m/%Y"]
+
+
+def test_parse_dates_matches_trying_every_format():
+    # Mostly one format, with a few rows in other formats that are not in the sample
+    dates = pl.Series("date", ["2018-10-05"] * 5000 + list(EXAMPLE_DATES.values()) + ["not a date", None])
+    converted, counts = parse_dates(dates)
+
+    assert converted.dtype == pl.Date
+    assert converted.series_equal(_parse_with_all_formats(dates), null_equal=True)
+    assert converted[0] == datetime.date(2018, 10, 5)
+
+    # Each value is counted against the format that parsed it
+    assert counts["%F"] == 5001
+    assert counts["%B %d, %Y"] == 1
+    assert counts[None] == 1
+
+
+def test_parse_dates_falls_back_for_formats_not_in_the_sample():
+    dates = pl.Series("date", ["2018-10-05", "2018-10-06", "July 19, 2016"])
+    converted, counts = parse_dates(dates, formats=["%F"])
+
+    assert converted.to_list() == [datetime.date(2018, 10, 5), datetime.date(2018, 10, 6), datetime.date(2016, 7, 19)]
+    assert counts == {"%F": 2, "%B %d, %Y": 1}
+
+
+def test_format_counts_message():
+    message = format_counts_message({"%F": 10, "%d/%m/%Y": 2, None: 1})
+    assert message == "Date formats found: '%F' (10 row(s)), '%d/%m/%Y' (2 row(s)). 1 date(s) could not be parsed"
+
+
+def test_map_distinct_applies_function_once_per_value():
+    calls = []
+
+    def to_date(dates: pl.Series) -> pl.Series:
+        calls.append(len(dates))
+        return dates.str.strptime(pl.Date, "%Y-%m-%d", strict=False)
+
+    dates = pl.Series("dob", ["2000-01-15", "1990-06-15", "2000-01-15", None, "1990-06-15"])
+    converted = map_distinct(dates, to_date)
+
+    # The function is called once with the 3 distinct values (including null)
+    assert calls == [3]
+    assert converted.name == "dob"
+    assert converted.to_list() == [datetime.date(2000, 1, 15), datetime.date(1990, 6, 15), datetime.date(2000, 1, 15),
+                                   None, datetime.date(1990, 6, 15)]
+
+
+def test_parse_dates_counts_rows_not_distinct_values():
+    dates = pl.Series("date", ["2018-10-05"] * 3 + ["05/11/2018"] * 2 + ["not a date"] * 2)
+    converted, counts = parse_dates(dates)
+
+    assert counts == {"%F": 3, "%d/%m/%Y": 2, None: 2}
+    assert converted.to_list() == [datetime.date(2018, 10, 5)] * 3 + [datetime.date(2018, 11, 5)] * 2 + [None] * 2
@@ -1,3 +1,5 @@
+import os
+import shutil
 import pytest
 import datetime
 import polars as pl
@@ -5,7 +7,7 @@ import polars as pl
 from tretools.datasets.processed_dataset import ProcessedDataset
 from tretools.datasets.demographic_dataset import DemographicDataset
 from tretools.codelists.codelist_types import CodelistType
-from tretools.datasets.errors import DeduplicationError, CodeNotMappable
+from tretools.datasets.errors import DeduplicationError, CodeNotMappable, WriteOptionsInvalid
 
 def test_load_processed_dataset():
     observed_dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
@@ -26,6 +28,43 @@ def test_merge_with_dataset():
     assert observed_dataset_one.data.shape == (14, 3)
 
 
+def test_merge_with_datasets():
+    observed_dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+    other_datasets = [ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED") for _ in range(3)]
+
+    observed_dataset.merge_with_datasets(other_datasets)
+
+    # the data is merged into a single chunk, with a single log entry for the merge
+    assert observed_dataset.data.shape == (28, 3)
+    assert observed_dataset.data.n_chunks() == 1
+    assert "Merged dataset with 3 dataset(s)" in observed_dataset.log[-1]
+    assert "Before merging, dataset had 7 rows. After merging, dataset has 28 rows" in observed_dataset.log[-1]
+
+
+def test_merge_with_datasets_and_deduplicate():
+    observed_dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+    other_datasets = [ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED") for _ in range(3)]
+    expected_data = observed_dataset.deduplicate().data
+
+    observed_dataset.merge_with_datasets(other_datasets, deduplicate=True)
+
+    assert observed_dataset.data.frame_equal(expected_data)
+    assert "dropping duplicates based on nhs_number, code and date. Before merging, dataset had 7 rows. After merging, dataset has 7 rows" in observed_dataset.log[-1]
+
+
+def test_merge_with_datasets_checks_every_dataset():
+    observed_dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+    other_datasets = [ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED"),
+                      ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="secondary_care", coding_system="SNOMED")]
+
+    with pytest.raises(DeduplicationError) as e:
+        observed_dataset.merge_with_datasets(other_datasets)
+
+    assert "Dataset type must be the same for both datasets" in str(e.value)
+    # nothing is merged if any dataset cannot be merged
+    assert observed_dataset.data.shape == (7, 3)
+
+
 def test_merge_with_dataset_different_coding_system():
     observed_dataset_one = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
     observed_dataset_two = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="ICD10")
@@ -148,8 +187,9 @@ def test_truncate_icd_to_3_digits_logs():
     observed_dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system=CodelistType.ICD10.value, log_path="tests/test_data/barts_health/diagnosis_log.txt")
     truncated_dataset = observed_dataset.truncate_icd_to_3_digits()
 
-    # there are 7 logs in the original dataset, 1 from loading and 3 created by the truncation function
-    assert len(truncated_dataset.log) == 11
+    # there are 7 logs in the original dataset and 3 created by the truncation function. The data is not
+    # re-loaded from disk, so there is no extra loading log
+    assert len(truncated_dataset.log) == 10
     assert "Post-truncation dataset has 10 rows" in truncated_dataset.log[9]
 
 
@@ -186,4 +226,172 @@ def test_removes_unrealistic_data_before_born_but_no_data():
     with pytest.raises(ValueError) as e:
         observed_dataset.remove_unrealistic_dates(before_born=True)
 
-    assert "A demographic dataset must be provided if before_born is True" in str(e.value)
\ No newline at end of file
+    assert "A demographic dataset must be provided if before_born is True" in str(e.value)
+
+def test_derived_dataset_is_not_reloaded_from_disk():
+    observed_dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system=CodelistType.ICD10.value)
+    truncated_dataset = observed_dataset.truncate_icd_to_3_digits()
+
+    # the new dataset keeps the path, type and coding system of the original
+    assert truncated_dataset.path == "tests/test_data/barts_health/diagnosis.csv"
+    assert truncated_dataset.dataset_type == "secondary_care"
+    assert truncated_dataset.coding_system == CodelistType.ICD10.value
+
+    # only the original load is in the log
+    loading_logs = [log for log in truncated_dataset.log if "Loaded data from" in log]
+    assert len(loading_logs) == 1
+
+
+def test_compact_dataset():
+    observed_dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="barts_health", coding_system=CodelistType.ICD10.value, compact=True)
+
+    assert observed_dataset.data.schema["nhs_number"] == pl.Categorical
+    assert observed_dataset.data.schema["code"] == pl.Categorical
+    assert observed_dataset.data.schema["date"] == pl.Date
+    assert "Data compacted, storing nhs_number as a categorical, code as a categorical, date as a date" in observed_dataset.log[-1]
+
+    # the compact dataset gives the same results as the original one
+    original_dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="barts_health", coding_system=CodelistType.ICD10.value)
+    compact_truncated = observed_dataset.truncate_icd_to_3_digits().deduplicate(date_start="2010-01-01")
+    original_truncated = original_dataset.truncate_icd_to_3_digits().deduplicate(date_start="2010-01-01")
+    assert compact_truncated.data.schema["code"] == pl.Categorical
+    assert compact_truncated.data.select(pl.all().cast(pl.Utf8)).frame_equal(original_truncated.data)
+
+
+def test_compact_turns_on_global_string_cache_once():
+    pl.disable_string_cache()
+    first_dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED", compact=True)
+    second_dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED", compact=True)
+
+    assert pl.using_string_cache()
+    assert any("Turned on the polars global string cache" in line for line in first_dataset.log)
+    assert not any("Turned on the polars global string cache" in line for line in second_dataset.log)
+    # the compact columns of the two datasets share the cache, so they can be joined
+    assert first_dataset.data.join(second_dataset.data, on=["nhs_number", "code"]).shape[0] > 0
+
+
+def test_compact_dataset_with_demographics():
+    observed_dataset = ProcessedDataset(path="tests/test_data/primary_care/procedures_with_unrealistic_values.csv", dataset_type="primary_care", coding_system="SNOMED", compact=True)
+    demographic_dataset = DemographicDataset(path="tests/test_data/demographics/processed.csv")
+
+    # dates are compared as dates, and the compact nhs numbers can be joined with the demographic data
+    cleaned_dataset = observed_dataset.remove_unrealistic_dates(before_born=False)
+    assert cleaned_dataset.data["date"].to_list() == [datetime.date(1910, 1, 1)]
+    cleaned_dataset = observed_dataset.remove_unrealistic_dates(before_born=True, demographic_dataset=demographic_dataset)
+    assert cleaned_dataset.data.shape == (0, 3)
+
+
+def test_merge_compact_with_not_compact_dataset():
+    observed_dataset_one = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED", compact=True)
+    observed_dataset_two = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system="SNOMED")
+
+    with pytest.raises(DeduplicationError) as e:
+        observed_dataset_one.merge_with_dataset(observed_dataset_two)
+
+    assert "Column types must be the same for both datasets" in str(e.value)
+
+
+def test_append_delta():
+    dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system=CodelistType.SNOMED.value).deduplicate()
+    delta_data = pl.DataFrame({
+        "nhs_number": ["73951AB0712D6E241E8222EDCCF28AE86DA72814078D6F48ECE512C91B5B104B",
+                       "73951AB0712D6E241E8222EDCCF28AE86DA72814078D6F48ECE512C91B5B104B",
+                       "00000AB0712D6E241E8222EDCCF28AE86DA72814078D6F48ECE512C91B5B104B",
+                       "00000AB0712D6E241E8222EDCCF28AE86DA72814078D6F48ECE512C91B5B104B"],
+        "code": [100000001, 100000002, 100000001, 100000001],
+        "date": ["2013-06-03", "2020-01-01", "2021-01-01", "2021-01-01"],
+    })
+    delta = ProcessedDataset.from_dataframe(delta_data, dataset_type="primary_care", coding_system=CodelistType.SNOMED.value, path="delta.csv")
+    appended_dataset = dataset.append_delta(delta)
+
+    # one row in the delta is already in the dataset and one is a duplicate, so 2 rows are added
+    expected_data = pl.concat([dataset.data, delta_data]).unique().sort(["nhs_number", "code", "date"])
+    assert appended_dataset.data.shape == (9, 3)
+    assert appended_dataset.data.frame_equal(expected_data)
+    assert "Appending delta from delta.csv. Delta has 4 rows, and 3 rows after deduplicating" in appended_dataset.log[-3]
+    assert "1 rows in the delta were already in the dataset" in appended_dataset.log[-2]
+    assert "Appended 2 new rows. Dataset has 9 rows, sorted by nhs_number, code and date" in appended_dataset.log[-1]
+
+    # a compact dataset gives the same result
+    dataset.compact()
+    delta.compact()
+    compact_appended_dataset = dataset.append_delta(delta)
+    assert compact_appended_dataset.data.select(pl.all().cast(pl.Utf8)).frame_equal(expected_data.select(pl.all().cast(pl.Utf8)))
+
+
+def test_append_delta_sorts_and_deduplicates_dataset():
+    # the patients are in order, but the codes and dates of patient B are not, and one row is repeated
+    history_data = pl.DataFrame({
+        "nhs_number": ["A", "B", "B", "B", "C"],
+        "code": ["100000002", "100000003", "100000001", "100000003", "100000001"],
+        "date": ["2020-01-01", "2021-01-01", "2020-01-01", "2021-01-01", "2020-01-01"],
+    })
+    delta_data = pl.DataFrame({
+        "nhs_number": ["B", "C"],
+        "code": ["100000002", "100000001"],
+        "date": ["2022-01-01", "2020-01-01"],
+    })
+    history = ProcessedDataset.from_dataframe(history_data, dataset_type="primary_care", coding_system=CodelistType.SNOMED.value)
+    delta = ProcessedDataset.from_dataframe(delta_data, dataset_type="primary_care", coding_system=CodelistType.SNOMED.value, path="delta.csv")
+    appended_dataset = history.append_delta(delta)
+
+    expected_data = pl.concat([history_data, delta_data]).unique().sort(["nhs_number", "code", "date"])
+    assert appended_dataset.data.frame_equal(expected_data)
+    assert any("Dataset was not sorted by nhs_number, code and date, so it was sorted" in line for line in appended_dataset.log)
+    assert any("Dataset had 1 duplicate rows, which were removed" in line for line in appended_dataset.log)
+    assert any("Appended 1 new rows. Dataset has 5 rows, sorted by nhs_number, code and date" in line for line in appended_dataset.log)
+
+
+def test_append_delta_different_coding_system():
+    with pytest.raises(DeduplicationError) as e:
+        dataset = ProcessedDataset(path="tests/test_data/primary_care/processed_data.csv", dataset_type="primary_care", coding_system=CodelistType.SNOMED.value)
+        delta = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="primary_care", coding_system=CodelistType.ICD10.value)
+        dataset.append_delta(delta)
+
+    assert "Coding system must be the same for both datasets" in str(e.value)
+
+
+def test_lazy_dataset_transforms():
+    dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system=CodelistType.ICD10.value)
+    lazy_dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system=CodelistType.ICD10.value, lazy=True)
+
+    # the lazy data is read in full by the transforms, which give the same data as for an eager dataset
+    assert lazy_dataset.deduplicate().data.frame_equal(dataset.deduplicate().data)
+    assert lazy_dataset.truncate_icd_to_3_digits().data.frame_equal(dataset.truncate_icd_to_3_digits().data)
+    assert lazy_dataset.remove_unrealistic_dates(before_born=False).data.frame_equal(dataset.remove_unrealistic_dates(before_born=False).data)
+    assert lazy_dataset.append_delta(dataset).data.frame_equal(dataset.append_delta(dataset).data)
+    assert any("Pre-deduplication dataset has 10 rows" in line for line in lazy_dataset.deduplicate().log)
+
+    lazy_dataset.merge_with_datasets([ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system=CodelistType.ICD10.value, lazy=True)])
+    assert lazy_dataset.data.shape == (20, 4)
+
+
+def test_write_to_partitions():
+    dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system=CodelistType.ICD10.value)
+    dataset.write_to_partitions("tests/test_data/barts_health/partitioned")
+    assert "in 3 partition(s) by the first 1 character(s) of the code" in dataset.log[-1]
+    assert sorted(os.listdir("tests/test_data/barts_health/partitioned")) == ["_partitioning.json", "code_prefix=A", "code_prefix=B", "code_prefix=C", "empty.parquet"]
+
+    # the partitions can be read back in full, or scanned lazily
+    loaded_dataset = ProcessedDataset(path="tests/test_data/barts_health/partitioned", dataset_type="secondary_care", coding_system=CodelistType.ICD10.value)
+    assert loaded_dataset.data.sort(["code", "nhs_number"]).frame_equal(dataset.data.sort(["code", "nhs_number"]))
+    assert "Loaded data from 3 partition(s) in tests/test_data/barts_health/partitioned" in loaded_dataset.log[0]
+
+    lazy_dataset = ProcessedDataset(path="tests/test_data/barts_health/partitioned", dataset_type="secondary_care", coding_system=CodelistType.ICD10.value, lazy=True)
+    assert lazy_dataset._count_rows() == 10
+    assert lazy_dataset._scan_codes(["B01", "B02"]).collect()["code"].to_list() == ["B01", "B01", "B01X", "B02"]
+    assert lazy_dataset._scan_codes(["D01"]).collect().columns == ["nhs_number", "code", "term", "date"]
+
+    # writing again with a different prefix length replaces the partitions
+    dataset.write_to_partitions("tests/test_data/barts_health/partitioned", prefix_length=3)
+    assert "in 4 partition(s) by the first 3 character(s) of the code" in dataset.log[-1]
+
+    shutil.rmtree("tests/test_data/barts_health/partitioned")
+
+
+def test_write_to_partitions_over_other_directory():
+    with pytest.raises(WriteOptionsInvalid) as e:
+        dataset = ProcessedDataset(path="tests/test_data/barts_health/diagnosis.csv", dataset_type="secondary_care", coding_system=CodelistType.ICD10.value)
+        dataset.write_to_partitions("tests/test_data/barts_health")
+
+    assert "Cannot write partitions to tests/test_data/barts_health as it exists and is not a partitioned dataset" in str(e.value)
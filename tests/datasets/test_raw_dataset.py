@@ -1,9 +1,12 @@
 import pytest
 import datetime
+import gzip
+import os
+import shutil
 import polars as pl
 
 from tretools.datasets.raw_dataset import RawDataset
-from tretools.datasets.errors import ColumnsValidationError, DeduplicationError
+from tretools.datasets.errors import ColumnsValidationError, DatasetPathNotCorrect, DeduplicationError, WriteOptionsInvalid
 from tretools.datasets.dataset_enums.dataset_types import DatasetType
 
 
@@ -200,6 +203,7 @@ def test_processed_log():
     assert "Unneeded 2 column(s) dropped" in ingested_data.log[3]
     assert "Dropped 6 rows with empty values or empty date strings" in ingested_data.log[4]
     assert "Date format standarised" in ingested_data.log[5]
+    assert "Date formats found: '%F %T' (3 row(s)), '%d/%m/%Y' (3 row(s))" in ingested_data.log[6]
 
 
 def test_with_barts_health_tab():
@@ -320,3 +324,223 @@ def test_accepts_scientific_notation_values():
     observed_dataset.data = observed_dataset.data.sort('original_code', descending=True)
     assert observed_dataset.data["original_code"][0] == 882784691000119040
 
+
+
+def test_process_dataset_lazy_matches_eager():
+    column_maps = {"original_code": "code", "clinical_effective_date": "date", "pseudo_nhs_number": "nhs_number"}
+    eager_data = RawDataset(path="tests/test_data/primary_care/procedures_many_diffs.csv", dataset_type="primary_care", coding_system="SNOMED")
+    lazy_data = RawDataset(path="tests/test_data/primary_care/procedures_many_diffs.csv", dataset_type="primary_care", coding_system="SNOMED", lazy=True)
+
+    # the lazy dataset has only been scanned, not read
+    assert isinstance(lazy_data.data, pl.LazyFrame)
+    assert "Scanned data lazily from tests/test_data/primary_care/procedures_many_diffs.csv" in lazy_data.log[0]
+
+    eager_processed = eager_data.process_dataset(deduplication_options=["nhs_number", "code", "date"], column_maps=column_maps)
+    lazy_processed = lazy_data.process_dataset(deduplication_options=["nhs_number", "code", "date"], column_maps=column_maps)
+
+    # the lazy query is collected into the same data as the eager processing
+    assert isinstance(lazy_processed.data, pl.DataFrame)
+    assert lazy_processed.data.sort(["nhs_number", "code", "date"]).frame_equal(eager_processed.data.sort(["nhs_number", "code", "date"]))
+
+    # and the logs after loading report the same row counts. The lazy counts are only known, and logged,
+    # once the query is collected, as the file is only read once.
+    eager_messages = [log.split(": ", 1)[1] for log in eager_processed.log[1:]]
+    lazy_messages = [log.split(": ", 1)[1] for log in lazy_processed.log[1:]]
+    assert sorted(lazy_messages) == sorted(eager_messages)
+    assert "Dropped 6 rows with empty values or empty date strings" in lazy_messages[-3]
+
+
+def test_process_dataset_lazy_with_nhs_digital():
+    raw_data = RawDataset(path="tests/test_data/nhs_digital/apc.txt", dataset_type="nhs_digital", coding_system="ICD10", lazy=True)
+    processed_data = raw_data.process_dataset(deduplication_options=["nhs_number", "code", "date"], nhs_digital_subtype="APC")
+
+    assert processed_data.data["date"].dtype == pl.Date
+    assert processed_data.data.shape == (6, 3)
+    assert any("Data shape before expanding wide columns into rows: (3, 220)" in line for line in raw_data.log)
+    assert any("Data shape after expanding wide columns into rows: (6, 3)" in line for line in raw_data.log)
+
+
+def test_process_dataset_in_batches():
+    column_maps = {"original_code": "code", "clinical_effective_date": "date", "pseudo_nhs_number": "nhs_number"}
+    output_path = "tests/test_data/primary_care/test_batches.arrow"
+
+    # a tiny memory limit forces the file to be read in many small batches and spilled to several partitions
+    raw_data = RawDataset(path="tests/test_data/primary_care/procedures_many_diffs.csv", dataset_type="primary_care", coding_system="SNOMED", lazy=True)
+    raw_data.process_dataset_in_batches(output_path, deduplication_options=["nhs_number", "code", "date"], column_maps=column_maps, memory_limit_mb=0.001)
+    assert "Processing data in batches of 2 rows" in raw_data.log[1]
+    assert "with 27 rows read and 21 rows kept after standarising the data" in raw_data.log[2]
+
+    # duplicates are removed across batches, so the output matches the in-memory processing
+    expected = RawDataset(path="tests/test_data/primary_care/procedures_many_diffs.csv", dataset_type="primary_care", coding_system="SNOMED")
+    expected = expected.process_dataset(deduplication_options=["nhs_number", "code", "date"], column_maps=column_maps)
+    observed = pl.read_ipc(output_path)
+    assert observed.shape == (7, 3)
+    assert observed.sort(["nhs_number", "code", "date"]).frame_equal(expected.data.sort(["nhs_number", "code", "date"]))
+
+    os.remove(output_path)
+
+
+def test_process_dataset_in_batches_with_wrong_output_type():
+    raw_data = RawDataset(path="tests/test_data/primary_care/procedures_many_diffs.csv", dataset_type="primary_care", coding_system="SNOMED", lazy=True)
+
+    with pytest.raises(WriteOptionsInvalid) as e:
+        raw_data.process_dataset_in_batches("tests/test_data/primary_care/test_batches.csv", deduplication_options=["nhs_number", "code", "date"])
+
+    assert "Output path for batch processing must be either .arrow or .parquet" in str(e.value)
+
+
+def test_nhs_digital_only_reads_config_columns():
+    raw_data = RawDataset(path="tests/test_data/nhs_digital/apc.txt", dataset_type="nhs_digital", coding_system="ICD10",
+                          nhs_digital_subtype="APC")
+
+    # The APC config needs the patient id, the admission date and the 20 diagnosis columns
+    assert raw_data.data.shape[1] == 22
+    assert "BIRESUS_1" not in raw_data.data.columns
+    assert "Only the 22 columns in the APC config were read" in raw_data.log[1]
+
+    # The subtype given on load is used when processing
+    processed_data = raw_data.process_dataset(deduplication_options=["nhs_number", "code", "date"])
+    full_data = RawDataset(path="tests/test_data/nhs_digital/apc.txt", dataset_type="nhs_digital", coding_system="ICD10")
+    expected = full_data.process_dataset(deduplication_options=["nhs_number", "code", "date"], nhs_digital_subtype="APC")
+    assert processed_data.data.sort(["nhs_number", "code"]).frame_equal(expected.data.sort(["nhs_number", "code"]))
+
+
+def test_nhs_digital_only_reads_config_columns_lazy():
+    raw_data = RawDataset(path="tests/test_data/nhs_digital/civreg.txt", dataset_type="nhs_digital", coding_system="ICD10",
+                          nhs_digital_subtype="CIV_REG", lazy=True)
+    assert len(raw_data.data.columns) == 18
+
+    processed_data = raw_data.process_dataset(deduplication_options=["nhs_number", "code", "date"])
+    assert processed_data.data.columns == ["nhs_number", "code", "date"]
+
+
+def test_raw_dataset_from_shards():
+    shards = ["tests/test_data/primary_care/good_procedures_with_multiples.csv", "tests/test_data/primary_care/procedures_with_mixed_dates.csv"]
+    observed_dataset = RawDataset(path=shards, dataset_type="primary_care", coding_system="SNOMED", max_workers=2)
+
+    # the shards are read separately, then combined into one dataset
+    assert observed_dataset.data.shape == (36, 4)
+    assert "Loaded data from tests/test_data/primary_care/good_procedures_with_multiples.csv using separator ','" in observed_dataset.log[0]
+    assert "Shard tests/test_data/primary_care/good_procedures_with_multiples.csv has 27 rows" in observed_dataset.log[1]
+    assert "Shard tests/test_data/primary_care/procedures_with_mixed_dates.csv has 9 rows" in observed_dataset.log[3]
+    assert "Combined 2 shards into one dataset with 36 rows" in observed_dataset.log[4]
+
+    processed_dataset = observed_dataset.process_dataset(deduplication_options=["nhs_number", "code", "date"], column_maps={"original_code": "code", "clinical_effective_date": "date", "pseudo_nhs_number": "nhs_number"})
+    assert processed_dataset.data.columns == ["nhs_number", "code", "date"]
+
+
+def test_raw_dataset_shards_are_pre_processed_separately():
+    shards = ["tests/test_data/primary_care/good_procedures_with_multiples.csv", "tests/test_data/primary_care/procedures_with_mixed_dates.csv"]
+    column_maps = {"original_code": "code", "clinical_effective_date": "date", "pseudo_nhs_number": "nhs_number"}
+    observed_dataset = RawDataset(path=shards, dataset_type="primary_care", coding_system="SNOMED", max_workers=2)
+    processed_dataset = observed_dataset.process_dataset(deduplication_options=["nhs_number", "code", "date"], column_maps=column_maps)
+
+    # each shard is renamed, has its null rows dropped and its dates parsed on its own
+    assert sum("Date format standarised" in line for line in processed_dataset.log) == 2
+    assert "Pre-processed 2 shards at the same time, and combined them into one dataset with 36 rows" in "".join(processed_dataset.log)
+    assert [step.step for step in processed_dataset.steps].count("RawDataset._standarise_date_format") == 2
+
+    # which gives the same data as processing the shards once they are combined
+    combined_data = pl.concat([RawDataset(path=shard, dataset_type="primary_care", coding_system="SNOMED").data for shard in shards], how="vertical_relaxed")
+    combined_dataset = RawDataset.from_dataframe(combined_data, dataset_type="primary_care", coding_system="SNOMED")
+    expected_dataset = combined_dataset.process_dataset(deduplication_options=["nhs_number", "code", "date"], column_maps=column_maps)
+    assert processed_dataset.data.sort(["nhs_number", "code", "date"]).frame_equal(expected_dataset.data.sort(["nhs_number", "code", "date"]))
+
+
+def test_raw_dataset_from_glob():
+    os.makedirs("tests/test_data/shards", exist_ok=True)
+    raw_data = pl.read_csv("tests/test_data/primary_care/good_procedures_with_multiples.csv")
+    raw_data.head(20).write_csv("tests/test_data/shards/gp_2023_01.csv")
+    raw_data.tail(7).write_csv("tests/test_data/shards/gp_2023_02.csv")
+
+    observed_dataset = RawDataset(path="tests/test_data/shards/gp_*.csv", dataset_type="primary_care", coding_system="SNOMED")
+    assert observed_dataset.data.shape == (27, 4)
+    assert "Combined 2 shards into one dataset with 27 rows" in observed_dataset.log[-1]
+
+    lazy_dataset = RawDataset(path="tests/test_data/shards/gp_*.csv", dataset_type="primary_care", coding_system="SNOMED", lazy=True)
+    assert lazy_dataset._count_rows() == 27
+    assert "Shard tests/test_data/shards/gp_2023_02.csv has 7 rows" in "".join(lazy_dataset.log)
+
+    os.remove("tests/test_data/shards/gp_2023_01.csv")
+    os.remove("tests/test_data/shards/gp_2023_02.csv")
+    os.rmdir("tests/test_data/shards")
+
+
+def test_raw_dataset_from_glob_with_no_files():
+    with pytest.raises(DatasetPathNotCorrect) as e:
+        RawDataset(path="tests/test_data/primary_care/no_such_shards_*.csv", dataset_type="primary_care", coding_system="SNOMED")
+
+    assert "No files found for Dataset: tests/test_data/primary_care/no_such_shards_*.csv" in str(e.value)
+
+
+def test_raw_dataset_from_gzip_file():
+    with open("tests/test_data/barts_health/diagnosis.tab", "rb") as f_in, gzip.open("tests/test_data/barts_health/diagnosis.tab.gz", "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+
+    # the separator is sniffed from the decompressed file, and the data matches the uncompressed file
+    expected = RawDataset(path="tests/test_data/barts_health/diagnosis.tab", dataset_type="barts_health", coding_system="ICD10")
+    observed = RawDataset(path="tests/test_data/barts_health/diagnosis.tab.gz", dataset_type="barts_health", coding_system="ICD10")
+    assert "using separator '\t'" in observed.log[0]
+    assert observed.data.frame_equal(expected.data)
+
+    # compressed files cannot be scanned, so they are read when lazy
+    lazy_dataset = RawDataset(path="tests/test_data/barts_health/diagnosis.tab.gz", dataset_type="barts_health", coding_system="ICD10", lazy=True)
+    assert "diagnosis.tab.gz is compressed so it cannot be scanned lazily, and was read instead" in lazy_dataset.log[-1]
+    assert lazy_dataset.data.collect().frame_equal(expected.data)
+
+    os.remove("tests/test_data/barts_health/diagnosis.tab.gz")
+
+
+def test_process_dataset_in_batches_from_gzip_file():
+    column_maps = {"original_code": "code", "clinical_effective_date": "date", "pseudo_nhs_number": "nhs_number"}
+    output_path = "tests/test_data/primary_care/test_batches_gzip.arrow"
+    with open("tests/test_data/primary_care/procedures_many_diffs.csv", "rb") as f_in, gzip.open("tests/test_data/primary_care/procedures_many_diffs.csv.gz", "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+
+    # the file is decompressed a batch of lines at a time
+    raw_data = RawDataset(path="tests/test_data/primary_care/procedures_many_diffs.csv.gz", dataset_type="primary_care", coding_system="SNOMED", lazy=True)
+    raw_data.process_dataset_in_batches(output_path, deduplication_options=["nhs_number", "code", "date"], column_maps=column_maps, memory_limit_mb=0.001)
+    assert "with 27 rows read and 21 rows kept after standarising the data" in raw_data.log[-3]
+
+    expected = RawDataset(path="tests/test_data/primary_care/procedures_many_diffs.csv", dataset_type="primary_care", coding_system="SNOMED")
+    expected = expected.process_dataset(deduplication_options=["nhs_number", "code", "date"], column_maps=column_maps)
+    observed = pl.read_ipc(output_path)
+    assert observed.sort(["nhs_number", "code", "date"]).frame_equal(expected.data.sort(["nhs_number", "code", "date"]))
+
+    os.remove(output_path)
+    os.remove("tests/test_data/primary_care/procedures_many_diffs.csv.gz")
+
+
+def test_batches_from_gzip_file_keep_quoted_line_breaks():
+    path = "tests/test_data/primary_care/procedures_multiline_terms.csv.gz"
+    # the terms hold line breaks and escaped quotes inside quoted values
+    lines = ["pseudo_nhs_number,clinical_effective_date,original_code,original_term"]
+    for i in range(7):
+        lines.append(f'A{i},2020-01-0{i + 1},10000000{i},"Disease {i}\nwith ""two""\nlines"')
+    with gzip.open(path, "wb") as f:
+        f.write(("\n".join(lines) + "\n").encode())
+
+    expected = RawDataset(path=path, dataset_type="primary_care", coding_system="SNOMED")
+    lazy_dataset = RawDataset(path=path, dataset_type="primary_care", coding_system="SNOMED", lazy=True)
+    # each batch of 2 lines ends inside a quoted value, so it is carried on to the end of the value
+    batches = list(lazy_dataset._iter_batches(2))
+    assert [batch.shape[0] for batch in batches] == [1, 1, 1, 1, 1, 1, 1]
+    observed = pl.concat(batches)
+    assert observed.frame_equal(expected.data)
+    assert observed["original_term"][0] == 'Disease 0\nwith "two"\nlines'
+
+    os.remove(path)
+
+
+def test_raw_dataset_from_zstd_file():
+    zstandard = pytest.importorskip("zstandard")
+    with open("tests/test_data/primary_care/procedures_many_diffs.csv", "rb") as f:
+        compressed = zstandard.ZstdCompressor().compress(f.read())
+    with open("tests/test_data/primary_care/procedures_many_diffs.csv.zst", "wb") as f:
+        f.write(compressed)
+
+    expected = RawDataset(path="tests/test_data/primary_care/procedures_many_diffs.csv", dataset_type="primary_care", coding_system="SNOMED")
+    observed = RawDataset(path="tests/test_data/primary_care/procedures_many_diffs.csv.zst", dataset_type="primary_care", coding_system="SNOMED")
+    assert observed.data.frame_equal(expected.data)
+
+    os.remove("tests/test_data/primary_care/procedures_many_diffs.csv.zst")
@@ -56,6 +56,10 @@ def test_add_count():
     assert nhs_number_dict['84950DE0614A5C241F7223FBCCD27BE87DB61915972C7E49EDF519B72A3A104A']['code'] == 100000001
     assert nhs_number_dict['84950DE0614A5C241F7223FBCCD27BE87DB61915972C7E49EDF519B72A3A104A']['date'] == "2018-10-05"
 
+    # the log of the count ends with the step that made it
+    assert report.logs[0].startswith("Codelist test_count_primary_care added to report Disease A")
+    assert "Step EventCounter.count_events took" in report.logs[1][-1]
+
 
 def test_add_count_already_exists():
     with pytest.raises(ReportAlreadyExists) as e:
@@ -166,6 +170,51 @@ def test_report_overlaps_insufficient_counts():
     assert "Only 1 count has been run so comparison between datasets is not possible" in str(e.value)
 
 
+def test_add_counts():
+    primary_care = ProcessedDataset(PRIMARY_CARE_DATASET, "primary_care", "SNOMED")
+    codelists = {
+        "disease_a": Codelist(SNOMED_CODELIST, "SNOMED"),
+        "disease_b": Codelist.from_data([{"code": "200000001", "term": "Disease B - 1"}], "SNOMED"),
+    }
+
+    demographic_data = DemographicDataset(path_to_mapping_file=DEMOGRAPHIC_MAPPING_FILE, path_to_demographic_file=DEMOGRAPHIC_FILE)
+    demographic_data.process_dataset(MAPPING_CONFIG)
+
+    report = PhenotypeReport("Disease A and B")
+    report.add_counts(codelists, primary_care, demographics=demographic_data)
+
+    # the counts are the same as adding each one on its own
+    single_report = PhenotypeReport("Disease A")
+    single_report.add_count("disease_a", codelists["disease_a"], primary_care, demographics=demographic_data)
+    assert report.counts["disease_a"]["patient_count"] == 2
+    assert report.counts["disease_a"]["event_count"] == 4
+    assert report.counts["disease_a"]["nhs_numbers"].sort("nhs_number").frame_equal(single_report.counts["disease_a"]["nhs_numbers"].sort("nhs_number"))
+    assert report.counts["disease_b"]["event_count"] == 3
+    assert list(report.counts.keys()) == ["disease_a", "disease_b"]
+    assert "Codelists disease_a, disease_b added to report Disease A and B" in report.logs[0]
+
+    with pytest.raises(ReportAlreadyExists) as e:
+        report.add_counts({"disease_b": codelists["disease_b"]}, primary_care)
+    assert "Report disease_b already exists in this report." in str(e.value)
+
+
+def test_add_count_with_prefix_match_shares_code_index():
+    secondary_care = ProcessedDataset(SECONDARY_CARE_DATASET, "secondary_care", "ICD10")
+    report = PhenotypeReport("Disease A")
+    report.add_count("disease_a", Codelist(ICD_CODELIST, "ICD10"), secondary_care, prefix_match=True)
+    report.add_count("disease_b", Codelist.from_data([{"code": "B01", "term": "Disease B - 1"}], "ICD10"), secondary_care, prefix_match=True)
+
+    # the index of the codes in the dataset is built for the first count and kept on the dataset for the second
+    assert any("Built an index of the" in line for line in report.counts["disease_a"]["log"])
+    assert not any("Built an index of the" in line for line in report.counts["disease_b"]["log"])
+    assert report.counts["disease_b"]["matched_codes"] == ["B01", "B01X"]
+
+    # a new index is built if the data of the dataset is replaced
+    secondary_care.merge_with_dataset(ProcessedDataset(SECONDARY_CARE_DATASET, "secondary_care", "ICD10"))
+    report.add_count("disease_b_merged", Codelist.from_data([{"code": "B01", "term": "Disease B - 1"}], "ICD10"), secondary_care, prefix_match=True)
+    assert any("Built an index of the" in line for line in report.counts["disease_b_merged"]["log"])
+
+
 def test_report_with_demographics():
     # snomed code and primary care
     snomed_codelist = Codelist(SNOMED_CODELIST, "SNOMED")
@@ -0,0 +1,125 @@
+import os
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from tretools.datasets.raw_dataset import RawDataset
+from tretools.utility.step_log import StepRecord, steps_to_dataframe, timed_step
+
+
+COLUMN_MAPS = {"original_code": "code", "clinical_effective_date": "date", "pseudo_nhs_number": "nhs_number"}
+
+
+def test_steps_are_recorded_for_processing():
+    raw_data = RawDataset(path="tests/test_data/primary_care/good_procedures_with_multiples.csv", dataset_type="primary_care", coding_system="SNOMED")
+    processed_data = raw_data.process_dataset(deduplication_options=["nhs_number", "code", "date"], column_maps=COLUMN_MAPS)
+    deduplicated_data = processed_data.deduplicate()
+
+    # the processed dataset carries on the steps of the raw dataset, as it does the log
+    steps = [step.step for step in deduplicated_data.steps]
+    assert steps[0] == "RawDataset._load_data"
+    assert "RawDataset._standarise_date_format" in steps
+    assert steps[-2:] == ["RawDataset.process_dataset", "ProcessedDataset.deduplicate"]
+
+    # the row counts going in and out of each step are recorded
+    process_step = deduplicated_data.steps[-2]
+    assert process_step.rows_in == 27
+    assert process_step.rows_out == 9
+    assert process_step.duration_seconds >= 0
+
+    # the free-text log is unchanged
+    assert not any("Step " in line for line in deduplicated_data.log)
+
+
+def test_steps_to_dataframe():
+    steps = [
+        StepRecord(step="RawDataset._load_data", start=datetime(2024, 1, 1, 12, 0, 0), end=datetime(2024, 1, 1, 12, 0, 2),
+                   rows_out=100),
+        StepRecord(step="RawDataset._deduplicate", start=datetime(2024, 1, 1, 12, 0, 2), end=datetime(2024, 1, 1, 12, 0, 3),
+                   rows_in=100, rows_out=90, rss_delta_bytes=1024 * 1024),
+    ]
+    observed = steps_to_dataframe(steps)
+
+    assert observed.shape == (2, 8)
+    assert observed["duration_seconds"].to_list() == [2.0, 1.0]
+    assert observed["rows_in"].to_list() == [None, 100]
+
+    assert steps_to_dataframe([]).shape == (0, 8)
+
+
+def test_step_record_to_log_line():
+    step = StepRecord(step="RawDataset._deduplicate", start=datetime(2024, 1, 1, 12, 0, 2), end=datetime(2024, 1, 1, 12, 0, 3),
+                      rows_in=100, rows_out=90, rss_delta_bytes=1024 * 1024)
+
+    assert step.to_log_line() == "2024-01-01 12:00:03: Step RawDataset._deduplicate took 1.000s, 100 rows in and 90 rows out, memory changed by +1.0 MB"
+
+
+
+def test_steps_are_written_with_the_log():
+    raw_data = RawDataset(path="tests/test_data/primary_care/good_procedures_with_multiples.csv", dataset_type="primary_care", coding_system="SNOMED")
+    raw_data.write_to_log("tests/test_data/primary_care/steps.log", include_steps=True)
+
+    with open("tests/test_data/primary_care/steps.log") as f:
+        lines = f.read().splitlines()
+    os.remove("tests/test_data/primary_care/steps.log")
+
+    # the free-text log comes first, then a line for each step
+    assert lines[:len(raw_data.log)] == raw_data.log
+    assert lines[len(raw_data.log):] == [step.to_log_line() for step in raw_data.steps]
+    assert "Step RawDataset._load_data took" in lines[len(raw_data.log)]
+
+
+class Pipeline:
+    def __init__(self):
+        self.steps = []
+
+    @timed_step
+    def allocate(self, megabytes):
+        # bytearray fills the memory with zeros, so all of it is resident
+        bytearray(megabytes * 1024 * 1024)
+
+    @timed_step
+    def allocate_twice(self, megabytes):
+        self.allocate(megabytes)
+        self.allocate(1)
+
+    @timed_step
+    def allocate_in_pool(self, pipelines, megabytes):
+        with ThreadPoolExecutor(max_workers=len(pipelines)) as executor:
+            list(executor.map(lambda pipeline: pipeline.allocate_twice(megabytes), pipelines))
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="The peak memory can only be reset on Linux")
+def test_peak_memory_is_recorded_per_step():
+    pipeline = Pipeline()
+    pipeline.allocate(100)
+    pipeline.allocate(1)
+    pipeline.allocate_twice(100)
+
+    big_step, small_step, inner_big_step, inner_small_step, outer_step = pipeline.steps
+
+    # the peak of a step is not the peak of the steps before it
+    assert big_step.peak_rss_bytes - small_step.peak_rss_bytes > 50 * 1024 * 1024
+    assert inner_big_step.peak_rss_bytes - inner_small_step.peak_rss_bytes > 50 * 1024 * 1024
+
+    # a step keeps the peak of the steps it runs
+    assert outer_step.step == "Pipeline.allocate_twice"
+    assert outer_step.peak_rss_bytes >= inner_big_step.peak_rss_bytes
+
+
+def test_steps_run_in_a_pool_of_threads():
+    pipeline = Pipeline()
+    pipelines = [Pipeline() for _ in range(8)]
+    pipeline.allocate_in_pool(pipelines, 10)
+
+    # every step in the pool is recorded, without memory, as it is shared by the steps running at the same time
+    for worker_pipeline in pipelines:
+        assert [step.step for step in worker_pipeline.steps] == ["Pipeline.allocate", "Pipeline.allocate", "Pipeline.allocate_twice"]
+        assert all(step.peak_rss_bytes is None and step.rss_delta_bytes is None for step in worker_pipeline.steps)
+
+    # the step on the main thread that runs the pool still measures the memory of the process
+    pool_step, = pipeline.steps
+    assert pool_step.step == "Pipeline.allocate_in_pool"
+    if os.path.exists("/proc/self/clear_refs"):
+        assert pool_step.peak_rss_bytes is not None
@@ -2,14 +2,38 @@
 This file contains the codelist class.
 """
 from __future__ import annotations
-import csv
 import os
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Union
 import re
-import tempfile
+
+import polars as pl
 
 from tretools.codelists.codelist_types import CodelistType
 from tretools.codelists.errors import InvalidSNOMEDCodeError, RepeatedCodeError, InvalidDataShapeError, InvalidICD10CodeError, InvalidOPCSCodesError, InvalidProcessingRequest
+from tretools.codelists.mapping import SnomedToIcd10Mapping
+from tretools.codelists.snomed_hierarchy import SnomedHierarchy
+
+# The forms of valid codes. The patterns are compiled once, and are also used by polars to check
+# all the codes in a codelist at once.
+SNOMED_MIN_LENGTH = 6
+SNOMED_MAX_LENGTH = 18
+ICD10_PATTERN = r"^[A-Z]\d{2}(X|(\.\d{1,3})?|\d{1,4})?$"
+ICD10_MAX_LENGTH = 7
+OPCS_PATTERN = r"^[A-Z]\d{2}(\.\d{1,2}|\d{1,2})?$"
+OPCS_MAX_LENGTH = 5
+
+ICD10_REGEX = re.compile(ICD10_PATTERN)
+OPCS_REGEX = re.compile(OPCS_PATTERN)
+
+# ICD-10 codes that have an X code added when add_x_codes is True, e.g. A01 gets A01X
+ICD10_3_CHARACTER_PATTERN = r"^[A-Z]\d{2}$"
+
+# The error raised for invalid codes of each codelist type
+INVALID_CODE_ERRORS = {
+    "SNOMED": InvalidSNOMEDCodeError,
+    "ICD10": InvalidICD10CodeError,
+    "OPCS": InvalidOPCSCodesError,
+}
 
 class Codelist:
     def __init__(self, path: str,
@@ -33,85 +57,171 @@ class Codelist:
         else:
             self.data = self._load_codelist(path)
 
+    @classmethod
+    def from_data(cls, data: Union[pl.DataFrame, List[Dict[str, str]]],
+                  codelist_type: CodelistType,
+                  code_column: str = "code",
+                  term_column: str = "term",
+                  add_x_codes: bool = False,
+                  icd10_3_digit_only: bool = False,
+                  path: Optional[str] = None) -> Codelist:
+        """
+        Creates a codelist from codes that are already in memory, such as a codelist made from another
+        codelist. The codes are validated in the same way as a codelist loaded from a file.
+
+        Args:
+            data (pl.DataFrame | List[Dict[str, str]]): The codelist, with a code column and a term column.
+            codelist_type (CodelistType): The codelist type.
+            code_column (str, optional): The code column. Defaults to "code".
+            term_column (str, optional): The term column. Defaults to "term".
+            add_x_codes (bool, optional): If True, X codes are added for ICD10 codes. Defaults to False.
+            icd10_3_digit_only (bool, optional): If True, ICD10 codes are truncated to 3 digits. Defaults to False.
+            path (str, optional): The path of the file the codes originally came from. Defaults to None.
+
+        Returns:
+            Codelist: The codelist.
+        """
+        # Bypass __init__ as that loads the codelist from the path
+        codelist = cls.__new__(cls)
+        codelist.codelist_type = codelist_type
+        codelist.code_column = code_column
+        codelist.term_column = term_column
+        codelist.codes = set()
+        codelist.path = path
+
+        if isinstance(data, list):
+            data = pl.DataFrame(data, schema={code_column: pl.Utf8, term_column: pl.Utf8})
+        if codelist_type != "ICD10":
+            add_x_codes, icd10_3_digit_only = False, False
+        codelist.data = codelist._build_codelist(data, add_x_codes=add_x_codes, icd10_3_digit_only=icd10_3_digit_only)
+        return codelist
 
     def _load_codelist(self, path, add_x_codes: bool = False, icd10_3_digit_only: bool = False) -> List[Dict[str, str]]:
         """
-        Loads the codelist from the path.
+        Loads the codelist from the path. The file is read once with polars, and all the codes are
+        validated together.
 
         Args:
             path (str): The path to the codelist.
 
         Returns:
             list: The codelist as a list of dictionaries.
+
+        Raises:
+            InvalidDataShapeError: If the codelist does not have 2 columns.
+            InvalidSNOMEDCodeError, InvalidICD10CodeError, InvalidOPCSCodesError: If any codes are invalid.
+                Every invalid code is listed in the error.
+            RepeatedCodeError: If any codes are repeated. Every repeated code is listed in the error.
         """
         if not self._check_path(path):
             raise FileNotFoundError(f"Could not find codelist at {path}")
 
+        if os.path.getsize(path) == 0:
+            return []
+
+        # Every column is read as a string
+        data = pl.read_csv(path, infer_schema_length=0)
+        return self._build_codelist(data, add_x_codes=add_x_codes, icd10_3_digit_only=icd10_3_digit_only)
+
+    def _build_codelist(self, data: pl.DataFrame, add_x_codes: bool = False, icd10_3_digit_only: bool = False) -> List[Dict[str, str]]:
+        """
+        Validates the codelist and adds X codes or truncates ICD10 codes if asked to.
+
+        Args:
+            data (pl.DataFrame): The codelist, with every column as a string.
+
+        Returns:
+            list: The codelist as a list of dictionaries.
+
+        Raises:
+            InvalidProcessingRequest: If asked to both add X codes and truncate ICD10 codes.
+            InvalidDataShapeError: If the codelist does not have 2 columns.
+            InvalidSNOMEDCodeError, InvalidICD10CodeError, InvalidOPCSCodesError: If any codes are invalid.
+            RepeatedCodeError: If any codes are repeated.
+        """
         if add_x_codes and icd10_3_digit_only:
             raise InvalidProcessingRequest("Cannot add X codes and truncate ICD10 codes to 3 digits at the same time.")
 
-        data = []
-        with open(path, "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                
-                # Check for correct data shape
-                if len(row) != 2:
-                    raise InvalidDataShapeError(f"Invalid data shape. Expected 2 columns, but got {len(row)} columns.")
-
-                # Validate the codelist. Raises errors if invalid.
-                self._validate_codelist(row)
-
-                # Truncating ICD10 codes to contain the first 3 digits only if icd10_3_digit_only is True
-                if icd10_3_digit_only:
-                    row = self._icd10_3_digit_only(row)
-
-                # Add the row to the data
-                data.append(row)
-
-                # Add the X codes for ICD-10 codes that do not have an X code
-                if add_x_codes and self.codelist_type == "ICD10":
-                    new_row = self._add_X_codes_for_ICD(row)
-                    if new_row is not None:
-                        data.append(new_row)
-                        self.codes.add(new_row[self.code_column])
-        
-        return data
+        # Empty values are kept as empty strings
+        data = data.with_columns(pl.all().fill_null(""))
+        if data.is_empty():
+            return []
+
+        # Check for correct data shape
+        if data.shape[1] != 2:
+            raise InvalidDataShapeError(f"Invalid data shape. Expected 2 columns, but got {data.shape[1]} columns.")
 
-    def _validate_codelist(self, row: Dict[str, str]):
+        # Validate the codelist. Raises errors if invalid.
+        self._validate_codelist(data)
+
+        # Truncating ICD10 codes to contain the first 3 digits only if icd10_3_digit_only is True
+        if icd10_3_digit_only:
+            data = data.with_columns(self._icd10_3_digit_only())
+
+        # Add the X codes for ICD-10 codes that do not have an X code, each straight after its code
+        if add_x_codes and self.codelist_type == "ICD10":
+            data = data.with_row_count("row").with_columns(pl.lit(False).alias("is_x_code"))
+            x_codes = self._add_X_codes_for_ICD(data).with_columns(pl.lit(True).alias("is_x_code"))
+            self.codes.update(x_codes[self.code_column].to_list())
+            data = pl.concat([data, x_codes]).sort(["row", "is_x_code"]).drop(["row", "is_x_code"])
+
+        return data.to_dicts()
+
+    def _validate_codelist(self, data: pl.DataFrame) -> None:
         """
-        Validates the codelist.
+        Validates the codelist. All the codes are checked at once, and the error lists every code that
+        fails the check.
 
         Args:
-            row (Dict[str, str]): A dictionary containing the data for the current row.
+            data (pl.DataFrame): The codelist, with every column as a string.
 
         Raises:
-            InvalidSNOMEDCodeError: If the SNOMED code is invalid.
-            RepeatedCodeError: If a code is repeated.
-            RepeatedTermError: If a term is repeated.
+            InvalidSNOMEDCodeError: If any SNOMED codes are invalid.
+            InvalidICD10CodeError: If any ICD-10 codes are invalid.
+            InvalidOPCSCodesError: If any OPCS codes are invalid.
+            RepeatedCodeError: If any codes are repeated.
+            ValueError: If the codelist type is not supported.
         """
-        code = row.get(self.code_column, "")
-        term = row.get(self.term_column, "")
+        if self.codelist_type not in INVALID_CODE_ERRORS:
+            raise ValueError(f"Invalid codelist type: {self.codelist_type}")
+
+        code = pl.col(self.code_column) if self.code_column in data.columns else pl.lit("")
+        term = pl.col(self.term_column) if self.term_column in data.columns else pl.lit("")
+        codes = data.select(code.alias("code"), term.alias("term"))
 
         # validate the codelist against the expected format depending on the codelist type
-        validation_methods = {
-            "SNOMED": (self.validate_snomed_code, InvalidSNOMEDCodeError),
-            "ICD10": (self.validate_icd10_code, InvalidICD10CodeError),
-            "OPCS": (self.validate_opcs_code, InvalidOPCSCodesError)
-        }
-        validate_method, exception_type = validation_methods.get(self.codelist_type, (None, ValueError))
-        if validate_method:
-            if not validate_method(code):
-                raise exception_type(f"Invalid {self.codelist_type} code: {code} for term: {term}")
-        else:
-            raise ValueError(f"Invalid codelist type: {self.codelist_type}")
+        invalid = codes.filter(~self._valid_codes(pl.col("code"), self.codelist_type))
+        if not invalid.is_empty():
+            raise INVALID_CODE_ERRORS[self.codelist_type]("; ".join(
+                f"Invalid {self.codelist_type} code: {code} for term: {term}" for code, term in invalid.iter_rows()
+            ))
 
         # Check for repeated codes. We do not check for repeated terms as this occurs when we have both
-        # an ICD code with and without an X that mean the same thing. i.e. A01 and A01X are the same. 
-        if code in self.codes:
-            raise RepeatedCodeError(f"Repeated code found: {code}")
-        else:
-            self.codes.add(code)
+        # an ICD code with and without an X that mean the same thing. i.e. A01 and A01X are the same.
+        repeated = codes.filter(pl.col("code").is_duplicated())["code"].unique(maintain_order=True)
+        if not repeated.is_empty():
+            raise RepeatedCodeError("; ".join(f"Repeated code found: {code}" for code in repeated))
+
+        self.codes.update(codes["code"].to_list())
+
+    @staticmethod
+    def _valid_codes(codes: pl.Expr, codelist_type: str) -> pl.Expr:
+        """
+        Builds an expression that checks the form of every code in a column at once. It gives the
+        same result as validate_snomed_code(), validate_icd10_code() or validate_opcs_code().
+
+        Args:
+            codes (pl.Expr): The codes.
+            codelist_type (str): The codelist type.
+
+        Returns:
+            pl.Expr: True for each valid code, False otherwise.
+        """
+        if codelist_type == "SNOMED":
+            return codes.str.contains(r"^\d+$") & codes.str.len_chars().is_between(SNOMED_MIN_LENGTH, SNOMED_MAX_LENGTH)
+        if codelist_type == "ICD10":
+            return codes.str.contains(ICD10_PATTERN) & (codes.str.len_chars() <= ICD10_MAX_LENGTH)
+        return codes.str.contains(OPCS_PATTERN) & (codes.str.len_chars() <= OPCS_MAX_LENGTH)
 
     @staticmethod
     def _check_path(path: str) -> bool:
@@ -127,7 +237,7 @@ class Codelist:
         return os.path.exists(path)
 
     @staticmethod
-    def validate_snomed_code(code: str, min_length: int = 6, max_length: int = 18) -> bool:
+    def validate_snomed_code(code: str, min_length: int = SNOMED_MIN_LENGTH, max_length: int = SNOMED_MAX_LENGTH) -> bool:
         """
         Validate the form of a SNOMED CT code.
         
@@ -165,13 +275,10 @@ class Codelist:
         Returns:
             bool: True if the code is valid, False otherwise.
         """
-        # Regex pattern to match the ICD-10 formats
-        pattern = re.compile(r"^[A-Z]\d{2}(X|(\.\d{1,3})?|\d{1,4})?$")
-
-        if len(code) > 7:
+        if len(code) > ICD10_MAX_LENGTH:
             return False
 
-        if pattern.match(code):
+        if ICD10_REGEX.match(code):
             return True
 
         return False
@@ -188,99 +295,107 @@ class Codelist:
         - If there is a fourth character and it is a dot, there must be a number after the dot
         - The fifth character, if present, is a number
         """
-        pattern = re.compile(r"^[A-Z]\d{2}(\.\d{1,2}|\d{1,2})?$")
-        if len(code) > 5:
+        if len(code) > OPCS_MAX_LENGTH:
             return False
 
-        if pattern.match(code):
+        if OPCS_REGEX.match(code):
             return True
 
         return False
 
-    def _add_X_codes_for_ICD(self, row: Dict[str, str]) -> Optional[Dict[str, str]]:
+    def _add_X_codes_for_ICD(self, data: pl.DataFrame) -> pl.DataFrame:
         """
-        Add the X code for ICD-10 codes that do not have an X code
-        and appends the X code to the end of the codelist with the 
-        correct term.
+        Builds the X codes for ICD-10 codes that do not have an X code. Each X code keeps
+        the other columns of the code it is made from, such as the term.
 
         E.g. if A01 is in the codelist, then A01X is added to the codelist
 
         Args:
-            row (Dict[str, str]): The row data containing the code and term.
+            data (pl.DataFrame): The codelist.
 
         Returns:
-            Optional[Dict[str, str]]: A new row with the X code, or None if the row already contains an X code.
+            pl.DataFrame: The X codes, one row for each code they are made from.
         """
-        code = row.get(self.code_column, "")
-
         # If the code is already an X code or doesn't match the pattern, don't add another
-        if 'X' in code or not re.match(r"^[A-Z]\d{2}$", code):
-            return None
-
-        # Create the new row with the X code
-        new_code = f"{code}X"
-        new_row = {
-            self.code_column: new_code,
-            self.term_column: row[self.term_column]
-        }
-
-        return new_row
-    
+        code = pl.col(self.code_column)
+        return (data
+                .filter(code.str.contains(ICD10_3_CHARACTER_PATTERN) & ~code.str.contains("X", literal=True))
+                .with_columns((code + "X").alias(self.code_column)))
+
     @classmethod
-    def map_snomed_to_icd10(cls, codelist: Codelist, mapping_file: str, icd10_3_digit_only: bool = False) -> Codelist:
+    def map_snomed_to_icd10(cls, codelist: Codelist, mapping_file: Union[str, SnomedToIcd10Mapping],
+                            icd10_3_digit_only: bool = False) -> Codelist:
         """
-        Maps SNOMED codes to their corresponding ICD10
+        Maps SNOMED codes to their corresponding ICD10. The codes are joined to the mapping table, and the
+        new codelist is built in memory. A SNOMED code that maps to several ICD10 codes keeps all of them.
+        If several SNOMED codes map to the same ICD10 code, the ICD10 code is kept once, in the place of the
+        first of them, with the term of the last of them.
 
         Args:
-            mapping_file (str): mapping file path
-        """
-        # Raise error if the codelist is not SNOMED
+            codelist (Codelist): The SNOMED codelist.
+            mapping_file (str | SnomedToIcd10Mapping): The mapping table, or the path to the mapping file. A path is
+                only read the first time it is used (see SnomedToIcd10Mapping.load()).
+            icd10_3_digit_only (bool, optional): If True, the ICD10 codes are truncated to 3 digits. Defaults to False.
 
-        # Check path to mapping file exists
+        Returns:
+            Codelist: The ICD10 codelist.
+        """
+        mapping = mapping_file if isinstance(mapping_file, SnomedToIcd10Mapping) else SnomedToIcd10Mapping.load(mapping_file)
+
+        codes = pl.DataFrame(codelist.data, schema={codelist.code_column: pl.Utf8, codelist.term_column: pl.Utf8})
+        # Keep the order of the codelist, then of the mapping file, through the join
+        mapped = (codes
+                  .select(pl.col(codelist.code_column).alias("snomed_code"), pl.col(codelist.term_column).alias("snomed_term"))
+                  .with_row_count("codelist_row")
+                  .join(mapping.targets(icd10_3_digit_only).with_row_count("mapping_row"), on="snomed_code", how="inner")
+                  .sort(["codelist_row", "mapping_row"])
+                  .group_by("icd10_code", maintain_order=True)
+                  .agg(pl.col("snomed_code").last(), pl.col("snomed_term").last())
+                  .select(pl.col("icd10_code").alias("code"),
+                          pl.format("Mapped from SNOMED Code: {}, Term: {}", "snomed_code", "snomed_term").alias("term")))
+
+        return cls.from_data(mapped, "ICD10")
 
-        # Decide whether to truncate ICD10 codes to 3 digits
-        if icd10_3_digit_only:
-            col_map = "ICD10_3digit"
-        else:
-            col_map = "mapTarget"
-
-        # Load the mapping file into a dictionary
-        with open(mapping_file, "r") as f:
-            reader = csv.DictReader(f)
-            mapping = {row["conceptId"]: row[col_map] for row in reader}
-
-        # Iterate through the data and map the SNOMED codes to ICD10 codes
-        new_data = {}
-        for row in codelist.data:
-            # If the SNOMED code is in the mapping file, add the ICD10 code to the new data
-            if row["code"] in mapping:
-                new_data[mapping[row["code"]]] = f"Mapped from SNOMED Code: {row['code']}, Term: {row['term']}"
-
-        # write the new data to a temporary file so it can be loaded into a new codelist object
-        # TODO: In the future, we should be able to load the data directly into a new codelist object
-        # without having to write to a temporary file first
-        temp_file = tempfile.NamedTemporaryFile(mode="w", delete=False)
-        writer = csv.DictWriter(temp_file, fieldnames=["code", "term"])
-        writer.writeheader()
-        for code, term in new_data.items():
-            writer.writerow({"code": code, "term": term})
-        temp_file.close()
-
-        # # make a new codelist object with the new data
-        new_codelist = Codelist(temp_file.name, "ICD10")
-        return new_codelist
-
-
-    def _icd10_3_digit_only(self, row: Dict[str, str]) -> [Dict[str, str]]:
+    @classmethod
+    def expand_snomed_descendants(cls, codelist: Codelist, hierarchy: SnomedHierarchy) -> Codelist:
         """
-        Truncating ICD10 codes to contain the first 3 digits only
+        Expands a SNOMED codelist to include every descendant of its concepts. The codes of the codelist are
+        kept with their terms, and each descendant that is not already in the codelist is added after them.
+        A descendant of several concepts in the codelist is added once, with the first of them as its source.
 
         Args:
-            row (Dict[str, str]): The row data containing the code and term.
+            codelist (Codelist): The SNOMED codelist.
+            hierarchy (SnomedHierarchy): The SNOMED hierarchy (see SnomedHierarchy.load()).
+
+        Returns:
+            Codelist: The expanded SNOMED codelist.
+
+        Raises:
+            InvalidProcessingRequest: If the codelist is not a SNOMED codelist.
+        """
+        if codelist.codelist_type != "SNOMED":
+            raise InvalidProcessingRequest("Only SNOMED codelists can be expanded to their descendants.")
+
+        codes = (pl.DataFrame(codelist.data, schema={codelist.code_column: pl.Utf8, codelist.term_column: pl.Utf8})
+                 .select(pl.col(codelist.code_column).alias("code"), pl.col(codelist.term_column).alias("term")))
+        descendants = (codes
+                       .with_row_count("codelist_row")
+                       .with_columns(pl.col("code").cast(pl.Int64).alias("ancestor"))
+                       .join(hierarchy.descendants(codes["code"].cast(pl.Int64)), on="ancestor", how="inner")
+                       .with_columns(pl.col("descendant").cast(pl.Utf8))
+                       .filter(~pl.col("descendant").is_in(codes["code"]))
+                       .sort(["codelist_row", "descendant"])
+                       .unique(subset="descendant", keep="first", maintain_order=True)
+                       .select(pl.col("descendant").alias("code"),
+                               pl.format("Descendant of SNOMED Code: {}, Term: {}", "code", "term").alias("term")))
+
+        return cls.from_data(pl.concat([codes, descendants]), "SNOMED", path=codelist.path)
+
+    def _icd10_3_digit_only(self) -> pl.Expr:
+        """
+        Truncating ICD10 codes to contain the first 3 digits only
 
         Returns:
-            Dict[str, str]: A new row with the truncated ICD10 code.
+            pl.Expr: The code column with each code truncated to its first 3 characters.
         """
-        if len(row[self.code_column]) > 3:
-            row[self.code_column] = row[self.code_column][:3]
-        return row
+        return pl.col(self.code_column).str.slice(0, 3)
@@ -24,4 +24,8 @@ class InvalidDataShapeError(Exception):
 
 class InvalidProcessingRequest(Exception):
     """Raised when the processing request is invalid."""
-    pass
\ No newline at end of file
+    pass
+
+class InvalidSNOMEDHierarchyError(Exception):
+    """Raised when a SNOMED hierarchy cannot be built from the relationships."""
+    pass
@@ -0,0 +1,89 @@
+"""
+This file contains the SnomedToIcd10Mapping class, a SNOMED to ICD10 mapping table that is loaded once
+and shared by every codelist that is mapped with it.
+"""
+from __future__ import annotations
+import os
+from typing import Dict, Tuple
+
+import polars as pl
+
+
+class SnomedToIcd10Mapping:
+    # Mapping tables that have been loaded, keyed on the file (and its modification time) and the columns used
+    _loaded: Dict[Tuple, SnomedToIcd10Mapping] = {}
+
+    def __init__(self, path: str,
+                 snomed_column: str = "conceptId",
+                 icd10_column: str = "mapTarget",
+                 icd10_3_digit_column: str = "ICD10_3digit") -> None:
+        """
+        Loads a SNOMED to ICD10 mapping table. Every row of the file is kept, so a SNOMED code that maps
+        to several ICD10 codes keeps all of them.
+
+        Args:
+            path (str): The path to the mapping file.
+            snomed_column (str, optional): The column with the SNOMED codes. Defaults to "conceptId".
+            icd10_column (str, optional): The column with the ICD10 codes. Defaults to "mapTarget".
+            icd10_3_digit_column (str, optional): The column with the ICD10 codes truncated to 3 digits.
+                Defaults to "ICD10_3digit".
+
+        Raises:
+            FileNotFoundError: If the mapping file does not exist.
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Could not find mapping file at {path}")
+
+        self.path = path
+        self.snomed_column = snomed_column
+        self.icd10_column = icd10_column
+        self.icd10_3_digit_column = icd10_3_digit_column
+
+        # Codes are read as strings, as they are in a codelist
+        self.data = pl.read_csv(path, infer_schema_length=0)
+
+    @classmethod
+    def load(cls, path: str,
+             snomed_column: str = "conceptId",
+             icd10_column: str = "mapTarget",
+             icd10_3_digit_column: str = "ICD10_3digit") -> SnomedToIcd10Mapping:
+        """
+        Gets the mapping table for a file, loading it only the first time it is asked for. The table is
+        loaded again if the file has changed since.
+
+        Args:
+            path (str): The path to the mapping file.
+            snomed_column (str, optional): The column with the SNOMED codes. Defaults to "conceptId".
+            icd10_column (str, optional): The column with the ICD10 codes. Defaults to "mapTarget".
+            icd10_3_digit_column (str, optional): The column with the ICD10 codes truncated to 3 digits.
+                Defaults to "ICD10_3digit".
+
+        Returns:
+            SnomedToIcd10Mapping: The mapping table.
+
+        Raises:
+            FileNotFoundError: If the mapping file does not exist.
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Could not find mapping file at {path}")
+
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns, snomed_column, icd10_column, icd10_3_digit_column)
+        if key not in cls._loaded:
+            cls._loaded[key] = cls(path, snomed_column, icd10_column, icd10_3_digit_column)
+        return cls._loaded[key]
+
+    def targets(self, icd10_3_digit_only: bool = False) -> pl.DataFrame:
+        """
+        Gets the SNOMED code and ICD10 code of every row of the mapping table.
+
+        Args:
+            icd10_3_digit_only (bool, optional): If True, the ICD10 codes are truncated to 3 digits. Defaults to False.
+
+        Returns:
+            pl.DataFrame: The mapping, with the columns "snomed_code" and "icd10_code", in the order of the file.
+        """
+        icd10_column = self.icd10_3_digit_column if icd10_3_digit_only else self.icd10_column
+        # SNOMED codes with no ICD10 code are not mapped
+        return (self.data
+                .select(pl.col(self.snomed_column).alias("snomed_code"), pl.col(icd10_column).alias("icd10_code"))
+                .drop_nulls())
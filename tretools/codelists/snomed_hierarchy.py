@@ -0,0 +1,189 @@
+"""
+This file contains the SnomedHierarchy class, which finds all the descendants of SNOMED concepts.
+
+The hierarchy is read from the relationships file of a SNOMED CT RF2 release
+(e.g. sct2_Relationship_Snapshot_INT_20240101.txt). Every concept is linked to its parents by "is a"
+relationships. The transitive closure of these relationships - every ancestor paired with every one of its
+descendants - is built once, which is slow, and saved to disk. After that, the descendants of any set of
+concepts are found with a binary search in the saved closure.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterable
+
+import polars as pl
+
+from tretools.codelists.errors import InvalidSNOMEDHierarchyError
+
+
+# The typeId of an "is a" relationship in SNOMED CT
+IS_A_RELATIONSHIP = 116680003
+
+# The columns of the RF2 relationships file that are needed to build the hierarchy
+RF2_RELATIONSHIP_COLUMNS = ["active", "sourceId", "destinationId", "typeId"]
+
+
+class SnomedHierarchy:
+    # Hierarchies that have been loaded, keyed on the path of the saved closure
+    _loaded: Dict[str, SnomedHierarchy] = {}
+
+    def __init__(self, closure: pl.DataFrame) -> None:
+        """
+        Creates a hierarchy from its transitive closure. Use build() or load() to make one from an RF2 file.
+
+        Args:
+            closure (pl.DataFrame): Every ancestor paired with every one of its descendants, in the columns
+                "ancestor" and "descendant", sorted by ancestor.
+        """
+        self.closure = closure
+        self.log = []
+
+    @staticmethod
+    def _read_is_a_relationships(relationships_path: str) -> pl.DataFrame:
+        """
+        Reads the active "is a" relationships from an RF2 relationships file.
+
+        Args:
+            relationships_path (str): The path to the RF2 relationships file.
+
+        Returns:
+            pl.DataFrame: Each parent and child, in the columns "ancestor" and "descendant".
+        """
+        relationships = pl.read_csv(relationships_path, separator="\t", quote_char=None, columns=RF2_RELATIONSHIP_COLUMNS,
+                                    dtypes={column: pl.Int64 for column in RF2_RELATIONSHIP_COLUMNS})
+        return (relationships
+                .filter((pl.col("active") == 1) & (pl.col("typeId") == IS_A_RELATIONSHIP))
+                .select(pl.col("destinationId").alias("ancestor"), pl.col("sourceId").alias("descendant"))
+                .unique())
+
+    @classmethod
+    def build(cls, relationships_path: str) -> SnomedHierarchy:
+        """
+        Builds the transitive closure of the hierarchy from an RF2 relationships file. The closure starts as the
+        parent-child pairs. Each round finds the pairs one step further apart than the last round, by joining
+        them to the parent-child pairs, until a round finds none. The number of rounds is the depth of the
+        hierarchy. Pairs that are linked by several paths are found more than once, and are only dropped
+        at the end, which is much quicker than checking each round against all the pairs found so far.
+
+        Args:
+            relationships_path (str): The path to the RF2 relationships file.
+
+        Returns:
+            SnomedHierarchy: The hierarchy.
+
+        Raises:
+            FileNotFoundError: If the relationships file does not exist.
+            InvalidSNOMEDHierarchyError: If a concept is its own ancestor.
+        """
+        if not os.path.exists(relationships_path):
+            raise FileNotFoundError(f"Could not find SNOMED relationships file at {relationships_path}")
+
+        start = datetime.now()
+        edges = cls._read_is_a_relationships(relationships_path)
+        found = [edges]
+        new_pairs = edges
+        rounds = 0
+        while not new_pairs.is_empty():
+            # A concept that is its own ancestor would make the rounds go on forever
+            cycle = new_pairs.filter(pl.col("ancestor") == pl.col("descendant"))
+            if not cycle.is_empty():
+                raise InvalidSNOMEDHierarchyError(f"SNOMED concept {cycle['ancestor'][0]} is its own ancestor in {relationships_path}")
+            new_pairs = (new_pairs
+                         .join(edges, left_on="descendant", right_on="ancestor")
+                         .select("ancestor", pl.col("descendant_right").alias("descendant"))
+                         .unique())
+            found.append(new_pairs)
+            rounds += 1
+
+        closure = pl.concat(found).unique().sort(["ancestor", "descendant"]).rechunk()
+        hierarchy = cls(closure)
+        hierarchy.log.append(f"{datetime.now()}: Built the transitive closure of {relationships_path} in {rounds} rounds, "
+                             f"with {edges.shape[0]} relationships and {closure.shape[0]} ancestor-descendant pairs, "
+                             f"in {(datetime.now() - start).total_seconds():.1f}s")
+        return hierarchy
+
+    def write(self, path: str) -> None:
+        """
+        Saves the closure to an uncompressed feather file, so it can be memory-mapped when it is loaded.
+
+        Args:
+            path (str): The path to the feather file.
+        """
+        # Write next to the path and move into place, so the file is never half written
+        temp_path = f"{path}.tmp"
+        self.closure.write_ipc(temp_path, compression="uncompressed")
+        os.replace(temp_path, path)
+        self.log.append(f"{datetime.now()}: Closure written to {path}")
+
+    @classmethod
+    def read(cls, path: str) -> SnomedHierarchy:
+        """
+        Loads a closure saved with write(). The file is memory-mapped, so it is not copied into memory and
+        its pages are shared with other processes that load it.
+
+        Args:
+            path (str): The path to the feather file.
+
+        Returns:
+            SnomedHierarchy: The hierarchy.
+        """
+        hierarchy = cls(pl.read_ipc(path, memory_map=True, rechunk=False))
+        hierarchy.log.append(f"{datetime.now()}: Loaded closure from {path} using a memory map")
+        return hierarchy
+
+    @classmethod
+    def load(cls, relationships_path: str, cache_dir: str) -> SnomedHierarchy:
+        """
+        Gets the hierarchy for an RF2 relationships file. The closure is built and saved in the cache directory
+        the first time, and loaded from there after that. A new release, or any change to the file, gets a
+        new closure.
+
+        Args:
+            relationships_path (str): The path to the RF2 relationships file.
+            cache_dir (str): The directory to save the closure in.
+
+        Returns:
+            SnomedHierarchy: The hierarchy.
+
+        Raises:
+            FileNotFoundError: If the relationships file does not exist.
+        """
+        if not os.path.exists(relationships_path):
+            raise FileNotFoundError(f"Could not find SNOMED relationships file at {relationships_path}")
+
+        stat = os.stat(relationships_path)
+        fingerprint = {"path": os.path.abspath(relationships_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        key = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+        closure_path = os.path.join(cache_dir, f"snomed_closure_{key}.arrow")
+
+        if closure_path not in cls._loaded:
+            if os.path.isfile(closure_path):
+                hierarchy = cls.read(closure_path)
+            else:
+                os.makedirs(cache_dir, exist_ok=True)
+                hierarchy = cls.build(relationships_path)
+                hierarchy.write(closure_path)
+            cls._loaded[closure_path] = hierarchy
+        return cls._loaded[closure_path]
+
+    def descendants(self, codes: Iterable[int]) -> pl.DataFrame:
+        """
+        Finds the descendants of SNOMED concepts. The closure is sorted by ancestor, so the descendants of
+        each concept are found with a binary search.
+
+        Args:
+            codes (Iterable[int]): The concept ids.
+
+        Returns:
+            pl.DataFrame: Each concept paired with each of its descendants, in the columns "ancestor" and
+                "descendant", sorted by ancestor. Concepts with no descendants are left out.
+        """
+        codes = pl.Series("ancestor", list(codes), dtype=pl.Int64).unique().sort()
+        ancestors = self.closure["ancestor"]
+        starts = ancestors.search_sorted(codes, side="left")
+        ends = ancestors.search_sorted(codes, side="right")
+        rows = pl.int_ranges(starts, ends, eager=True).explode().drop_nulls()
+        return self.closure[rows]
@@ -0,0 +1,79 @@
+"""
+This module contains the CodePrefixIndex class, which finds the codes in a dataset that start with
+the codes in a codelist.
+"""
+from __future__ import annotations
+
+from bisect import bisect_left
+from typing import Iterable, List
+
+import polars as pl
+
+
+class CodePrefixIndex:
+    """
+    An index over the distinct codes of a dataset, kept as a sorted list. The codes that start with
+    a prefix are next to each other in the list, so they are found with two binary searches. The cost
+    of a match depends on the number of distinct codes, not the number of rows in the dataset.
+    """
+    def __init__(self, codes: Iterable[str]) -> None:
+        """
+        Builds the index.
+
+        Args:
+            codes (Iterable[str]): The codes in the dataset. Repeated and missing codes are dropped.
+        """
+        self.codes = sorted({code for code in codes if code is not None})
+        # The data the index was built from, if it was built with from_data()
+        self.data = None
+
+    @classmethod
+    def from_data(cls, data) -> CodePrefixIndex:
+        """
+        Builds the index from the code column of a dataset. A lazy dataset is scanned for its distinct codes,
+        so only the code column is read.
+
+        Args:
+            data (pl.DataFrame | pl.LazyFrame): The data of the dataset.
+
+        Returns:
+            CodePrefixIndex: The index.
+        """
+        codes = data.select(pl.col("code").cast(pl.Utf8).unique())
+        if isinstance(codes, pl.LazyFrame):
+            codes = codes.collect()
+        index = cls(codes["code"].to_list())
+        index.data = data
+        return index
+
+    def match(self, prefix: str) -> List[str]:
+        """
+        Finds the codes that start with a prefix.
+
+        Args:
+            prefix (str): The prefix, e.g. "A01".
+
+        Returns:
+            List[str]: The codes that start with the prefix, in sorted order.
+        """
+        if not prefix:
+            return list(self.codes)
+        start = bisect_left(self.codes, prefix)
+        # Every code that starts with the prefix sorts before the prefix with its last character incremented
+        end = bisect_left(self.codes, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo=start)
+        return self.codes[start:end]
+
+    def match_all(self, prefixes: Iterable[str]) -> List[str]:
+        """
+        Finds the codes that start with any of the prefixes.
+
+        Args:
+            prefixes (Iterable[str]): The prefixes.
+
+        Returns:
+            List[str]: The codes that start with any of the prefixes, in sorted order.
+        """
+        matched = set()
+        for prefix in prefixes:
+            matched.update(self.match(prefix))
+        return sorted(matched)
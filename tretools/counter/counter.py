@@ -1,19 +1,39 @@
 
 
+import os
+
+from bisect import bisect_right
 from datetime import datetime
-from typing import Optional
+from functools import reduce
+from typing import Dict, List, Optional, Tuple, Union
 import polars as pl
 
 from tretools.codelists.codelist_types import CodelistType
-from tretools.counter.errors import MismatchBetweenDatasetAndCodelist
+from tretools.counter.code_index import CodePrefixIndex
+from tretools.counter.errors import MismatchBetweenDatasetAndCodelist, PrefixMatchNotSupported
 from tretools.codelists.codelist import Codelist
 
+from tretools.datasets.base import match_join_key_types
 from tretools.datasets.demographic_dataset import DemographicDataset
+from tretools.datasets.dates import map_distinct
+from tretools.utility.step_log import timed_step
+
+
+# The most ranges of codes that are checked against the statistics of a parquet file, to skip the
+# row groups that contain no codes from a codelist
+MAX_CODE_RANGES = 64
+
+# The age ranges from ONS. Each break is the first age of the next range.
+AGE_RANGE_BREAKS = [18, 25, 35, 45, 55, 65, 75, 85]
+AGE_RANGE_LABELS = ["<18", "18-24", "25-34", "35-44", "45-54", "55-64", "65-74", "75-84", "85+"]
+
+# The labels of the gender codes in the demographic data
+GENDER_LABELS = {1: "M", 2: "F"}
 
 
 def categorise_age(age):
     """
-    Categorises the age into age ranges from ONS.
+    Categorises the age into age ranges from ONS. Use age_range_expr() to categorise a column of ages.
 
     Args:
         age: The age to categorise.
@@ -21,24 +41,108 @@ def categorise_age(age):
     Returns:
         str: The age range.
     """
-    if age < 18:
-        return "<18"
-    if age < 25:
-        return "18-24"
-    elif age < 35:
-        return "25-34"
-    elif age < 45:
-        return "35-44"
-    elif age < 55:
-        return "45-54"
-    elif age < 65:
-        return "55-64"
-    elif age < 75:
-        return "65-74"
-    elif age < 85:
-        return "75-84"
-    else:
-        return "85+"
+    return AGE_RANGE_LABELS[bisect_right(AGE_RANGE_BREAKS, age)]
+
+
+def age_range_expr(column: str = "age_at_event") -> pl.Expr:
+    """
+    Categorises a column of ages into the age ranges from ONS, in the same way as categorise_age().
+    Missing ages are left missing.
+
+    Args:
+        column (str, optional): The column with the ages. Defaults to "age_at_event".
+
+    Returns:
+        pl.Expr: The age range of each age, as a string.
+    """
+    return pl.col(column).cut(AGE_RANGE_BREAKS, labels=AGE_RANGE_LABELS, left_closed=True).cast(pl.Utf8)
+
+
+def gender_label_expr(column: str = "gender") -> pl.Expr:
+    """
+    Labels a column of gender codes as "M" or "F". Codes other than 1 and 2 are left missing.
+
+    Args:
+        column (str, optional): The column with the gender codes. Defaults to "gender".
+
+    Returns:
+        pl.Expr: The label of each gender code.
+    """
+    return pl.col(column).map_dict(GENDER_LABELS)
+
+
+def code_ranges(codes: List, max_ranges: int = MAX_CODE_RANGES) -> List[Tuple]:
+    """
+    Groups codes into ranges, so that the codes can be checked against the minimum and maximum code of each
+    row group in a parquet file. If there are more codes than max_ranges, the codes are split at the biggest
+    gaps between them.
+
+    Args:
+        codes (List): The codes.
+        max_ranges (int, optional): The most ranges to return. Defaults to MAX_CODE_RANGES.
+
+    Returns:
+        List[Tuple]: The first and last code of each range, in order.
+    """
+    codes = sorted(set(codes))
+    if len(codes) <= max_ranges:
+        return [(code, code) for code in codes]
+
+    # Split the codes at the biggest gaps. Codes that are strings are split where they differ the earliest.
+    def gap(i):
+        if isinstance(codes[i], str):
+            common = len(os.path.commonprefix([codes[i - 1], codes[i]]))
+            return -common
+        return codes[i] - codes[i - 1]
+    splits = sorted(sorted(range(1, len(codes)), key=gap, reverse=True)[:max_ranges - 1])
+
+    ranges, start = [], 0
+    for split in splits:
+        ranges.append((codes[start], codes[split - 1]))
+        start = split
+    ranges.append((codes[start], codes[-1]))
+    return ranges
+
+
+def code_filter(codes: List) -> pl.Expr:
+    """
+    Builds the filter for rows with a code in a list of codes. As well as the is_in check, the filter checks
+    the codes are in code_ranges(codes). Polars checks these ranges against the statistics of each row group
+    of a parquet file, so a lazy scan skips the row groups that contain none of the codes.
+
+    Args:
+        codes (List): The codes.
+
+    Returns:
+        pl.Expr: The filter.
+    """
+    ranges = [
+        pl.col("code") == pl.lit(first) if first == last else pl.col("code").is_between(pl.lit(first), pl.lit(last))
+        for first, last in code_ranges(codes)
+    ]
+    if not ranges:
+        return pl.col("code").is_in(codes)
+    return reduce(lambda left, right: left | right, ranges) & pl.col("code").is_in(codes)
+
+
+def select_first_events(data: pl.DataFrame, by: Union[str, List[str]] = "nhs_number",
+                        order_by: Optional[List[str]] = None) -> pl.DataFrame:
+    """
+    Gets the first event of each group, e.g. of each person. The rows are grouped and only the rows within
+    each group are ordered, so the whole frame is never sorted. Rows on the same date are split by the
+    next column of order_by, so the same event is picked every time.
+
+    Args:
+        data (pl.DataFrame): The events.
+        by (Union[str, List[str]], optional): The column(s) to group by. Defaults to "nhs_number".
+        order_by (List[str], optional): The columns that order the events, the first being the date and the rest
+            breaking ties. Defaults to ["date", "code"].
+
+    Returns:
+        pl.DataFrame: The first event of each group, with the group columns first.
+    """
+    order_by = ["date", "code"] if order_by is None else order_by
+    return data.group_by(by).agg(pl.all().sort_by(order_by).first())
 
 
 
@@ -49,20 +153,123 @@ class EventCounter:
     def __init__(self, dataset):
         self.dataset = dataset
         self.counts = {}
-        self.log = [f"{datetime.now()}: There are {self.dataset.data.shape[0]} events in the dataset"]
+        self.log = [f"{datetime.now()}: There are {self.dataset._count_rows()} events in the dataset"]
+        # A record of each count, with its timing and memory (see tretools.utility.step_log)
+        self.steps = []
+        # The index of the distinct codes in the dataset, built the first time a count uses prefix matching
+        # and kept on the dataset
+        self.code_index = None
 
-    def count_events(self, name_of_count: str, codelist: Codelist, demographics: Optional[DemographicDataset] = None) -> None:
+    @timed_step
+    def count_events(self, name_of_count: str, codelist: Codelist, demographics: Optional[DemographicDataset] = None,
+                     prefix_match: bool = False) -> None:
         """
         Counts the number of events in the dataset for each code in the codelist.
 
         Args:
             name_of_count (str): The name of the count.
             codelist (Codelist): The codelist to count events for.
+            demographics (DemographicDataset, optional): The demographic data to add to the count. Defaults to None.
+            prefix_match (bool, optional): If True, each code in an ICD10 or OPCS codelist also counts the events of
+                every code in the dataset that starts with it, e.g. A01 also counts A01X, A010 and A01.1. The codes
+                that were matched are stored in the count as "matched_codes". Defaults to False.
+
+        Raises:
+            MismatchBetweenDatasetAndCodelist: If the coding systems of the dataset and codelist do not match.
+            PrefixMatchNotSupported: If prefix matching is asked for with a SNOMED codelist.
         """
-        # Log the number of events in the dataset
+        # Log the number of events in the dataset
         log = self.log
         log.append(f"{datetime.now()}: Counting events for codelist {name_of_count}")
 
+        codes, matched_codes = self._codelist_codes(codelist, prefix_match)
+
+        # Filter the dataset to only include rows where the code is in the codelist
+        filtered_data = self._filter_codes(matched_codes if prefix_match else codes)
+
+        # event count
+        event_count = filtered_data.shape[0]
+        log.append(f"{datetime.now()}: There are {event_count} events in the dataset for the codelist")
+
+        # Get the first event of each person
+        first_events = select_first_events(filtered_data)
+
+        self._add_counts(name_of_count, codelist, codes, matched_codes, event_count, first_events, demographics)
+
+    @timed_step
+    def count_events_batch(self, codelists: Dict[str, Codelist], demographics: Optional[DemographicDataset] = None,
+                           prefix_match: bool = False) -> None:
+        """
+        Counts the number of events in the dataset for many codelists at once. The codes of all the codelists
+        are put in one table of count names and codes, which is joined to the dataset once. The event counts
+        and the first event of each person are then found for every codelist with one grouped aggregation,
+        instead of a scan, sort and group by of the dataset for each codelist. Each count is stored in the
+        same way as by count_events().
+
+        Args:
+            codelists (Dict[str, Codelist]): The codelists to count events for, keyed on the name of each count.
+            demographics (DemographicDataset, optional): The demographic data to add to the counts. Defaults to None.
+            prefix_match (bool, optional): If True, each code in an ICD10 or OPCS codelist also counts the events of
+                every code in the dataset that starts with it (see count_events()). Defaults to False.
+
+        Raises:
+            MismatchBetweenDatasetAndCodelist: If the coding systems of the dataset and a codelist do not match.
+            PrefixMatchNotSupported: If prefix matching is asked for with a SNOMED codelist.
+        """
+        log = self.log
+        log.append(f"{datetime.now()}: Counting events for {len(codelists)} codelists in one pass")
+
+        # Every codelist is checked before the dataset is read
+        codes, matched_codes = {}, {}
+        for name_of_count, codelist in codelists.items():
+            codes[name_of_count], matched_codes[name_of_count] = self._codelist_codes(codelist, prefix_match)
+        count_codes = matched_codes if prefix_match else codes
+
+        # A long table with a row for each count and each of its codes
+        code_type = pl.Int64 if self.dataset.coding_system == CodelistType.SNOMED.value else pl.Utf8
+        code_table = pl.DataFrame({
+            "count_name": [name for name, name_codes in count_codes.items() for _ in name_codes],
+            "code": [code for name_codes in count_codes.values() for code in name_codes],
+        }, schema={"count_name": pl.Utf8, "code": code_type})
+
+        # Only the rows with a code in one of the codelists are read, then each row is matched to every
+        # count it is in
+        filtered_data = self._filter_codes(code_table["code"].unique().to_list())
+        if filtered_data.schema["code"] != pl.Categorical:
+            code_table = code_table.with_columns(pl.col("code").cast(filtered_data.schema["code"]))
+        filtered_data, code_table = match_join_key_types(filtered_data, code_table, on="code")
+        matched_data = filtered_data.join(code_table, on="code", how="inner")
+        log.append(f"{datetime.now()}: There are {filtered_data.shape[0]} events in the dataset for the {len(codelists)} codelists")
+
+        event_counts = dict(matched_data.group_by("count_name").agg(pl.count()).iter_rows())
+        first_events = (select_first_events(matched_data, by=["count_name", "nhs_number"])
+                        .partition_by("count_name", as_dict=True))
+
+        # Split the counts back out for each codelist, in the order of the codelists
+        for name_of_count, codelist in codelists.items():
+            log.append(f"{datetime.now()}: Counting events for codelist {name_of_count}")
+            event_count = event_counts.get(name_of_count, 0)
+            log.append(f"{datetime.now()}: There are {event_count} events in the dataset for the codelist")
+            name_first_events = first_events[name_of_count] if name_of_count in first_events else matched_data.clear()
+            self._add_counts(name_of_count, codelist, codes[name_of_count], matched_codes[name_of_count], event_count,
+                             name_first_events.select(filtered_data.columns), demographics)
+
+    def _codelist_codes(self, codelist: Codelist, prefix_match: bool) -> Tuple[List, Optional[List]]:
+        """
+        Gets the codes of a codelist to count, in the type of the codes in the dataset.
+
+        Args:
+            codelist (Codelist): The codelist.
+            prefix_match (bool): If True, the codes in the dataset that start with a code in the codelist are found.
+
+        Returns:
+            Tuple[List, Optional[List]]: The codes of the codelist, and the codes in the dataset that they
+                matched, or None if prefix matching is not used.
+
+        Raises:
+            MismatchBetweenDatasetAndCodelist: If the coding systems of the dataset and codelist do not match.
+            PrefixMatchNotSupported: If prefix matching is asked for with a SNOMED codelist.
+        """
         # Check if the codelist and dataset have the same coding system
         if self.dataset.coding_system != codelist.codelist_type:
             raise MismatchBetweenDatasetAndCodelist(f"Coding system of dataset ({self.dataset.coding_system}) does not match coding system of codelist ({codelist.codelist_type})")
@@ -74,17 +281,48 @@ class EventCounter:
         if codelist.codelist_type == CodelistType.SNOMED.value:
             codes = [int(code) for code in codelist.codes if code.isdigit()]
 
-        # Filter the dataset to only include rows where the code is in the codelist
-        filtered_data = self.dataset.data.filter(self.dataset.data["code"].is_in(codes))
+        # Find the codes in the dataset that start with a code in the codelist
+        matched_codes = None
+        if prefix_match:
+            if codelist.codelist_type == CodelistType.SNOMED.value:
+                raise PrefixMatchNotSupported("Prefix matching is only supported for ICD10 and OPCS codelists")
+            matched_codes = self._code_index().match_all(codes)
+            self.log.append(f"{datetime.now()}: Prefix matching the {len(codes)} codes in the codelist matched {len(matched_codes)} codes in the dataset")
+        return codes, matched_codes
 
-        # event count
-        event_count = filtered_data.shape[0]
-        log.append(f"{datetime.now()}: There are {event_count} events in the dataset for the codelist")
+    def _filter_codes(self, codes: List) -> pl.DataFrame:
+        """
+        Filters the dataset to only include rows where the code is in a list of codes. If the dataset is lazy,
+        only the rows that match are read. Partitions and parquet row groups with none of the codes are skipped.
+
+        Args:
+            codes (List): The codes.
 
-        # Sort the data by nhs_number and date, then group by nhs_number to get the first event
+        Returns:
+            pl.DataFrame: The rows with one of the codes.
+        """
+        if self.dataset._is_lazy():
+            data = self.dataset._scan_codes(codes)
+            if data.schema["code"] == pl.Categorical:
+                return data.filter(pl.col("code").is_in(codes)).collect()
+            return data.filter(code_filter(codes)).collect()
+        return self.dataset.data.filter(self.dataset.data["code"].is_in(codes))
+
+    def _add_counts(self, name_of_count: str, codelist: Codelist, codes: List, matched_codes: Optional[List],
+                    event_count: int, first_events: pl.DataFrame, demographics: Optional[DemographicDataset]) -> None:
+        """
+        Adds the counts for a codelist to the counts dictionary.
 
-        first_events = (filtered_data.sort(["nhs_number", "date"])
-                        .group_by("nhs_number").first())
+        Args:
+            name_of_count (str): The name of the count.
+            codelist (Codelist): The codelist that was counted.
+            codes (List): The codes of the codelist.
+            matched_codes (List, optional): The codes in the dataset matched by prefix matching, or None.
+            event_count (int): The number of events for the codelist.
+            first_events (pl.DataFrame): The first event of each person for the codelist.
+            demographics (DemographicDataset, optional): The demographic data to add to the count.
+        """
+        log = self.log
 
         # person count
         person_count = first_events.shape[0]
@@ -106,38 +344,54 @@ class EventCounter:
             "dataset_log": self.dataset.log,
         }
 
+        if matched_codes is not None:
+            counts["matched_codes"] = matched_codes
+
         # Add the counts to the counts dictionary
         self.counts[name_of_count] = counts
 
+    def _code_index(self) -> CodePrefixIndex:
+        """
+        Gets the index of the distinct codes in the dataset, building it the first time it is needed. The index
+        is kept on the dataset, so every count with prefix matching on the dataset shares it, including the counts
+        of other counters such as those made by PhenotypeReport.add_count(). It is built again if the data of
+        the dataset has been replaced since.
+
+        Returns:
+            CodePrefixIndex: The index.
+        """
+        code_index = getattr(self.dataset, "code_index", None)
+        if code_index is None or code_index.data is not self.dataset.data:
+            code_index = CodePrefixIndex.from_data(self.dataset.data)
+            self.dataset.code_index = code_index
+            self.log.append(f"{datetime.now()}: Built an index of the {len(code_index.codes)} distinct codes in the dataset")
+        self.code_index = code_index
+        return code_index
+
     def _calculate_demographics(self, first_events, demographics: DemographicDataset):
         # Merge the first events data with demographic together
-        first_events = first_events.join(demographics.data, on="nhs_number", how="inner")
+        first_events, demographic_data = match_join_key_types(first_events, demographics.data, on="nhs_number")
+        first_events = first_events.join(demographic_data, on="nhs_number", how="inner")
 
         # Convert 'date' and 'dob' columns to datetime if they are not already. If they are already datetime, then
         # skip this step
         if first_events["date"].dtype != pl.Date:
-            first_events = first_events.with_columns([
-                pl.col("date").str.strptime(pl.Date, "%Y-%m-%d", strict=False).alias("date"),
-            ])
-
-        gender_map = {1: "M", 2: "F"}
-
-        # Calculate the age at event
-        first_events = first_events.with_columns(
-            ((pl.col("date") - pl.col("dob")).dt.days() / 365.25).cast(int).alias("age_at_event")
-        )
-
-        # Apply categorization and mapping - we only do this if we have any rows in the dataset
-        if first_events.shape[0] > 0:
-            first_events = first_events.with_columns([
-                first_events["age_at_event"].apply(categorise_age).alias("age_range"),
-                first_events["gender"].apply(lambda x: gender_map[x]).alias("gender_label")
-            ])
-
-            # select the columns we want (nhs_number, code, date, age at event, gender_label)
-            first_events = first_events.select(["nhs_number", "code", "date", "age_at_event", "gender_label"])
-            # Rename gender_label as gender
-            first_events = first_events.rename({"gender_label": "gender"})
-
-            self.log.append(f"{datetime.now()}: Demographic data added to the report")
+            # Each distinct date is only parsed once
+            first_events = first_events.with_columns(
+                map_distinct(first_events["date"], lambda dates: dates.str.strptime(pl.Date, "%Y-%m-%d", strict=False))
+            )
+
+        # Calculate the age at event, and label the gender. The age range is not kept, as it is found from the
+        # age at event when a report is transformed.
+        first_events = first_events.with_columns([
+            ((pl.col("date") - pl.col("dob")).dt.days() / 365.25).cast(int).alias("age_at_event"),
+            gender_label_expr().alias("gender_label"),
+        ])
+
+        # select the columns we want (nhs_number, code, date, age at event, gender_label)
+        first_events = first_events.select(["nhs_number", "code", "date", "age_at_event", "gender_label"])
+        # Rename gender_label as gender
+        first_events = first_events.rename({"gender_label": "gender"})
+
+        self.log.append(f"{datetime.now()}: Demographic data added to the report")
         return first_events
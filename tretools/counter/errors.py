@@ -2,4 +2,10 @@ class MismatchBetweenDatasetAndCodelist(Exception):
     """
     Raised when the dataset type and codelist type do not match.
     """
-    pass
\ No newline at end of file
+    pass
+
+class PrefixMatchNotSupported(Exception):
+    """
+    Raised when prefix matching is asked for with a codelist type that does not support it.
+    """
+    pass
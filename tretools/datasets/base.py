@@ -1,26 +1,267 @@
 """
 File containing the Dataset class.
 """
+from __future__ import annotations
+
+import glob
+import gzip
+import io
+import itertools
+import json
+import math
 import os
 import polars as pl
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
 
 
 from tretools.codelists.codelist_types import CodelistType
 from tretools.datasets.dataset_enums.dataset_types import DatasetType
+from tretools.datasets.dates import map_distinct
 from tretools.datasets.errors import DatasetPathNotCorrect, WriteOptionsInvalid, UnsupportedFileType
+from tretools.utility.step_log import timed_step
+
+
+# Values that are treated as missing when reading delimited files
+NULL_VALUES = ["", " ", "NULL", "NA", "               ", ".", "                    ", "-", "NOT CLOSE"]
+
+# Compressed delimited files are decompressed as they are read. The extension before the compression
+# extension says what kind of file it is, e.g. procedures.csv.gz
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".zst": "zstd"}
+
+# Number of rows sampled from a delimited file to work out the type of each column
+SCHEMA_SAMPLE_ROWS = 10000
+
+# Patterns used to work out the type of a column from its sampled values
+INTEGER_PATTERN = r"^[+-]?\d+$"
+FLOAT_PATTERN = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
+SCIENTIFIC_NOTATION_PATTERN = r"^[+-]?(\d+\.?\d*|\.\d+)[eE][+-]?\d+$"
+BOOLEAN_PATTERN = r"(?i)^(true|false)$"
+
+# Number of rows in each row group of a parquet file written by write_to_parquet()
+PARQUET_ROW_GROUP_SIZE = 100000
+
+# The most row groups a parquet file is split into. Larger files get larger row groups, as a filtered
+# scan of a file with many more row groups than this crashes polars 0.19 (from around 2,000 row groups,
+# on a 200,000 row file; 1,000 row groups still work).
+MAX_PARQUET_ROW_GROUPS = 512
+
+# The most shards of a dataset (see Dataset._shard_paths()) that are read at the same time
+MAX_SHARD_WORKERS = 8
+
+# The file in a partitioned dataset directory that lists its partitions (see ProcessedDataset.write_to_partitions())
+PARTITIONING_FILE = "_partitioning.json"
+
+# The compressions that write_to_feather() can use. Feather files compressed with lz4 or zstd are smaller
+# but cannot be memory-mapped.
+FEATHER_COMPRESSIONS = ["uncompressed", "lz4", "zstd"]
+
+# The compressions that write_to_parquet() can use
+PARQUET_COMPRESSIONS = ["uncompressed", "snappy", "gzip", "lz4", "zstd"]
+
+# The columns data is sorted by before writing, when asked to sort. Columns that are missing are skipped.
+WRITE_SORT_COLUMNS = ["nhs_number", "code", "date"]
+
+# The summary of a written dataset (see Dataset.write_summary()) is written next to it, with this added to the path
+SUMMARY_SUFFIX = ".summary.json"
+
+
+def decode_compact(data: pl.DataFrame) -> pl.DataFrame:
+    """
+    Converts the categorical columns of compact data (see Dataset.compact()) back to strings. This
+    is used when the data is combined with data that has not been compacted, such as reports and files.
+
+    Args:
+        data (pl.DataFrame): The data.
+
+    Returns:
+        pl.DataFrame: The data with any categorical columns as strings.
+    """
+    categorical_cols = [col for col, dtype in data.schema.items() if dtype == pl.Categorical]
+    if not categorical_cols:
+        return data
+    return data.with_columns([pl.col(col).cast(pl.Utf8) for col in categorical_cols])
+
+
+def match_join_key_types(left: pl.DataFrame, right: pl.DataFrame, on: str) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Makes the join column the same type on both sides of a join. If one side has been compacted and the
+    other has not, the string side is cast to a categorical so the join runs on the compact keys.
+
+    Args:
+        left (pl.DataFrame): The left side of the join.
+        right (pl.DataFrame): The right side of the join.
+        on (str): The column to join on.
+
+    Returns:
+        Tuple[pl.DataFrame, pl.DataFrame]: The left and right sides of the join.
+    """
+    left_type, right_type = left.schema[on], right.schema[on]
+    if left_type == pl.Categorical and right_type == pl.Utf8:
+        right = right.with_columns(pl.col(on).cast(pl.Categorical))
+    elif left_type == pl.Utf8 and right_type == pl.Categorical:
+        left = left.with_columns(pl.col(on).cast(pl.Categorical))
+    return left, right
 
 
 class Dataset():
-    def __init__(self, path, dataset_type: DatasetType, coding_system: CodelistType) -> None:
+    # If True, the shards of a sharded dataset are kept after they are combined, so later steps can be
+    # run on each shard at the same time
+    KEEP_SHARDS = False
+
+    def __init__(self, path, dataset_type: DatasetType, coding_system: CodelistType, lazy: bool = False,
+                 columns: Optional[List[str]] = None, persist_schema: bool = False, memory_map: bool = True,
+                 max_workers: int = MAX_SHARD_WORKERS) -> None:
         self.dataset_type = dataset_type
         self.coding_system = coding_system
         self.path = path
         self.log = []
-        self.data = self._load_data(path)
-        
+        # A record of each step run on the dataset, with its timing, row counts and memory (see tretools.utility.step_log)
+        self.steps = []
+        # If columns are given, only these columns are read from the file
+        self.columns = columns
+        # If True, the schema inferred for a delimited file is saved next to it so it is
+        # not inferred again the next time the file is loaded
+        self.persist_schema = persist_schema
+        # If the path is a directory partitioned by code prefix, this holds its partitions
+        self.partitioning = self._read_partitioning(path) if isinstance(path, str) and os.path.isdir(path) else None
+        # The shards the data was combined from, and the combined data, if the shards are kept (see KEEP_SHARDS)
+        self.shards = None
+        self.shard_data = None
+        # The index of the distinct codes, built when the EventCounter first prefix matches codes in the dataset
+        self.code_index = None
+        # In lazy mode the file is only scanned, and self.data is a polars LazyFrame that
+        # is read from disk when it is collected.
+        shard_paths = self._shard_paths(path)
+        if shard_paths is not None:
+            self.data = self._load_shards(shard_paths, lazy=lazy, columns=columns, persist_schema=persist_schema,
+                                          memory_map=memory_map, max_workers=max_workers)
+        elif lazy:
+            self.data = self._scan_data(path, columns=columns, persist_schema=persist_schema, memory_map=memory_map)
+        else:
+            self.data = self._load_data(path, columns=columns, persist_schema=persist_schema, memory_map=memory_map)
+
+    @classmethod
+    def from_dataframe(cls, data: pl.DataFrame, dataset_type: DatasetType, coding_system: CodelistType,
+                       path: Optional[str] = None, log: Optional[List[str]] = None) -> Dataset:
+        """
+        Creates a dataset from a polars DataFrame that is already in memory. Nothing is read
+        from disk, so this is used when one dataset is derived from another.
+
+        Args:
+            data (pl.DataFrame): The data for the dataset.
+            dataset_type (DatasetType): The type of the dataset.
+            coding_system (CodelistType): The coding system of the dataset.
+            path (str, optional): The path of the file the data originally came from. Defaults to None.
+            log (List[str], optional): The log to carry over to the new dataset. Defaults to None.
+
+        Returns:
+            Dataset: A new dataset (of the class this is called on) holding the data.
+        """
+        # Bypass __init__ as that loads the data from the path
+        dataset = cls.__new__(cls)
+        dataset.dataset_type = dataset_type
+        dataset.coding_system = coding_system
+        dataset.path = path
+        dataset.log = log if log is not None else []
+        dataset.steps = []
+        dataset.columns = None
+        dataset.persist_schema = False
+        dataset.partitioning = None
+        dataset.shards = None
+        dataset.shard_data = None
+        dataset.code_index = None
+        dataset.data = data
+        return dataset
+
+    @staticmethod
+    def _shard_paths(path) -> Optional[List[str]]:
+        """
+        Gets the files of a dataset that is split into shards, such as monthly extracts. The shards are
+        given as a list of paths, or as a glob pattern like "gp_extract_*.csv".
+
+        Args:
+            path (str | List[str]): The path, glob pattern or list of paths.
+
+        Returns:
+            List[str]: The paths to the shards, or None if the path is a single file.
+        """
+        if isinstance(path, (list, tuple)):
+            return list(path)
+        if any(char in path for char in "*?["):
+            return sorted(glob.glob(path))
+        return None
+
+    def _load_shard(self, path: str, lazy: bool = False, columns: Optional[List[str]] = None,
+                    persist_schema: bool = False, memory_map: bool = True) -> Dataset:
+        """
+        Loads one shard of a sharded dataset as a dataset of its own.
+
+        Args:
+            path (str): The path to the shard.
+            lazy (bool, optional): If True, the shard is scanned rather than read. Defaults to False.
+            columns (List[str], optional): The columns to read. Defaults to None, which reads all columns.
+            persist_schema (bool, optional): If True, save the inferred schema next to the shard. Defaults to False.
+            memory_map (bool, optional): If True, an uncompressed feather shard is memory-mapped. Defaults to True.
+
+        Returns:
+            Dataset: The shard.
+        """
+        return Dataset(path, self.dataset_type, self.coding_system, lazy=lazy, columns=columns,
+                       persist_schema=persist_schema, memory_map=memory_map)
+
+    def _load_shards(self, paths: List[str], lazy: bool = False, columns: Optional[List[str]] = None,
+                     persist_schema: bool = False, memory_map: bool = True,
+                     max_workers: int = MAX_SHARD_WORKERS) -> pl.DataFrame:
+        """
+        Loads the shards of a dataset at the same time in a pool of threads, then combines them. Each shard
+        is read as a dataset of its own (see _load_shard()), so the separator and schema are worked out for
+        each file, and its rows are counted in the same thread.
+
+        Args:
+            paths (List[str]): The paths to the shards.
+            lazy (bool, optional): If True, the shards are scanned rather than read. Defaults to False.
+            columns (List[str], optional): The columns to read. Defaults to None, which reads all columns.
+            persist_schema (bool, optional): If True, save the inferred schema next to each shard. Defaults to False.
+            memory_map (bool, optional): If True, uncompressed feather shards are memory-mapped. Defaults to True.
+            max_workers (int, optional): The most shards that are read at the same time. Defaults to MAX_SHARD_WORKERS.
+
+        Returns:
+            polars.DataFrame | polars.LazyFrame: The combined data.
+
+        Raises:
+            DatasetPathNotCorrect: If there are no shards.
+        """
+        if not paths:
+            raise DatasetPathNotCorrect(f"No files found for Dataset: {self.path}")
+
+        def load_shard(path: str) -> Dataset:
+            shard = self._load_shard(path, lazy=lazy, columns=columns, persist_schema=persist_schema, memory_map=memory_map)
+            shard.log.append(f"{datetime.now()}: Shard {shard.path} has {shard._count_rows()} rows")
+            return shard
+
+        # polars releases the GIL while it parses, so the shards are read in parallel
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            shards = list(executor.map(load_shard, paths))
+
+        for shard in shards:
+            self.log.extend(shard.log)
+            self.steps.extend(shard.steps)
+
+        # A column can be read as a different type in different shards, so cast to a common type. Kept shards
+        # are not copied into one block, so the combined data shares their memory.
+        data = pl.concat([shard.data for shard in shards], how="vertical_relaxed", rechunk=not self.KEEP_SHARDS)
+        if self.KEEP_SHARDS:
+            self.shards = shards
+            self.shard_data = data
+            self.max_workers = max_workers
+        if lazy:
+            self.log.append(f"{datetime.now()}: Scanned {len(shards)} shards lazily as one dataset")
+        else:
+            self.log.append(f"{datetime.now()}: Combined {len(shards)} shards into one dataset with {data.shape[0]} rows")
+        return data
 
     @staticmethod
     def _check_path(path: str) -> bool:
@@ -35,72 +276,786 @@ class Dataset():
         """
         return os.path.exists(path)
     
-    def _load_data(self, path: str) -> pl.DataFrame:
+    @staticmethod
+    def _compression(path: str) -> Optional[str]:
+        """
+        Gets the compression of a file from its extension.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            str: The compression ("gzip" or "zstd"), or None if the file is not compressed.
+        """
+        extension = os.path.splitext(path)[1]
+        return COMPRESSION_EXTENSIONS.get(extension)
+
+    @classmethod
+    def _uncompressed_path(cls, path: str) -> str:
+        """
+        Gets the path of a file without its compression extension, so the type of file can be told from the
+        extension that is left.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            str: The path without the compression extension.
+        """
+        return os.path.splitext(path)[0] if cls._compression(path) else path
+
+    @classmethod
+    def _open_decompressed(cls, path: str) -> BinaryIO:
+        """
+        Opens a file for reading, decompressing it as it is read if it is compressed. Nothing is
+        decompressed to disk.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            BinaryIO: The open file.
+
+        Raises:
+            UnsupportedFileType: If the file is zstd compressed and the zstandard package is not installed.
+        """
+        compression = cls._compression(path)
+        if compression == "gzip":
+            return gzip.open(path, "rb")
+        if compression == "zstd":
+            zstandard = cls._import_zstandard()
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+        return open(path, "rb")
+
+    @staticmethod
+    def _import_zstandard():
+        """
+        Imports the zstandard package, which is only needed for .zst files.
+
+        Returns:
+            module: The zstandard package.
+
+        Raises:
+            UnsupportedFileType: If the zstandard package is not installed.
+        """
+        try:
+            import zstandard
+        except ImportError:
+            raise UnsupportedFileType("Reading or writing .zst files needs the zstandard package. Install it with: pip install zstandard")
+        return zstandard
+
+    @classmethod
+    def _read_csv(cls, path: str, **kwargs) -> pl.DataFrame:
+        """
+        Reads a delimited file with polars. polars decompresses gzip files itself. zstd files are
+        decompressed in memory first.
+
+        Args:
+            path (str): The path to the file.
+            **kwargs: The arguments to pass to polars.read_csv.
+
+        Returns:
+            polars.DataFrame: The data.
+        """
+        if cls._compression(path) == "zstd":
+            with cls._open_decompressed(path) as file:
+                return pl.read_csv(file.read(), **kwargs)
+        return pl.read_csv(path, **kwargs)
+
+    @classmethod
+    def _read_csv_head(cls, path: str, n_rows: int, **kwargs) -> pl.DataFrame:
+        """
+        Reads the first rows of a delimited file. For a compressed file only the start of the file is
+        decompressed.
+
+        Args:
+            path (str): The path to the file.
+            n_rows (int): The number of rows to read.
+            **kwargs: The arguments to pass to polars.read_csv.
+
+        Returns:
+            polars.DataFrame: The first rows.
+        """
+        if cls._compression(path) is None:
+            return pl.read_csv(path, n_rows=n_rows, **kwargs)
+        with cls._open_decompressed(path) as file:
+            # The header and the first n_rows lines
+            head = b"".join(itertools.islice(file, n_rows + 1))
+        return pl.read_csv(head, **kwargs)
+
+    @classmethod
+    def _detect_separator(cls, path: str) -> str:
+        """
+        Determines the separator of a delimited file by inspecting the first line.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            str: The separator.
+        """
+        with cls._open_decompressed(path) as file:
+            first_line = file.readline().decode(errors="replace")
+            if '|' in first_line:
+                return '|'
+            elif ',' in first_line:
+                return ','
+            elif '\t' in first_line:
+                return '\t'
+            else:
+                raise Exception("Unable to determine the file separator.")
+
+    @classmethod
+    def _get_separator(cls, path: str) -> str:
+        """
+        Gets the separator of a delimited file from its extension, or by inspecting the
+        first line if the extension does not say. Compressed files (e.g. .csv.gz) go by the
+        extension before the compression extension.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            str: The separator.
+
+        Raises:
+            UnsupportedFileType: If the file is not a delimited file.
+        """
+        uncompressed_path = cls._uncompressed_path(path)
+        if uncompressed_path.endswith(".tab"):
+            return "\t"
+        elif uncompressed_path.endswith(".txt") or uncompressed_path.endswith(".tsv") or uncompressed_path.endswith(".csv"):
+            return cls._detect_separator(path)
+        else:
+            raise UnsupportedFileType("File type not supported. File type not supported. Must be either .csv, .txt, .arrow or .parquet")
+
+    @staticmethod
+    def _read_partitioning(path: str) -> Dict:
+        """
+        Reads the partitions of a dataset directory that is partitioned by code prefix.
+
+        Args:
+            path (str): The path to the directory.
+
+        Returns:
+            Dict: The length of the code prefix and the file and number of rows of each partition.
+
+        Raises:
+            DatasetPathNotCorrect: If the directory is not a partitioned dataset.
+        """
+        partitioning_path = os.path.join(path, PARTITIONING_FILE)
+        if not os.path.isfile(partitioning_path):
+            raise DatasetPathNotCorrect(f"Directory {path} is not a partitioned dataset as it has no {PARTITIONING_FILE} file")
+        with open(partitioning_path, "r") as f:
+            return json.load(f)
+
+    def _partition_files(self, prefixes: Optional[List[str]] = None) -> List[str]:
+        """
+        Gets the files of the partitions of a partitioned dataset.
+
+        Args:
+            prefixes (List[str], optional): The code prefixes to get the files for. Prefixes with no partition
+                are skipped. Defaults to None, which gets every partition.
+
+        Returns:
+            List[str]: The paths to the files.
+        """
+        partitions = self.partitioning["partitions"]
+        if prefixes is None:
+            prefixes = partitions.keys()
+        return [os.path.join(self.path, partitions[prefix]["file"]) for prefix in sorted(set(prefixes)) if prefix in partitions]
+
+    def _scan_partitions(self, files: List[str]) -> pl.LazyFrame:
+        """
+        Scans the files of some of the partitions of a partitioned dataset.
+
+        Args:
+            files (List[str]): The paths to the files.
+
+        Returns:
+            polars.LazyFrame: The query plan that reads the data. If there are no files, this has the
+                columns of the dataset and no rows.
+        """
+        if not files:
+            return pl.scan_parquet(os.path.join(self.path, self.partitioning["empty_file"]), hive_partitioning=False)
+        # The code prefix is in the directory names, but is not added as a column
+        return pl.scan_parquet(files, hive_partitioning=False)
+
+    def _scan_codes(self, codes: List) -> pl.LazyFrame:
+        """
+        Scans the rows that can have one of the codes. For a partitioned dataset, only the partitions that
+        the codes fall in are scanned. Otherwise this is the whole of the lazy data.
+
+        Args:
+            codes (List): The codes.
+
+        Returns:
+            polars.LazyFrame: The query plan that reads the data.
+        """
+        if self.partitioning is None:
+            return self.data
+        prefix_length = self.partitioning["prefix_length"]
+        return self._scan_partitions(self._partition_files([str(code)[:prefix_length] for code in codes]))
+
+    @staticmethod
+    def _schema_path(path: str) -> str:
+        """
+        Gets the path of the sidecar file that holds the inferred schema of a file.
+
+        Args:
+            path (str): The path to the data file.
+
+        Returns:
+            str: The path to the schema file.
+        """
+        return f"{path}.schema.json"
+
+    @classmethod
+    def _read_persisted_schema(cls, path: str) -> Optional[Dict]:
+        """
+        Reads the schema saved next to a file. The schema is only used if the file has not
+        changed since the schema was saved.
+
+        Args:
+            path (str): The path to the data file.
+
+        Returns:
+            Dict: The saved schema, or None if there is no schema for the current version of the file.
+        """
+        schema_path = cls._schema_path(path)
+        if not os.path.exists(schema_path):
+            return None
+        try:
+            with open(schema_path) as f:
+                schema = json.load(f)
+        except (OSError, ValueError):
+            return None
+        stat = os.stat(path)
+        if schema.get("size") != stat.st_size or schema.get("mtime_ns") != stat.st_mtime_ns:
+            return None
+        return schema
+
+    @classmethod
+    def _sniff_schema(cls, path: str, separator: str, columns: Optional[List[str]] = None) -> Dict:
+        """
+        Works out the type of each column from a sample of the rows. The sample is read with every
+        column as a string, and each column is given the narrowest type that all of its values match.
+        Columns with integer values in scientific notation (e.g. 882784691000119e3) are marked so they
+        can be read as floats and cast to integers.
+
+        Args:
+            path (str): The path to the file.
+            separator (str): The separator of the file.
+            columns (List[str], optional): The columns to infer the types of. Defaults to None, which is all columns.
+
+        Returns:
+            Dict: The type of each column and the columns in scientific notation.
+        """
+        sample = cls._read_csv_head(path, SCHEMA_SAMPLE_ROWS, separator=separator, null_values=NULL_VALUES,
+                                    infer_schema_length=0, columns=columns)
+        checks = cls._schema_checks(sample)
+
+        dtypes, scientific_notation = {}, []
+        for col in sample.columns:
+            check = checks.get(col)
+            if check is None or not check["any"]:
+                dtypes[col] = "Utf8"
+            elif check["integer"]:
+                dtypes[col] = "Int64"
+            elif check["float"]:
+                dtypes[col] = "Float64"
+                # Scientific notation is read as integers if all the sampled values are whole numbers
+                if check["scientific_notation"] and check["whole_numbers"]:
+                    scientific_notation.append(col)
+            elif check["boolean"]:
+                dtypes[col] = "Boolean"
+            else:
+                dtypes[col] = "Utf8"
+        return {"dtypes": dtypes, "scientific_notation": scientific_notation}
+
+    @staticmethod
+    def _schema_checks(sample: pl.DataFrame) -> Dict[str, Dict[str, bool]]:
+        """
+        Checks the values of each column of a sample read as strings against the patterns of each type.
+
+        Args:
+            sample (pl.DataFrame): The sample, with every column as a string.
+
+        Returns:
+            Dict[str, Dict[str, bool]]: The checks of each column that has any rows.
+        """
+        # Check all the columns against all the patterns in one pass over the sample, by
+        # stacking the columns into a single column of values
+        values = pl.col("value")
+        floats = values.cast(pl.Float64, strict=False)
+        checks = sample.melt(value_vars=sample.columns).group_by("variable").agg(
+            values.is_not_null().any().alias("any"),
+            # Integers that are too big for an Int64 are not read as integers
+            ((values.is_null() | values.str.contains(INTEGER_PATTERN)).all()
+             & (values.cast(pl.Int64, strict=False).null_count() == values.null_count())).alias("integer"),
+            (values.is_null() | values.str.contains(FLOAT_PATTERN)).all().alias("float"),
+            values.str.contains(SCIENTIFIC_NOTATION_PATTERN).any().alias("scientific_notation"),
+            (floats.is_null() | (floats == floats.floor())).all().alias("whole_numbers"),
+            (values.is_null() | values.str.contains(BOOLEAN_PATTERN)).all().alias("boolean"),
+        )
+        return {row.pop("variable"): row for row in checks.iter_rows(named=True)}
+
+    def _infer_schema(self, path: str, separator: str, columns: Optional[List[str]] = None,
+                      persist_schema: bool = False) -> Dict:
+        """
+        Gets the schema of a delimited file. A schema saved next to the file is used if it is
+        still valid, otherwise the schema is inferred from a sample of the file.
+
+        Args:
+            path (str): The path to the file.
+            separator (str): The separator of the file.
+            columns (List[str], optional): The columns to read. Defaults to None, which is all columns.
+            persist_schema (bool, optional): If True, save the inferred schema next to the file. Defaults to False.
+
+        Returns:
+            Dict: The type of each column and the columns in scientific notation.
+        """
+        persisted = self._read_persisted_schema(path)
+        if persisted is not None:
+            # A schema inferred for some of the columns can only be reused for those columns
+            if columns is None and persisted["complete"]:
+                return persisted
+            if columns is not None and set(columns).issubset(persisted["dtypes"]):
+                return persisted
+
+        schema = self._sniff_schema(path, separator, columns)
+
+        if persist_schema:
+            schema = self._persist_schema(path, schema, columns, persisted)
+        return schema
+
+    def _persist_schema(self, path: str, schema: Dict, columns: Optional[List[str]] = None,
+                        persisted: Optional[Dict] = None) -> Dict:
+        """
+        Saves the schema of a delimited file next to it. A schema of some of the columns is added to
+        the schema already saved for the file.
+
+        Args:
+            path (str): The path to the file.
+            schema (Dict): The type of each column and the columns in scientific notation.
+            columns (List[str], optional): The columns the schema is of. Defaults to None, which is all columns.
+            persisted (Dict, optional): The schema already saved for the file. Defaults to None.
+
+        Returns:
+            Dict: The saved schema.
+        """
+        stat = os.stat(path)
+        if persisted is not None:
+            persisted["dtypes"].update(schema["dtypes"])
+            scientific_notation = set(persisted["scientific_notation"]) - set(schema["dtypes"])
+            schema = {"dtypes": persisted["dtypes"],
+                      "scientific_notation": sorted(scientific_notation | set(schema["scientific_notation"])),
+                      "complete": persisted["complete"] or columns is None}
+        else:
+            schema["complete"] = columns is None
+        schema.update({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+        with open(self._schema_path(path), "w") as f:
+            json.dump(schema, f, indent=4)
+        return schema
+
+    @staticmethod
+    def _schema_dtypes(schema: Dict, columns: Optional[List[str]] = None) -> Dict[str, pl.PolarsDataType]:
+        """
+        Gets the polars types to read the columns with. Columns in scientific notation are read
+        as floats, and cast to integers after reading.
+
+        Args:
+            schema (Dict): The schema of the file.
+            columns (List[str], optional): The columns to read. Defaults to None, which is all columns.
+
+        Returns:
+            Dict[str, pl.PolarsDataType]: The polars type of each column.
+        """
+        return {
+            col: getattr(pl, dtype)
+            for col, dtype in schema["dtypes"].items()
+            if columns is None or col in columns
+        }
+
+    @staticmethod
+    def _cast_scientific_notation(data, schema: Dict):
+        """
+        Casts the columns in scientific notation, which are read as floats, to integers.
+
+        Args:
+            data (pl.DataFrame | pl.LazyFrame): The data.
+            schema (Dict): The schema of the file.
+
+        Returns:
+            pl.DataFrame | pl.LazyFrame: The data with the columns cast.
+        """
+        cols = [col for col in schema["scientific_notation"] if col in data.columns]
+        if not cols:
+            return data
+        return data.with_columns([pl.col(col).cast(pl.Int64) for col in cols])
+
+    @staticmethod
+    def _cast_from_strings(data, schema: Dict):
+        """
+        Casts columns read as strings to the types of a schema. Values that do not fit the type, which can
+        only be in rows after the sample the schema was inferred from, become null rather than failing the
+        read. The columns in scientific notation are cast to floats and then to integers.
+
+        Args:
+            data (pl.DataFrame | pl.LazyFrame): The data, with every column as a string.
+            schema (Dict): The schema of the file.
+
+        Returns:
+            pl.DataFrame | pl.LazyFrame: The data with the columns cast.
+        """
+        casts = []
+        for col, dtype in schema["dtypes"].items():
+            if col not in data.columns or dtype == "Utf8":
+                continue
+            if dtype == "Boolean":
+                # Strings cannot be cast to booleans, so the values are matched instead
+                value = pl.col(col).str.to_lowercase()
+                casts.append(pl.when(value == "true").then(True).when(value == "false").then(False).alias(col))
+            elif col in schema["scientific_notation"]:
+                casts.append(pl.col(col).cast(pl.Float64, strict=False).cast(pl.Int64, strict=False))
+            else:
+                casts.append(pl.col(col).cast(getattr(pl, dtype), strict=False))
+        if not casts:
+            return data
+        return data.with_columns(casts)
+
+    @timed_step
+    def _load_data(self, path: str, columns: Optional[List[str]] = None, persist_schema: bool = False,
+                   memory_map: bool = True) -> pl.DataFrame:
         if not self._check_path(path):
             raise DatasetPathNotCorrect(f"Invalid path for Dataset: {path}")
         
-        null_values = ["", " ", "NULL", "NA", "               ", ".", "                    ", "-", "NOT CLOSE"]
+        # A partitioned dataset is read from all of its partitions
+        if os.path.isdir(path):
+            data = self._scan_partitions(self._partition_files()).collect()
+            self.log.append(f"{datetime.now()}: Loaded data from {len(self.partitioning['partitions'])} partition(s) in {path}")
+            return data
+
+        null_values = NULL_VALUES
         try:
-            # Attempt to read the data normally
-            data = self._read_file(path, null_values)
+            # Infer the schema from a sample, then parse the whole file once with that schema
+            schema = None
+            if not (path.endswith(".arrow") or path.endswith(".parquet")):
+                schema = self._infer_schema(path, self._get_separator(path), columns, persist_schema)
+            data = self._read_file(path, null_values, columns=columns, schema=schema, memory_map=memory_map)
         except pl.exceptions.ComputeError:
-            # If a ComputeError occurs, read the data with all columns as strings
-            data = self._read_file(path, null_values, infer_schema_length=0)
+            # If rows after the sample do not fit the schema, read the data with all columns as strings
+            data = self._read_file(path, null_values, infer_schema_length=0, columns=columns)
             # Convert columns with scientific notation to int
             data = self._convert_scientific_notation_columns(data)
+            # The saved schema does not fit the file either, so save the types the data was read with
+            # instead, or every later load would fail with it and read the file twice
+            if persist_schema:
+                self._persist_schema(path, self._schema_of_fallback(data), columns, self._read_persisted_schema(path))
+                self.log.append(f"{datetime.now()}: Rows after the sample did not fit the schema, so the schema saved for {path} was replaced")
 
         return data
     
+    @staticmethod
+    def _schema_of_fallback(data: pl.DataFrame) -> Dict:
+        """
+        Gets the schema that reads a file into the same data as the fallback of _load_data(). The columns
+        that were converted to integers are read as floats and cast, as they may be in scientific notation.
+
+        Args:
+            data (pl.DataFrame): The data read by the fallback.
+
+        Returns:
+            Dict: The type of each column and the columns in scientific notation.
+        """
+        converted = [col for col, dtype in data.schema.items() if dtype == pl.Int64]
+        dtypes = {col: "Float64" if col in converted else "Utf8" for col in data.columns}
+        return {"dtypes": dtypes, "scientific_notation": converted}
+
     def _convert_scientific_notation_columns(self, df: pl.DataFrame) -> pl.DataFrame:
-        # Function to convert columns with scientific notation
-        for col in df.columns:
-            if df[col].dtype == pl.Utf8:
-                try:
-                    # Try converting to int, if fails, keep as is
-                    df = df.with_columns(df[col].cast(pl.Float64).cast(pl.Int64).alias(col))
-                except pl.exceptions.ComputeError:
-                    continue
-        return df
-
-    def _read_file(self, path: str, null_values: List, infer_schema_length = None ) -> pl.DataFrame:
+        # Function to convert columns with scientific notation. A column is converted to int
+        # if all its values can be read as numbers, otherwise it is kept as is.
+        string_cols = [col for col in df.columns if df[col].dtype == pl.Utf8]
+        if not string_cols:
+            return df
+        numeric = df.select([
+            (pl.col(col).cast(pl.Float64, strict=False).null_count() == pl.col(col).null_count()).alias(col)
+            for col in string_cols
+        ]).row(0, named=True)
+        return df.with_columns([
+            pl.col(col).cast(pl.Float64).cast(pl.Int64) for col in string_cols if numeric[col]
+        ])
+
+    def _read_file(self, path: str, null_values: List, infer_schema_length = None, columns: Optional[List[str]] = None,
+                   schema: Optional[Dict] = None, memory_map: bool = True) -> pl.DataFrame:
         """
         Load the data using polars from a csv file.
 
         Args:
             path (str): The path to the csv file.
+            columns (List[str], optional): The columns to read. Other columns are skipped by the
+                reader and never parsed. Defaults to None, which reads all columns.
+            schema (Dict, optional): The schema to read a delimited file with, so polars does not have to
+                infer it. Defaults to None.
+            memory_map (bool, optional): If True, an uncompressed feather file is memory-mapped rather than
+                copied into memory. Defaults to True.
 
         Returns:
             polars.DataFrame: The data.
         """
         # if feather file, load using polars
         if path.endswith(".arrow"):
-            data = pl.read_ipc(path)
-            self.log.append(f"{datetime.now()}: Loaded data from {path}")
+            if memory_map:
+                # The chunks are kept as they are in the file, as joining them up would copy the data
+                data = pl.read_ipc(path, columns=columns, memory_map=True, rechunk=False)
+                self.log.append(f"{datetime.now()}: Loaded data from {path} using a memory map")
+            else:
+                data = pl.read_ipc(path, columns=columns, memory_map=False)
+                self.log.append(f"{datetime.now()}: Loaded data from {path}")
             return data
-        # if tab file, load using polars
-        elif path.endswith(".tab"):
-            separator = "\t"
-            data = pl.read_csv(path, separator=separator, null_values=null_values, infer_schema_length=infer_schema_length)
-            self.log.append(f"{datetime.now()}: Loaded data from {path} using separator '{separator}' with these values as null: {null_values}")
+        # if parquet file, the types are stored in the file
+        if path.endswith(".parquet"):
+            data = pl.read_parquet(path, columns=columns, memory_map=memory_map)
+            self.log.append(f"{datetime.now()}: Loaded data from {path}")
             return data
-        # if txt file, separator is "|" or ","
+        # if tab file, separator is tab
         # if txt file, determine separator by inspecting the first line
-        elif path.endswith(".txt") or path.endswith(".tsv") or path.endswith(".csv"):
-            with open(path, 'r') as file:
-                first_line = file.readline()
-                if '|' in first_line:
-                    separator = '|'
-                elif ',' in first_line:
-                    separator = ','
-                elif '\t' in first_line:
-                    separator = '\t'
-                else:
-                    raise Exception("Unable to determine the file separator.")
-            data = pl.read_csv(path, separator=separator, null_values=null_values, infer_schema_length=infer_schema_length)
-            self.log.append(f"{datetime.now()}: Loaded data from {path} using separator '{separator}' with these values as null: {null_values}")
-            return data
+        separator = self._get_separator(path)
+        if schema is not None:
+            data = self._read_csv(path, separator=separator, null_values=null_values, infer_schema_length=0, columns=columns,
+                                  dtypes=self._schema_dtypes(schema, columns))
+            data = self._cast_scientific_notation(data, schema)
         else:
-            raise UnsupportedFileType("File type not supported. File type not supported. Must be either .csv, .txt or .arrow")
+            data = self._read_csv(path, separator=separator, null_values=null_values, infer_schema_length=infer_schema_length, columns=columns)
+        self.log.append(f"{datetime.now()}: Loaded data from {path} using separator '{separator}' with these values as null: {null_values}")
+        return data
+
+    @timed_step
+    def _scan_data(self, path: str, columns: Optional[List[str]] = None, persist_schema: bool = False,
+                   memory_map: bool = True) -> pl.LazyFrame:
+        """
+        Scans the data lazily so the reading of the file becomes part of a query plan.
+
+        Args:
+            path (str): The path to the file.
+            columns (List[str], optional): The columns to read. Defaults to None, which reads all columns.
+            persist_schema (bool, optional): If True, save the inferred schema next to the file. Defaults to False.
+            memory_map (bool, optional): If True, an uncompressed feather file is memory-mapped. Defaults to True.
+
+        Returns:
+            polars.LazyFrame: The query plan that reads the data.
+        """
+        if not self._check_path(path):
+            raise DatasetPathNotCorrect(f"Invalid path for Dataset: {path}")
+
+        if os.path.isdir(path):
+            data = self._scan_partitions(self._partition_files())
+            self.log.append(f"{datetime.now()}: Scanned data lazily from {len(self.partitioning['partitions'])} partition(s) in {path}")
+            if columns is not None:
+                data = data.select(columns)
+            return data
+
+        if path.endswith(".arrow") or path.endswith(".parquet"):
+            if path.endswith(".arrow"):
+                data = pl.scan_ipc(path, memory_map=memory_map, rechunk=not memory_map)
+            else:
+                # Filters on the scan are checked against the statistics of each row group, so
+                # row groups that cannot match are not read
+                data = pl.scan_parquet(path)
+            self.log.append(f"{datetime.now()}: Scanned data lazily from {path}")
+            if columns is not None:
+                data = data.select(columns)
+            return data
+
+        # polars cannot scan a compressed file, so it is read instead. Use process_dataset_in_batches()
+        # to process a compressed file that does not fit in memory.
+        if self._compression(path) is not None:
+            data = self._load_data(path, columns=columns, persist_schema=persist_schema)
+            self.log.append(f"{datetime.now()}: {path} is compressed so it cannot be scanned lazily, and was read instead")
+            return data.lazy()
+
+        # The file is scanned as strings and cast to the types of the sample in the query plan, so a row
+        # after the sample that does not fit cannot make the query fail when it is collected
+        separator = self._get_separator(path)
+        schema = self._infer_schema(path, separator, columns, persist_schema)
+        data = pl.scan_csv(path, separator=separator, null_values=NULL_VALUES, infer_schema_length=0)
+        self.log.append(f"{datetime.now()}: Scanned data lazily from {path} using separator '{separator}' with these values as null: {NULL_VALUES}")
+        if columns is not None:
+            data = data.select(columns)
+        return self._cast_from_strings(data, schema)
+
+    def _iter_batches(self, batch_size: int) -> Iterator[pl.DataFrame]:
+        """
+        Reads the file in batches so that it never has to be held in memory in full.
+
+        Args:
+            batch_size (int): The number of rows per batch.
+
+        Yields:
+            polars.DataFrame: The next batch of rows.
+        """
+        # The shards of a sharded dataset are read one after the other
+        for path in self._shard_paths(self.path) or [self.path]:
+            if not self._check_path(path):
+                raise DatasetPathNotCorrect(f"Invalid path for Dataset: {path}")
+
+            if path.endswith(".arrow") or path.endswith(".parquet"):
+                scan = pl.scan_ipc if path.endswith(".arrow") else pl.scan_parquet
+                num_rows = scan(path).select(pl.count()).collect().item()
+                for offset in range(0, num_rows, batch_size):
+                    batch = scan(path).slice(offset, batch_size)
+                    if self.columns is not None:
+                        batch = batch.select(self.columns)
+                    yield batch.collect()
+                continue
+
+            # Every batch is cast to the same schema, so the batches can be concatenated
+            separator = self._get_separator(path)
+            schema = self._infer_schema(path, separator, self.columns, self.persist_schema)
+            for batch in self._iter_csv_batches(path, batch_size, separator, self.columns):
+                yield self._cast_from_strings(batch, schema)
+
+    @classmethod
+    def _iter_csv_batches(cls, path: str, batch_size: int, separator: str,
+                          columns: Optional[List[str]] = None) -> Iterator[pl.DataFrame]:
+        """
+        Reads a delimited file in batches, with every column as a string. A compressed file is decompressed as it is read, a batch
+        of lines at a time, so neither the whole file nor a decompressed copy of it is ever held.
+
+        Args:
+            path (str): The path to the file.
+            batch_size (int): The number of rows per batch.
+            separator (str): The separator of the file.
+            columns (List[str], optional): The columns to read. Defaults to None, which reads all columns.
+
+        Yields:
+            polars.DataFrame: The next batch of rows.
+        """
+        if cls._compression(path) is None:
+            reader = pl.read_csv_batched(path, separator=separator, null_values=NULL_VALUES, batch_size=batch_size,
+                                         columns=columns, infer_schema_length=0)
+            batches = reader.next_batches(1)
+            while batches:
+                yield batches[0]
+                batches = reader.next_batches(1)
+            return
+
+        with cls._open_decompressed(path) as file:
+            header = file.readline()
+            while True:
+                lines = list(itertools.islice(file, batch_size))
+                # A quoted value can hold a line break, so a batch that ends inside quotes (with an odd number
+                # of quote characters, as an escaped quote is written twice) is carried on to the end of the value
+                quotes = sum(line.count(b'"') for line in lines)
+                while quotes % 2 == 1:
+                    line = file.readline()
+                    if not line:
+                        break
+                    lines.append(line)
+                    quotes += line.count(b'"')
+                lines = b"".join(lines)
+                if not lines.strip():
+                    return
+                yield pl.read_csv(header + lines, separator=separator, null_values=NULL_VALUES, columns=columns,
+                                  infer_schema_length=0)
+
+    def _is_lazy(self) -> bool:
+        """
+        Checks whether the data is a LazyFrame that has not been collected yet.
+
+        Returns:
+            bool: True if the data is lazy, False otherwise.
+        """
+        return isinstance(self.data, pl.LazyFrame)
+
+    def _collect(self) -> pl.DataFrame:
+        """
+        Gets the data as a DataFrame. Lazy data is read in full, so this is used by the steps that need
+        every row, such as deduplicating or writing the data.
+
+        Returns:
+            polars.DataFrame: The data.
+        """
+        return self.data.collect() if self._is_lazy() else self.data
+
+    def _count_rows(self) -> int:
+        """
+        Counts the rows in the data. For lazy data only the count is computed, the
+        data itself is not collected.
+
+        Returns:
+            int: The number of rows.
+        """
+        if self._is_lazy():
+            # The rows in each partition of a partitioned dataset are stored with its partitions
+            if self.partitioning is not None:
+                return sum(partition["rows"] for partition in self.partitioning["partitions"].values())
+            return self.data.select(pl.count()).collect().item()
+        return self.data.shape[0]
+
+    def _shape(self) -> tuple:
+        """
+        Gets the shape of the data, for both eager and lazy data.
+
+        Returns:
+            tuple: The number of rows and columns.
+        """
+        return (self._count_rows(), len(self.data.columns))
+
+    def _date_value(self, date: str):
+        """
+        Gets a date string in the form YYYY-MM-DD as a value that can be compared with the date
+        column. This is a date if the date column holds dates, and the string otherwise.
+
+        Args:
+            date (str): The date, as YYYY-MM-DD.
+
+        Returns:
+            datetime.date | str: The date to compare with.
+        """
+        if self.data.schema["date"] == pl.Date:
+            return datetime.strptime(date, "%Y-%m-%d").date()
+        return date
+
+    def compact(self) -> None:
+        """
+        Stores the data in a compact form, which uses less memory and makes joins, deduplication and
+        sorting faster. The nhs_number and code columns are stored as categoricals, so each distinct value
+        is only stored once and each row holds a small integer key for it. The date column is stored as a
+        date. Categoricals sort in the same order as the strings they hold.
+
+        Compact columns from different datasets can only be joined and merged if their categoricals share
+        a string cache. Datasets are compacted one at a time and joined later, so a cache scoped to this
+        method (pl.StringCache()) would not be shared. Instead, this turns on the polars global string cache
+        for the rest of the process, if it is not on already. All categoricals created after that, including
+        ones outside tretools, then use the global cache. The values are decoded back to strings when reports
+        are written, or with decode_compact().
+        """
+        if not pl.using_string_cache():
+            pl.enable_string_cache()
+            self.log.append(f"{datetime.now()}: Turned on the polars global string cache, so compact datasets can be joined")
+
+        size_before = None if self._is_lazy() else self.data.estimated_size("mb")
+        schema = self.data.schema
+        compacted = []
+        for col in ["nhs_number", "code"]:
+            if schema.get(col) == pl.Utf8:
+                self.data = self.data.with_columns(pl.col(col).cast(pl.Categorical).cat.set_ordering("lexical"))
+                compacted.append(f"{col} as a categorical")
+
+        if schema.get("date") == pl.Utf8:
+            if self._is_lazy():
+                date_converted = pl.col("date").str.strptime(pl.Date, "%Y-%m-%d", strict=False)
+            else:
+                # Each distinct date is only parsed once
+                date_converted = map_distinct(self.data["date"], lambda dates: dates.str.strptime(pl.Date, "%Y-%m-%d", strict=False))
+            self.data = self.data.with_columns(date_converted)
+            compacted.append("date as a date")
+
+        message = f"Data compacted, storing {', '.join(compacted) if compacted else 'no columns'}"
+        if size_before is not None:
+            message += f". Estimated size went from {size_before:.2f}MB to {self.data.estimated_size('mb'):.2f}MB"
+        self.log.append(f"{datetime.now()}: {message}")
 
     def _validate_column_names(self) -> bool:
         """
@@ -122,43 +1077,224 @@ class Dataset():
             return False
 
 
-    def write_to_log(self, path: str, overwrite_or_append: str = "overwrite") -> None:
+    def write_to_log(self, path: str, overwrite_or_append: str = "overwrite", include_steps: bool = False) -> None:
         """
         Write self.log to a log file.
 
         Args:
             path (str): The path to the log file.
             overwrite_or_append (str, optional): Whether to overwrite the log file or append to it. Defaults to "overwrite".
+            include_steps (bool, optional): If True, a line for each step in self.steps is written after the log.
+                Defaults to False, so the file can be read back as the log, as the cache does.
         """
+        lines = self.log
+        if include_steps:
+            lines = lines + [step.to_log_line() for step in self.steps]
         if overwrite_or_append == "overwrite":
             with open(path, "w") as f:
-                for line in self.log:
+                for line in lines:
                     f.write(line + "\n")
         elif overwrite_or_append == "append":
             with open(path, "a") as f:
-                for line in self.log:
+                for line in lines:
                     f.write(line + "\n")
         else:
             raise WriteOptionsInvalid("Invalid option for overwrite_or_append. Must be either 'overwrite' or 'append'")
 
-    def write_to_csv(self, path: str) -> None:
+    def _data_to_write(self, sort: bool = False) -> pl.DataFrame:
         """
-        Write data to a csv file.
+        Gets the data to write, collecting it if it is lazy.
+
+        Args:
+            sort (bool, optional): If True, the data is sorted by the columns in WRITE_SORT_COLUMNS that it has.
+                Sorted data compresses better and lets readers find the rows for a patient or code quickly.
+                Defaults to False.
+
+        Returns:
+            polars.DataFrame: The data.
+        """
+        data = self._collect()
+        if sort:
+            sort_columns = [column for column in WRITE_SORT_COLUMNS if column in data.columns]
+            if sort_columns:
+                data = data.sort(sort_columns)
+        return data
+
+    @timed_step
+    def write_to_csv(self, path: str, sort: bool = False, compression_level: Optional[int] = None,
+                     write_summary: bool = False) -> None:
+        """
+        Write data to a csv file. If the path ends in .gz or .zst, the file is compressed with gzip or zstd.
 
         Args:
             path (str): The path to the csv file.
+            sort (bool, optional): If True, the data is sorted by nhs_number, code and date before it is
+                written. Defaults to False.
+            compression_level (int, optional): The compression level, for a .gz or .zst file. Defaults to None,
+                which uses the default level of the compression.
+            write_summary (bool, optional): If True, a summary of the data is written next to the file
+                (see write_summary()). Defaults to False.
+
+        Raises:
+            WriteOptionsInvalid: If a compression level is given for a file that is not compressed.
         """
-        self.data.write_csv(path)
+        compression = self._compression(path)
+        if compression_level is not None and compression is None:
+            raise WriteOptionsInvalid("A compression level can only be given for a .gz or .zst file")
+
+        data = self._data_to_write(sort)
+        if compression == "gzip":
+            with gzip.open(path, "wb", compresslevel=9 if compression_level is None else compression_level) as f:
+                data.write_csv(f)
+        elif compression == "zstd":
+            zstandard = self._import_zstandard()
+            compressor = zstandard.ZstdCompressor(level=3 if compression_level is None else compression_level)
+            with open(path, "wb") as f, compressor.stream_writer(f) as writer:
+                data.write_csv(writer)
+        else:
+            data.write_csv(path)
         self.log.append(f"{datetime.now()}: Data written to {path}")
+        if write_summary:
+            self.write_summary(path, data)
 
-    def write_to_feather(self, path: str) -> None:
+    @timed_step
+    def write_to_feather(self, path: str, for_memory_map: bool = False, compression: str = "uncompressed",
+                         chunk_size: Optional[int] = None, sort: bool = False, write_summary: bool = False) -> None:
         """
-        Write data to a feather file. 
+        Write data to a feather file. The file is written next to the path and then moved into place,
+        so a dataset that is memory-mapped from the same path keeps reading the old file.
 
         Args:
             path (str): The path to the feather file.
+            for_memory_map (bool, optional): If True, the data is written uncompressed as a single contiguous
+                block per column. Loading the file then needs no copies, so several processes can share
+                one copy of the file in the page cache. Defaults to False.
+            compression (str, optional): The compression to use, one of FEATHER_COMPRESSIONS. lz4 is fast to
+                read and write; zstd makes smaller files. Compressed files cannot be memory-mapped.
+                Defaults to "uncompressed".
+            chunk_size (int, optional): The number of rows in each record batch of the file. Defaults to None,
+                which keeps the chunks the data has.
+            sort (bool, optional): If True, the data is sorted by nhs_number, code and date before it is
+                written. Defaults to False.
+            write_summary (bool, optional): If True, a summary of the data is written next to the file
+                (see write_summary()). Defaults to False.
+
+        Raises:
+            WriteOptionsInvalid: If the compression is not supported, the chunk size is not positive, or the file
+                is for a memory map but compressed or chunked.
         """
-        self.data.write_ipc(path)
-        self.log.append(f"{datetime.now()}: Data written to {path}")
+        if compression not in FEATHER_COMPRESSIONS:
+            raise WriteOptionsInvalid(f"Invalid compression for a feather file: {compression}. Must be one of {FEATHER_COMPRESSIONS}")
+        if chunk_size is not None and chunk_size < 1:
+            raise WriteOptionsInvalid(f"Invalid chunk size: {chunk_size}. Must be at least 1")
+        if for_memory_map and (compression != "uncompressed" or chunk_size is not None):
+            raise WriteOptionsInvalid("A feather file for a memory map must be uncompressed and written as a single chunk")
+
+        data = self._data_to_write(sort)
+        if for_memory_map:
+            data = data.rechunk()
+        elif chunk_size is not None:
+            # Each chunk of the data is written as one record batch
+            data = pl.concat([data.slice(offset, chunk_size) for offset in range(0, data.shape[0], chunk_size)] or [data],
+                             rechunk=False)
+
+        temp_path = f"{path}.tmp"
+        data.write_ipc(temp_path, compression=compression)
+        os.replace(temp_path, path)
+        self.log.append(f"{datetime.now()}: Data written to {path}" + ("" if compression == "uncompressed" else f" with {compression} compression"))
+        if write_summary:
+            self.write_summary(path, data)
+
+    @timed_step
+    def write_to_parquet(self, path: str, row_group_size: int = PARQUET_ROW_GROUP_SIZE, compression: str = "zstd",
+                         compression_level: Optional[int] = None, write_summary: bool = False) -> None:
+        """
+        Write data to a parquet file. The rows are sorted by code and the file is written with the
+        minimum and maximum of each column in each row group. A lazy scan of the file that filters
+        on code (as the EventCounter does) then only reads the row groups that can contain the codes.
+
+        Args:
+            path (str): The path to the parquet file.
+            row_group_size (int, optional): The number of rows in each row group. Smaller row groups let more
+                of the file be skipped, but add overhead. The row groups are made larger if the file would
+                have more than MAX_PARQUET_ROW_GROUPS of them. Defaults to PARQUET_ROW_GROUP_SIZE.
+            compression (str, optional): The compression to use, one of PARQUET_COMPRESSIONS. Defaults to "zstd".
+            compression_level (int, optional): The compression level, for gzip (0-10) or zstd (1-22).
+                Defaults to None, which uses the default level of the compression.
+            write_summary (bool, optional): If True, a summary of the data is written next to the file
+                (see write_summary()). Defaults to False.
+
+        Raises:
+            WriteOptionsInvalid: If the compression is not supported.
+        """
+        if compression not in PARQUET_COMPRESSIONS:
+            raise WriteOptionsInvalid(f"Invalid compression for a parquet file: {compression}. Must be one of {PARQUET_COMPRESSIONS}")
+
+        data = self._data_to_write()
+        row_group_size = max(row_group_size, math.ceil(data.shape[0] / MAX_PARQUET_ROW_GROUPS))
+        temp_path = f"{path}.tmp"
+        data.sort("code").write_parquet(temp_path, statistics=True, row_group_size=row_group_size, compression=compression,
+                                        compression_level=compression_level)
+        os.replace(temp_path, path)
+        self.log.append(f"{datetime.now()}: Data written to {path}, sorted by code in row groups of {row_group_size} rows")
+        if write_summary:
+            self.write_summary(path, data)
+
+    def write_summary(self, path: str, data: Optional[pl.DataFrame] = None) -> str:
+        """
+        Writes a summary of the data to a JSON file next to a written dataset: the number of rows, patients
+        and codes, and the first and last date. The summary can be read with read_summary() to answer
+        these questions without loading the data.
+
+        Args:
+            path (str): The path the dataset was written to. The summary is written to this path with
+                SUMMARY_SUFFIX added.
+            data (polars.DataFrame, optional): The data to summarise. Defaults to None, which uses self.data.
+
+        Returns:
+            str: The path of the summary.
+        """
+        data = self._data_to_write() if data is None else data
+        expressions = [pl.count().alias("rows")]
+        if "nhs_number" in data.columns:
+            expressions.append(pl.col("nhs_number").n_unique().alias("patients"))
+        if "code" in data.columns:
+            expressions.append(pl.col("code").n_unique().alias("codes"))
+        if "date" in data.columns:
+            expressions.append(pl.col("date").min().cast(pl.Utf8).alias("first_date"))
+            expressions.append(pl.col("date").max().cast(pl.Utf8).alias("last_date"))
+        summary = {
+            "dataset_type": self.dataset_type,
+            "coding_system": self.coding_system,
+            "columns": data.columns,
+            **data.select(expressions).row(0, named=True),
+            "written": datetime.now().isoformat(),
+        }
+
+        summary_path = f"{path}{SUMMARY_SUFFIX}"
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=4, default=str)
+        self.log.append(f"{datetime.now()}: Summary of {summary['rows']} rows written to {summary_path}")
+        return summary_path
+
+    @staticmethod
+    def read_summary(path: str) -> Dict:
+        """
+        Reads the summary written next to a dataset by write_summary(), without loading the data.
+
+        Args:
+            path (str): The path of the dataset.
+
+        Returns:
+            Dict: The summary.
+
+        Raises:
+            DatasetPathNotCorrect: If the dataset has no summary.
+        """
+        summary_path = f"{path}{SUMMARY_SUFFIX}"
+        if not os.path.isfile(summary_path):
+            raise DatasetPathNotCorrect(f"No summary found for Dataset: {path}")
+        with open(summary_path, "r") as f:
+            return json.load(f)
 
 
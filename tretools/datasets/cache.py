@@ -0,0 +1,241 @@
+"""
+This module contains the ProcessedDatasetCache class, which stores the results of processing raw datasets.
+
+Processing a raw extract means parsing the whole file, so it is slow for large extracts. The cache stores each
+processed dataset as a feather file with its log, keyed on the raw file and the options it was processed with.
+When the same raw file is processed again with the same options, the feather file is loaded instead.
+"""
+import hashlib
+import json
+import os
+
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from tretools.codelists.codelist_types import CodelistType
+from tretools.datasets.base import Dataset
+from tretools.datasets.dataset_enums.dataset_types import DatasetType
+from tretools.datasets.dataset_enums.deduplication_options import DeduplicationOptions
+from tretools.datasets.errors import DatasetPathNotCorrect
+from tretools.datasets.processed_dataset import ProcessedDataset
+from tretools.datasets.raw_dataset import RawDataset
+
+
+# The file in the cache directory that lists the cached datasets
+CACHE_INDEX_FILE = "cache_index.json"
+
+# The default most space the cached datasets can use, in megabytes
+DEFAULT_CACHE_SIZE_MB = 10240
+
+# Number of bytes read at a time when hashing the contents of a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# The version of tretools is part of every key, as a new version can process data differently
+with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "VERSION")) as f:
+    TRETOOLS_VERSION = f.read().strip()
+
+
+class ProcessedDatasetCache():
+    """
+    A cache of processed datasets on disk. Each entry is keyed on the raw file (its size and modification time,
+    or a hash of its contents) and the options it was processed with. When the cache is bigger than its size
+    limit, the entries that were used least recently are removed.
+    """
+    def __init__(self, cache_dir: str, max_size_mb: float = DEFAULT_CACHE_SIZE_MB, hash_contents: bool = False) -> None:
+        """
+        Opens a cache, creating the cache directory if it does not exist.
+
+        Args:
+            cache_dir (str): The directory to store the cached datasets in.
+            max_size_mb (float, optional): The most space the cached datasets can use, in megabytes.
+                Defaults to DEFAULT_CACHE_SIZE_MB.
+            hash_contents (bool, optional): If True, raw files are identified by a hash of their contents, so a file
+                that is copied or touched still matches. This reads the whole file. If False, the size and modification
+                time of the file are used. Defaults to False.
+        """
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        self.hash_contents = hash_contents
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    def _index_path(self) -> str:
+        return os.path.join(self.cache_dir, CACHE_INDEX_FILE)
+
+    def _load_index(self) -> Dict:
+        """
+        Loads the index of the cached datasets. Entries whose files are missing are dropped.
+
+        Returns:
+            Dict: The entries, keyed on the cache key.
+        """
+        if not os.path.isfile(self._index_path()):
+            return {}
+        with open(self._index_path(), "r") as f:
+            index = json.load(f)
+        return {key: entry for key, entry in index.items() if os.path.isfile(self._data_path(key))}
+
+    def _save_index(self) -> None:
+        # Write next to the index and move into place, so the index is never half written
+        temp_path = f"{self._index_path()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.index, f, indent=4)
+        os.replace(temp_path, self._index_path())
+
+    def _data_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.arrow")
+
+    def _log_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.log")
+
+    def _file_fingerprint(self, path: str) -> Dict:
+        """
+        Identifies the contents of a raw file.
+
+        Args:
+            path (str): The path to the raw file.
+
+        Returns:
+            Dict: The hash of the contents of the file, or its size and modification time.
+        """
+        if self.hash_contents:
+            file_hash = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    file_hash.update(chunk)
+            return {"sha256": file_hash.hexdigest()}
+        stat = os.stat(path)
+        return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _key(self, path, dataset_type: DatasetType, coding_system: CodelistType,
+             deduplication_options: List[DeduplicationOptions], column_maps: Optional[Dict[str, str]],
+             nhs_digital_subtype: Optional[str], config_path: Optional[str]) -> str:
+        """
+        Builds the cache key for a raw file and the options it is processed with.
+
+        Returns:
+            str: The key.
+        """
+        shard_paths = Dataset._shard_paths(path)
+        options = {
+            "file": self._file_fingerprint(path) if shard_paths is None else [self._file_fingerprint(shard) for shard in shard_paths],
+            "dataset_type": dataset_type,
+            "coding_system": coding_system,
+            "deduplication_options": list(deduplication_options),
+            "column_maps": column_maps,
+            "nhs_digital_subtype": nhs_digital_subtype,
+            "config_path": os.path.abspath(config_path) if config_path else None,
+            "tretools_version": TRETOOLS_VERSION,
+        }
+        return hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+    def process_dataset(self, path, dataset_type: DatasetType, coding_system: CodelistType,
+                        deduplication_options: List[DeduplicationOptions], column_maps: Dict[str, str] = None,
+                        nhs_digital_subtype: Optional[str] = None, config_path: Optional[str] = None,
+                        lazy: bool = False) -> ProcessedDataset:
+        """
+        Gets the processed dataset for a raw file. If the raw file has been processed with the same options
+        before, the processed dataset and its log are loaded from the cache and the raw file is not read.
+        Otherwise the raw file is processed as RawDataset.process_dataset() does, and the result is cached.
+
+        Args:
+            path (str | List[str]): The path to the raw file. A list of paths, or a glob pattern, is a raw dataset split
+                into shards (see RawDataset), and is cached as one dataset keyed on every shard.
+            dataset_type (DatasetType): The type of the dataset.
+            coding_system (CodelistType): The coding system of the dataset.
+            deduplication_options (List[str]): List containing columns to deduplicate on. Must include "nhs_number" and "code".
+            column_maps (Dict[str, str], optional): A dictionary of column names to be renamed. Defaults to None.
+            nhs_digital_subtype (str, optional): The NHS Digital subtype, if this is an NHS Digital dataset. Defaults to None.
+            config_path (str, optional): A config to use instead of the default config for the subtype. Defaults to None.
+            lazy (bool, optional): If True, the raw file is scanned rather than read when it is processed (see RawDataset).
+                Defaults to False.
+
+        Returns:
+            ProcessedDataset: The processed dataset.
+
+        Raises:
+            DatasetPathNotCorrect: If the raw file, or any of the shards, does not exist.
+        """
+        shard_paths = Dataset._shard_paths(path)
+        raw_paths = [path] if shard_paths is None else shard_paths
+        if not raw_paths:
+            raise DatasetPathNotCorrect(f"No files found for Dataset: {path}")
+        for raw_path in raw_paths:
+            if not os.path.isfile(raw_path):
+                raise DatasetPathNotCorrect(f"Invalid path for Dataset: {raw_path}")
+
+        key = self._key(path, dataset_type, coding_system, deduplication_options, column_maps, nhs_digital_subtype, config_path)
+        if key in self.index:
+            processed_dataset = ProcessedDataset(self._data_path(key), dataset_type, coding_system, log_path=self._log_path(key))
+            processed_dataset.log.append(f"{datetime.now()}: Loaded processed data for {path} from the cache in {self.cache_dir}")
+            self.index[key]["last_used"] = datetime.now().isoformat()
+            self._save_index()
+            return processed_dataset
+
+        raw_dataset = RawDataset(path, dataset_type, coding_system, lazy=lazy, nhs_digital_subtype=nhs_digital_subtype,
+                                 config_path=config_path)
+        processed_dataset = raw_dataset.process_dataset(deduplication_options, column_maps, nhs_digital_subtype)
+
+        # Store the data and the log, then add them to the index
+        processed_dataset.write_to_feather(self._data_path(key))
+        processed_dataset.write_to_log(self._log_path(key))
+        self.index[key] = {
+            "raw_path": os.path.abspath(path) if shard_paths is None else [os.path.abspath(shard) for shard in shard_paths],
+            "size_bytes": os.path.getsize(self._data_path(key)) + os.path.getsize(self._log_path(key)),
+            "created": datetime.now().isoformat(),
+            "last_used": datetime.now().isoformat(),
+        }
+        processed_dataset.log.append(f"{datetime.now()}: Processed data for {path} stored in the cache in {self.cache_dir}")
+        self._evict(keep=key)
+        self._save_index()
+        return processed_dataset
+
+    def _remove(self, key: str) -> None:
+        """
+        Removes an entry and its files from the cache.
+
+        Args:
+            key (str): The key of the entry.
+        """
+        for path in (self._data_path(key), self._log_path(key)):
+            if os.path.exists(path):
+                os.remove(path)
+        del self.index[key]
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """
+        Removes the entries that were used least recently until the cache is within its size limit.
+
+        Args:
+            keep (str, optional): The key of an entry that is never removed, such as the entry just added. Defaults to None.
+        """
+        max_size = self.max_size_mb * 1024 * 1024
+        total_size = sum(entry["size_bytes"] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda key: self.index[key]["last_used"]):
+            if total_size <= max_size:
+                break
+            if key == keep:
+                continue
+            total_size -= self.index[key]["size_bytes"]
+            self._remove(key)
+
+    def invalidate(self, path: Optional[str] = None) -> int:
+        """
+        Removes cached datasets, so they are processed again the next time they are asked for.
+
+        Args:
+            path (str, optional): The raw file to remove the cached datasets of. A shard removes every cached
+                dataset it is part of. Defaults to None, which removes every cached dataset.
+
+        Returns:
+            int: The number of cached datasets removed.
+        """
+        def raw_paths(entry: Dict) -> List[str]:
+            return entry["raw_path"] if isinstance(entry["raw_path"], list) else [entry["raw_path"]]
+
+        keys = [key for key, entry in self.index.items()
+                if path is None or os.path.abspath(path) in raw_paths(entry)]
+        for key in keys:
+            self._remove(key)
+        self._save_index()
+        return len(keys)
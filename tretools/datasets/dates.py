@@ -0,0 +1,175 @@
+"""
+This module contains the functions used to convert date strings in raw datasets to dates.
+
+Raw extracts use a number of different date formats, but a single extract almost always uses
+only one or two of them. The formats that occur are detected from a sample of the values, and
+only those formats are parsed. Values that none of the detected formats can parse fall back to
+the full list of formats. Extracts also repeat the same date strings many times, so each
+distinct date string is only parsed once.
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+
+import polars as pl
+
+
+# The date formats that are recognised, in the order they are tried. Some date strings can be parsed
+# by more than one format, e.g. "18-10-05" by both "%F" (year 18) and "%d-%m-%Y" (year 5). The order of
+# this list decides which format wins: the first format that parses a value is used.
+DATE_FORMATS = [
+    "%Y%m%d",               # "20181005"
+    "%F",                   # "2018-10-05"
+    "%F %T",                # "2018-10-05 12:15:30"
+    "%d/%m/%Y",             # "05/11/2018"
+    "%d-%m-%Y",             # "12-02-2019"
+    "%FT%T",                # "2020-05-22T08:45:50"
+    "%d.%m.%Y",             # "21.11.2012"
+    "%d-%m-%Y %H:%M",       # "03-06-2013 15:23"
+    "%d-%m-%Y %H:%M:%S",    # "19-10-2015 17:25:00"
+    "%B %d, %Y",            # "July 19, 2016"
+    "%Y-%m-%d %H:%M",       # "2016-08-20 07:10"
+    "%d/%m/%Y %H:%M",       # "19/10/2015 17:25"
+    "%FT%TZ",               # "2016-08-20T07:10:00Z"
+]
+
+# Number of values sampled to detect the date formats used
+DATE_SAMPLE_SIZE = 1000
+
+
+def detect_date_formats(dates: pl.Series, sample_size: int = DATE_SAMPLE_SIZE) -> List[str]:
+    """
+    Detects which date formats are used, from a sample of values spread evenly through the series.
+
+    Args:
+        dates (pl.Series): The date strings.
+        sample_size (int, optional): The number of values to sample. Defaults to DATE_SAMPLE_SIZE.
+
+    Returns:
+        List[str]: The date formats found in the sample, in the order of DATE_FORMATS.
+    """
+    dates = dates.drop_nulls()
+    step = max(1, len(dates) // sample_size)
+    sample = dates.take_every(step).to_frame("date")
+    found = sample.select([
+        pl.col("date").str.strptime(pl.Date, date_format, strict=False).is_not_null().any().alias(date_format)
+        for date_format in DATE_FORMATS
+    ])
+    if found.is_empty():
+        return []
+    found = found.row(0, named=True)
+    return [date_format for date_format in DATE_FORMATS if found[date_format]]
+
+
+def map_distinct(values: pl.Series, function: Callable[[pl.Series], pl.Series]) -> pl.Series:
+    """
+    Applies a function to each distinct value once, and maps the results back to every row.
+    Columns like dates repeat the same values many times, so this is much cheaper than applying
+    an expensive function (such as parsing) to every row.
+
+    Args:
+        values (pl.Series): The values.
+        function (Callable[[pl.Series], pl.Series]): The function to apply. It must return a series
+            the same length as its input.
+
+    Returns:
+        pl.Series: The result of the function for each row, with the same name as the values.
+    """
+    distinct = values.unique()
+    lookup = pl.DataFrame({"value": distinct, "result": function(distinct)})
+    # A left join keeps the order of the rows
+    mapped = values.to_frame("value").join(lookup, on="value", how="left")["result"]
+    return mapped.alias(values.name)
+
+
+def _parse_with_formats(dates: pl.Series, formats: List[str]) -> Tuple[pl.Series, pl.Series]:
+    """
+    Parses the date strings with each format in turn, keeping the first format that parses each value.
+
+    Args:
+        dates (pl.Series): The date strings.
+        formats (List[str]): The formats to try, in order.
+
+    Returns:
+        Tuple[pl.Series, pl.Series]: The dates, and the format that parsed each value (null if none did).
+    """
+    if not formats:
+        return pl.Series("date", [None] * len(dates), dtype=pl.Date), pl.Series("format", [None] * len(dates), dtype=pl.Utf8)
+
+    parsed = dates.to_frame("date").select([
+        pl.col("date").str.strptime(pl.Date, date_format, strict=False).alias(date_format)
+        for date_format in formats
+    ])
+    converted = parsed.select(pl.coalesce(formats).alias("date")).to_series()
+
+    # Record the first format that parses each value
+    matched_format = pl.when(pl.col(formats[0]).is_not_null()).then(pl.lit(formats[0]))
+    for date_format in formats[1:]:
+        matched_format = matched_format.when(pl.col(date_format).is_not_null()).then(pl.lit(date_format))
+    matched = parsed.select(matched_format.otherwise(pl.lit(None, dtype=pl.Utf8)).alias("format")).to_series()
+    return converted, matched
+
+
+def parse_dates(dates: pl.Series, formats: Optional[List[str]] = None) -> Tuple[pl.Series, Dict[str, int]]:
+    """
+    Converts date strings to dates. Each distinct date string is only parsed once, and the dates
+    are then mapped back to the rows. Only the formats that are detected in a sample of the values
+    are parsed, in the order of DATE_FORMATS. Any values that none of those formats can parse are tried
+    against the rest of the formats in DATE_FORMATS. The result is the same as trying every format in
+    DATE_FORMATS in order, except for a value that a format found in the sample parses, and that an
+    earlier format not found in the sample would also parse.
+
+    Args:
+        dates (pl.Series): The date strings.
+        formats (List[str], optional): The formats to try first. Defaults to None, which detects
+            the formats from a sample.
+
+    Returns:
+        Tuple[pl.Series, Dict[str, int]]: The dates, and the number of rows parsed by each format.
+            Rows that could not be parsed are counted under None.
+    """
+    # Parse each distinct date string once, keeping how many rows have that string
+    distinct = dates.to_frame("value").group_by("value").agg(pl.count().alias("rows")).drop_nulls("value")
+    values = distinct["value"]
+
+    if formats is None:
+        formats = detect_date_formats(values)
+
+    converted, matched = _parse_with_formats(values, formats)
+
+    # Fall back to the remaining formats for the values that were not parsed
+    failed = converted.is_null()
+    if failed.any():
+        remaining_formats = [date_format for date_format in DATE_FORMATS if date_format not in formats]
+        fallback, fallback_matched = _parse_with_formats(values.filter(failed), remaining_formats)
+        indices = failed.arg_true()
+        converted = converted.set_at_idx(indices, fallback)
+        matched = matched.set_at_idx(indices, fallback_matched)
+
+    # Count the rows parsed by each format, in the order of DATE_FORMATS
+    rows_per_format = distinct.select(matched.alias("format"), "rows").group_by("format").agg(pl.col("rows").sum())
+    rows_per_format = dict(rows_per_format.iter_rows())
+    counts = {date_format: rows_per_format[date_format] for date_format in DATE_FORMATS if rows_per_format.get(date_format)}
+    if rows_per_format.get(None):
+        counts[None] = rows_per_format[None]
+
+    # Map the parsed dates back to the rows. A left join keeps the order of the rows.
+    lookup = pl.DataFrame({"value": values, "date": converted})
+    mapped = dates.to_frame("value").join(lookup, on="value", how="left")["date"]
+    return mapped.alias(dates.name), counts
+
+
+def format_counts_message(counts: Dict[str, int]) -> str:
+    """
+    Describes the number of values parsed by each date format, for the log.
+
+    Args:
+        counts (Dict[str, int]): The number of values parsed by each format, with the values that
+            could not be parsed under None.
+
+    Returns:
+        str: The description.
+    """
+    formats = [f"'{date_format}' ({count} row(s))" for date_format, count in counts.items() if date_format is not None]
+    message = f"Date formats found: {', '.join(formats) if formats else 'none'}"
+    if counts.get(None):
+        message += f". {counts[None]} date(s) could not be parsed"
+    return message
@@ -8,11 +8,13 @@ from typing import Dict, Optional
 from datetime import datetime
 
 from tretools.datasets.base import Dataset
+from tretools.datasets.dates import map_distinct
 
 
 class DemographicDataset(Dataset):
     def __init__(self, path: Optional[str] = None, path_to_mapping_file: Optional[str] = None, path_to_demographic_file: Optional[str] = None) -> None:
         self.log = []
+        self.steps = []
         self.data = None
 
         if path is None:
@@ -56,19 +58,17 @@ class DemographicDataset(Dataset):
         Args:
             rounded_day (int): The day to round to.
         """
-        # Convert the date of birth to a date with rounded day so 01-2000 becomes 15-01-2000
-        self.data = self.data.with_columns(
-            (pl.lit(f"{str(rounded_day)}-") + self.data["dob"]).alias("dob")
-        )
-
-        # Convert the date of birth to a date
-        date_converted = self.data.select(
-        pl.coalesce(
-            pl.col("dob").str.strptime(pl.Date, "%d-%m-%Y", strict=False),             # "12-02-2019"
-            ).alias("dob")
-        )
+        def to_date(dob: pl.Series) -> pl.Series:
+            # Convert the date of birth to a date with rounded day so 01-2000 becomes 15-01-2000
+            return dob.to_frame("dob").select(
+                (pl.lit(f"{str(rounded_day)}-") + pl.col("dob")).str.strptime(pl.Date, "%d-%m-%Y", strict=False)   # "12-02-2019"
+            ).to_series()
+
+        # Many people share a month of birth, so each distinct value is only converted once
+        date_converted = map_distinct(self.data["dob"], to_date)
+
         # Drop the original date column and concatenate the converted one
-        self.data = self.data.drop("dob").hstack(date_converted)
+        self.data = self.data.drop("dob").hstack([date_converted])
 
         
     def process_dataset(self, column_maps: Dict[str, str] = None, round_to_day_in_month: int = 15) -> None:
@@ -3,25 +3,87 @@ from __future__ import annotations
 # of the merge_with_dataset method. This means thatit can be used as a type hint even though the 
 # class isn't fully defined yet.
 
+import json
+import os
+import shutil
+
 from datetime import datetime
 from typing import Dict, List, Optional
 import polars as pl
 
-from tretools.datasets.base import Dataset
+from tretools.datasets.base import Dataset, MAX_SHARD_WORKERS, PARTITIONING_FILE, match_join_key_types
 from tretools.datasets.demographic_dataset import DemographicDataset
 from tretools.datasets.dataset_enums.dataset_types import DatasetType
 from tretools.codelists.codelist_types import CodelistType
-from tretools.datasets.errors import DeduplicationError, CodeNotMappable
+from tretools.datasets.errors import DeduplicationError, CodeNotMappable, WriteOptionsInvalid
+from tretools.utility.step_log import timed_step
+
+
+# The default length of the code prefix that partitioned datasets are split on. For ICD10 and OPCS
+# this is the chapter letter, and for SNOMED it is the leading digits of the concept id.
+PARTITION_PREFIX_LENGTHS = {
+    CodelistType.ICD10.value: 1,
+    CodelistType.OPCS.value: 1,
+    CodelistType.SNOMED.value: 2,
+}
+
+
+def is_sorted_by(data: pl.DataFrame, columns: List[str]) -> bool:
+    """
+    Checks if data is sorted by several columns, in one pass that compares each row with the one before it.
+    Nulls are expected before the other values, as sort() leaves them.
+
+    Args:
+        data (pl.DataFrame): The data.
+        columns (List[str]): The columns the data should be sorted by, in order.
+
+    Returns:
+        bool: True if the data is sorted by the columns, False otherwise.
+    """
+    in_order = pl.lit(True)
+    for col in reversed(columns):
+        current, previous = pl.col(col), pl.col(col).shift(1)
+        greater = (current > previous).fill_null(previous.is_null() & current.is_not_null())
+        equal = (current == previous).fill_null(previous.is_null() & current.is_null())
+        # A row is in order if it is greater on this column, or equal and in order on the next columns
+        in_order = greater | (equal & in_order)
+    return data.select(in_order.all()).item()
 
 
 class ProcessedDataset(Dataset):
-    def __init__(self, path, dataset_type: DatasetType, coding_system: CodelistType, log_path: Optional[str] = None) -> None:
-        super().__init__(path, dataset_type, coding_system)
+    def __init__(self, path, dataset_type: DatasetType, coding_system: CodelistType, log_path: Optional[str] = None,
+                 compact: bool = False, memory_map: bool = True, lazy: bool = False,
+                 max_workers: int = MAX_SHARD_WORKERS) -> None:
+        """
+        Loads a processed dataset.
+
+        Args:
+            path (str | List[str]): The path to the dataset. A list of paths, or a glob pattern, loads a dataset
+                that is split into several files (shards) as one dataset.
+            dataset_type (DatasetType): The type of the dataset.
+            coding_system (CodelistType): The coding system of the dataset.
+            log_path (str, optional): The path to a log file to load with the dataset. Defaults to None.
+            compact (bool, optional): If True, the data is stored in a compact form (see compact()). Defaults to False.
+            memory_map (bool, optional): If True, an uncompressed feather file is memory-mapped rather than
+                copied into memory. Its pages are then shared with other processes that load the same file,
+                and only copied when a transform creates new data. Set to False if the file may be changed
+                while the dataset is in use. Defaults to True.
+            lazy (bool, optional): If True, the file is scanned rather than read, and self.data is a polars
+                LazyFrame. This is used to count events in a parquet file written by write_to_parquet(), as only
+                the row groups that contain the codes in a codelist are then read. The methods that change the
+                data, such as deduplicate() and the merges, read all of it first. Defaults to False.
+            max_workers (int, optional): The most shards that are read at the same time. Defaults to MAX_SHARD_WORKERS.
+        """
+        super().__init__(path, dataset_type, coding_system, lazy=lazy, memory_map=memory_map, max_workers=max_workers)
 
         # load the log if a log path is provided
         if log_path:
             self._load_log_from_file(log_path)
 
+        # store the data in a compact form if asked to
+        if compact:
+            self.compact()
+
     def _load_log_from_file(self, log_path: str) -> None:
         """
         Loads a log from a file.
@@ -32,12 +94,70 @@ class ProcessedDataset(Dataset):
         with open(log_path, "r") as f:
             self.log = f.read().splitlines()
 
-    def merge_with_dataset(self, dataset: ProcessedDataset) -> None:
+    @timed_step
+    def write_to_partitions(self, path: str, prefix_length: Optional[int] = None) -> None:
         """
-        Merges the current dataset with another dataset.
+        Writes the data to a directory partitioned by the start of the code, with one parquet file per code
+        prefix (for example code_prefix=E/data.parquet). The directory can be loaded again as a ProcessedDataset,
+        and when it is loaded with lazy=True the EventCounter only reads the partitions that a codelist's codes
+        can fall in.
 
         Args:
-            dataset (ProcessedDataset): The dataset to merge with.
+            path (str): The path to the directory. If it is already a partitioned dataset, it is replaced.
+            prefix_length (int, optional): The number of characters of the code to partition on, for example 3
+                for ICD10 stems. Defaults to None, which uses PARTITION_PREFIX_LENGTHS for the coding system.
+
+        Raises:
+            WriteOptionsInvalid: If the path exists and is not a partitioned dataset, or there is no default
+                prefix length for the coding system.
+        """
+        if os.path.exists(path) and not os.path.isfile(os.path.join(path, PARTITIONING_FILE)):
+            raise WriteOptionsInvalid(f"Cannot write partitions to {path} as it exists and is not a partitioned dataset")
+
+        if prefix_length is None:
+            if self.coding_system not in PARTITION_PREFIX_LENGTHS:
+                raise WriteOptionsInvalid(f"No default prefix length for coding system {self.coding_system}. Set prefix_length")
+            prefix_length = PARTITION_PREFIX_LENGTHS[self.coding_system]
+
+        data = self._collect()
+        # Rows without a code go in the partition hive uses for nulls
+        prefixes = pl.col("code").cast(pl.Utf8).str.slice(0, prefix_length).fill_null("__HIVE_DEFAULT_PARTITION__").alias("code_prefix")
+
+        # Write to a directory next to the path, then swap it into place
+        temp_path = f"{path}.tmp"
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+
+        partitions = {}
+        for prefix, partition_data in data.with_columns(prefixes).partition_by("code_prefix", as_dict=True).items():
+            # Codes are sorted within each partition, so row group statistics can skip codes too
+            partition_file = os.path.join(f"code_prefix={prefix}", "data.parquet")
+            os.makedirs(os.path.join(temp_path, f"code_prefix={prefix}"))
+            partition_data.drop("code_prefix").sort("code").write_parquet(os.path.join(temp_path, partition_file), statistics=True)
+            partitions[prefix] = {"file": partition_file, "rows": partition_data.shape[0]}
+
+        # An empty file with the columns of the data, used when no partition matches
+        data.head(0).write_parquet(os.path.join(temp_path, "empty.parquet"))
+
+        with open(os.path.join(temp_path, PARTITIONING_FILE), "w") as f:
+            json.dump({"column": "code", "prefix_length": prefix_length, "partitions": partitions,
+                       "empty_file": "empty.parquet"}, f, indent=4)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(temp_path, path)
+        self.log.append(f"{datetime.now()}: Data written to {path} in {len(partitions)} partition(s) by the first {prefix_length} character(s) of the code")
+
+    def _check_can_merge(self, dataset: ProcessedDataset) -> None:
+        """
+        Checks another dataset can be combined with this one.
+
+        Args:
+            dataset (ProcessedDataset): The other dataset.
+
+        Raises:
+            DeduplicationError: If the coding system, dataset type, column names or column types are not the same.
         """
         # Check the coding system and dataset type are the same
         if self.coding_system != dataset.coding_system:
@@ -50,16 +170,179 @@ class ProcessedDataset(Dataset):
         if self.data.columns != dataset.data.columns:
             raise DeduplicationError("Column names must be the same for both datasets")
 
+        # check if the columns have the same types, e.g. if only one of the datasets is compact
+        if self.data.dtypes != dataset.data.dtypes:
+            raise DeduplicationError("Column types must be the same for both datasets. Either compact both datasets or neither")
+
+    @staticmethod
+    def _with_lexical_ordering(data):
+        """
+        Sets the categorical columns of compact data to sort in lexical order again. Concatenating
+        compact data loses the ordering that compact() sets.
+
+        Args:
+            data (pl.DataFrame | pl.LazyFrame): The data.
+
+        Returns:
+            pl.DataFrame | pl.LazyFrame: The data, with its categorical columns sorting in lexical order.
+        """
+        categorical_cols = [col for col, dtype in data.schema.items() if dtype == pl.Categorical]
+        return data.with_columns([pl.col(col).cat.set_ordering("lexical") for col in categorical_cols])
+
+    @timed_step
+    def merge_with_dataset(self, dataset: ProcessedDataset) -> None:
+        """
+        Merges the current dataset with another dataset.
+
+        Args:
+            dataset (ProcessedDataset): The dataset to merge with.
+        """
+        self._check_can_merge(dataset)
+
         # Add to the log
-        self.log.append(f"{datetime.now()}: Before merging, dataset has {self.data.shape[0]} rows")
+        self.log.append(f"{datetime.now()}: Before merging, dataset has {self._count_rows()} rows")
 
         # merge
-        self.data = self.data.vstack(dataset.data)
+        self.data = self._collect().vstack(dataset._collect())
 
         # Add to the log
         self.log.append(f"{datetime.now()}: Merged dataset with {dataset.path}")
         self.log.append(f"{datetime.now()}: After merging, dataset has {self.data.shape[0]} rows")
 
+    @timed_step
+    def merge_with_datasets(self, datasets: List[ProcessedDataset], deduplicate: bool = False) -> None:
+        """
+        Merges the current dataset with several other datasets at once. All the datasets are checked first,
+        then concatenated in one step into contiguous memory. Merging datasets one at a time with
+        merge_with_dataset() leaves the data in many chunks, which slows down everything done with it later.
+
+        Args:
+            datasets (List[ProcessedDataset]): The datasets to merge with.
+            deduplicate (bool, optional): If True, rows with the same nhs_number, code and date are dropped while
+                merging, and the data is sorted by nhs_number, code and date, as deduplicate() does. Defaults to False.
+        """
+        for dataset in datasets:
+            self._check_can_merge(dataset)
+
+        rows_before = self._count_rows()
+        frames = [self._collect()] + [dataset._collect() for dataset in datasets]
+        if deduplicate:
+            merged_data = (self._with_lexical_ordering(pl.concat([frame.lazy() for frame in frames]))
+                           .unique(subset=["nhs_number", "code", "date"])
+                           .sort(["nhs_number", "code", "date"])
+                           .collect())
+        else:
+            merged_data = pl.concat(frames, rechunk=True)
+        self.data = merged_data
+
+        # Add a single entry to the log for the whole merge
+        paths = ", ".join(str(dataset.path) for dataset in datasets)
+        deduplicated = ", dropping duplicates based on nhs_number, code and date" if deduplicate else ""
+        self.log.append(f"{datetime.now()}: Merged dataset with {len(datasets)} dataset(s) ({paths}){deduplicated}. Before merging, dataset had {rows_before} rows. After merging, dataset has {merged_data.shape[0]} rows")
+
+    @timed_step
+    def append_delta(self, delta: ProcessedDataset, deduplication_options: Optional[List[str]] = None) -> ProcessedDataset:
+        """
+        Appends the rows of a newer extract that are not already in the dataset. The delta is usually
+        a refreshed extract processed on its own, so only the delta has to be processed and deduplicated,
+        not the full history.
+
+        The dataset is kept sorted by nhs_number, code and date, as deduplicate() leaves it. The rows of
+        the patients in the delta are found with a binary search on nhs_number, so only those rows are
+        compared with the delta and sorted again. Compact datasets cannot be searched like this, so for
+        them the whole dataset is sorted again.
+
+        The dataset is checked first, in one pass over the rows. If it is not sorted by nhs_number, code and
+        date it is sorted, and if it has duplicate rows they are removed, keeping the first.
+
+        Args:
+            delta (ProcessedDataset): The processed dataset with the new rows.
+            deduplication_options (List[str], optional): The columns that identify a duplicate row. Must include
+                "nhs_number" and "code". Defaults to None, which uses nhs_number, code and date.
+
+        Returns:
+            ProcessedDataset: A new dataset containing the deduplicated, sorted data with the new rows added.
+
+        Raises:
+            DeduplicationError: If the datasets cannot be combined, or deduplication_options does not include
+                "nhs_number" and "code".
+        """
+        if deduplication_options is None:
+            deduplication_options = ["nhs_number", "code", "date"]
+        if "nhs_number" not in deduplication_options or "code" not in deduplication_options:
+            raise DeduplicationError("deduplication_options must include 'nhs_number' and 'code'")
+
+        self._check_can_merge(delta)
+
+        new_log = []
+        sort_columns = ["nhs_number", "code", "date"]
+        delta_data = delta._collect().unique(subset=deduplication_options, keep="first")
+        new_log.append(f"{datetime.now()}: Appending delta from {delta.path}. Delta has {delta._count_rows()} rows, and {delta_data.shape[0]} rows after deduplicating")
+
+        data = self._collect()
+        if pl.Categorical in (data.schema["nhs_number"], data.schema["code"]):
+            # Categoricals cannot be checked or binary searched, so the delta is compared with the whole
+            # dataset, which is sorted again
+            is_sorted = False
+        else:
+            is_sorted = is_sorted_by(data, sort_columns)
+            if not is_sorted:
+                data = data.sort(sort_columns)
+                is_sorted = True
+                new_log.append(f"{datetime.now()}: Dataset was not sorted by nhs_number, code and date, so it was sorted")
+
+        if is_sorted and deduplication_options in (sort_columns[:2], sort_columns):
+            # Duplicates of sorted data are next to each other
+            has_duplicates = data.select(pl.all_horizontal([pl.col(col).eq_missing(pl.col(col).shift(1)) for col in deduplication_options]).slice(1).any()).item()
+        else:
+            has_duplicates = data.select(deduplication_options).is_duplicated().any()
+        if has_duplicates:
+            rows_before = data.shape[0]
+            data = data.unique(subset=deduplication_options, keep="first", maintain_order=True)
+            new_log.append(f"{datetime.now()}: Dataset had {rows_before - data.shape[0]} duplicate rows, which were removed")
+
+        if not is_sorted:
+            new_rows = delta_data.join(data, on=deduplication_options, how="anti")
+            appended_data = self._with_lexical_ordering(pl.concat([data, new_rows])).sort(sort_columns)
+        else:
+
+            # Find the rows of the patients in the delta with a binary search on the sorted nhs_number
+            patients = delta_data["nhs_number"].unique().sort()
+            starts = data["nhs_number"].search_sorted(patients, side="left")
+            ends = data["nhs_number"].search_sorted(patients, side="right")
+            patient_rows = pl.int_ranges(starts, ends, eager=True).explode().drop_nulls()
+            existing_data = data[patient_rows]
+
+            # Only the rows of these patients are compared with the delta and sorted again
+            new_rows = delta_data.join(existing_data, on=deduplication_options, how="anti")
+            patient_data = pl.concat([existing_data, new_rows]).sort(sort_columns)
+
+            # The other patients are still sorted, and no patient is in both, so merging on nhs_number keeps the order
+            is_patient_row = pl.repeat(False, data.shape[0], eager=True).set_at_idx(patient_rows, True)
+            other_data = data.filter(~is_patient_row)
+            if other_data.is_empty() or patient_data.is_empty():
+                # merge_sorted cannot merge with an empty dataframe
+                appended_data = pl.concat([other_data, patient_data])
+            else:
+                appended_data = other_data.merge_sorted(patient_data, key="nhs_number")
+
+        new_log.append(f"{datetime.now()}: {delta_data.shape[0] - new_rows.shape[0]} rows in the delta were already in the dataset")
+        new_log.append(f"{datetime.now()}: Appended {new_rows.shape[0]} new rows. Dataset has {appended_data.shape[0]} rows, sorted by nhs_number, code and date")
+
+        # Create a new ProcessedDataset instance and return
+        processed_dataset = ProcessedDataset.from_dataframe(appended_data, dataset_type=self.dataset_type,
+                                                            coding_system=self.coding_system, path=self.path)
+
+        # Add the new log to the processed dataset together with the old log
+        for log in new_log:
+            processed_dataset.log.append(log)
+        for log in self.log:
+            processed_dataset.log.append(log)
+        processed_dataset.log.sort()
+
+        return processed_dataset
+
+    @timed_step
     def deduplicate(self, date_start: Optional[str] = None) -> ProcessedDataset:
         """
         Deduplicates the DataFrame. Removes rows where entire row is the same and 
@@ -73,13 +356,14 @@ class ProcessedDataset(Dataset):
         """
         # start log
         new_log = []
-        new_log.append(f"{datetime.now()}: Deduplicating dataset. Pre-deduplication dataset has {self.data.shape[0]} rows")
+        data = self._collect()
+        new_log.append(f"{datetime.now()}: Deduplicating dataset. Pre-deduplication dataset has {data.shape[0]} rows")
 
         # Remove rows where the entire row is duplicated
-        deduplicated_data = self.data.unique()
+        deduplicated_data = data.unique()
 
         # If date_start is provided, filter rows after date_start, else use the entire data
-        filtered_data = deduplicated_data.filter(deduplicated_data["date"] >= date_start) if date_start else deduplicated_data
+        filtered_data = deduplicated_data.filter(deduplicated_data["date"] >= self._date_value(date_start)) if date_start else deduplicated_data
         if date_start:
             new_log.append(f"{datetime.now()}: Filtered rows after {date_start}. Post-filtering dataset has {filtered_data.shape[0]} rows")
 
@@ -92,8 +376,8 @@ class ProcessedDataset(Dataset):
         new_log.append(f"{datetime.now()}: Sorted dataset by nhs_number, code and date")
 
         # Create a new ProcessedDataset instance and return
-        processed_dataset = ProcessedDataset(path=self.path, dataset_type=self.dataset_type, coding_system=self.coding_system)
-        processed_dataset.data = unique_sorted_data
+        processed_dataset = ProcessedDataset.from_dataframe(unique_sorted_data, dataset_type=self.dataset_type,
+                                                            coding_system=self.coding_system, path=self.path)
 
         # Add the new log to the processed dataset together with the old log
         for log in new_log:
@@ -104,6 +388,7 @@ class ProcessedDataset(Dataset):
 
         return processed_dataset
     
+    @timed_step
     def map_snomed_to_icd(self, mapping_file: str, snomed_col: str = "conceptID", icd_col: str = "mapTarget") -> ProcessedDataset:
         """
         Maps snomed codes to icd codes using a mapping file.
@@ -121,22 +406,21 @@ class ProcessedDataset(Dataset):
         # Add to the log
         new_log = []
         new_log.append(f"{datetime.now()}: Loading mapping file from {mapping_file}")
-        new_log.append(f"{datetime.now()}: Pre-mapping dataset has {self.data.shape[0]} rows")
+        data = self._collect()
+        new_log.append(f"{datetime.now()}: Pre-mapping dataset has {data.shape[0]} rows")
 
         # Load the mapping file
         mapping_df = pl.read_csv(mapping_file)
 
         # Join the mapping file to the dataset
-        mapped_data = self.data.join(mapping_df, left_on="code", right_on=snomed_col, how="inner")
+        mapped_data = data.join(mapping_df, left_on="code", right_on=snomed_col, how="inner")
         new_log.append(f"{datetime.now()}: Post-mapping dataset has {mapped_data.shape[0]} rows")
         mapped_data = mapped_data.select([pl.col("nhs_number"), pl.col("date"), pl.col(icd_col).alias("code")])
         new_log.append(f"{datetime.now()}: Renamed column {snomed_col} to code, and dropped other columns")
 
         # Create a new ProcessedDataset instance and return
-        processed_dataset = ProcessedDataset(path=self.path, dataset_type=self.dataset_type, coding_system=self.coding_system)
-        processed_dataset.data = mapped_data
-        # wipe the log
-        processed_dataset.log = []
+        processed_dataset = ProcessedDataset.from_dataframe(mapped_data, dataset_type=self.dataset_type,
+                                                            coding_system=self.coding_system, path=self.path)
 
         # Add the new log to the processed dataset together with the old log
         for log in new_log:
@@ -148,6 +432,7 @@ class ProcessedDataset(Dataset):
 
         return processed_dataset
 
+    @timed_step
     def truncate_icd_to_3_digits(self) -> ProcessedDataset:
         """
         Truncates the icd codes to 3 digits.
@@ -162,15 +447,22 @@ class ProcessedDataset(Dataset):
         # Add to the log
         new_log = []
         new_log.append(f"{datetime.now()}: Truncating ICD codes to 3 digits")
-        new_log.append(f"{datetime.now()}: Pre-truncation dataset has {self.data.shape[0]} rows")
+        data = self._collect()
+        new_log.append(f"{datetime.now()}: Pre-truncation dataset has {data.shape[0]} rows")
 
         # Truncate the icd codes
-        truncated_data = self.data.select([pl.col("nhs_number"), pl.col("date"), pl.col("code").str.slice(0, 3).alias("code")])
+        truncated_code = pl.col("code")
+        if data.schema["code"] == pl.Categorical:
+            # Compact codes are truncated as strings, then stored as categoricals again
+            truncated_code = truncated_code.cast(pl.Utf8).str.slice(0, 3).cast(pl.Categorical).cat.set_ordering("lexical")
+        else:
+            truncated_code = truncated_code.str.slice(0, 3)
+        truncated_data = data.select([pl.col("nhs_number"), pl.col("date"), truncated_code.alias("code")])
         new_log.append(f"{datetime.now()}: Post-truncation dataset has {truncated_data.shape[0]} rows")
 
         # Create a new ProcessedDataset instance and return
-        processed_dataset = ProcessedDataset(path=self.path, dataset_type=self.dataset_type, coding_system=self.coding_system)
-        processed_dataset.data = truncated_data
+        processed_dataset = ProcessedDataset.from_dataframe(truncated_data, dataset_type=self.dataset_type,
+                                                            coding_system=self.coding_system, path=self.path)
 
         # Add the new log to the processed dataset together with the old log
         for log in new_log:
@@ -183,6 +475,7 @@ class ProcessedDataset(Dataset):
         return processed_dataset
     
     
+    @timed_step
     def remove_unrealistic_dates(self, date_start: str = "1910-01-01", 
                                  date_end: str = "2024-01-24", 
                                  before_born: bool = True, 
@@ -209,15 +502,17 @@ class ProcessedDataset(Dataset):
             raise ValueError("A demographic dataset must be provided if before_born is True")
         
         # Filter the data
-        new_log.append(f"{datetime.now()}: Before filtering for unrealistic dates, dataset has {self.data.shape[0]} rows")
-        filtered_data = self.data.filter((self.data["date"] >= date_start) & (self.data["date"] <= date_end))
+        data = self._collect()
+        new_log.append(f"{datetime.now()}: Before filtering for unrealistic dates, dataset has {data.shape[0]} rows")
+        filtered_data = data.filter((data["date"] >= self._date_value(date_start)) & (data["date"] <= self._date_value(date_end)))
         new_log.append(f"{datetime.now()}: After filtering dates before {date_start} and after {date_end}, dataset has {filtered_data.shape[0]} rows")
 
         # If before_born is True, filter rows before the patient was born
         new_log.append(f"{datetime.now()}: Before filtering rows before the patient was born, dataset has {filtered_data['nhs_number'].unique().shape[0]} people in it. Note this is people and not rows. ")
         if before_born:
             # join the filtered data with the demographic dataset
-            joined_data = filtered_data.join(demographic_dataset.data, on="nhs_number", how="inner")
+            filtered_data, demographic_data = match_join_key_types(filtered_data, demographic_dataset.data, on="nhs_number")
+            joined_data = filtered_data.join(demographic_data, on="nhs_number", how="inner")
             new_log.append(f"{datetime.now()}: After joining with demographic dataset, dataset has {joined_data['nhs_number'].unique().shape[0]} people in it.")
             # filter rows before the patient was born
             filtered_data = joined_data.filter(joined_data["date"] >= joined_data["dob"])
@@ -227,9 +522,8 @@ class ProcessedDataset(Dataset):
             filtered_data = filtered_data.select([pl.col("nhs_number"), pl.col("date"), pl.col("code")])        
 
         # Create a new ProcessedDataset instance and return
-        processed_dataset = ProcessedDataset(path=self.path, dataset_type=self.dataset_type, coding_system=self.coding_system)
-        processed_dataset.data = filtered_data
-        processed_dataset.log = []
+        processed_dataset = ProcessedDataset.from_dataframe(filtered_data, dataset_type=self.dataset_type,
+                                                            coding_system=self.coding_system, path=self.path)
 
         # Add the new log to the processed dataset together with the old log
         for log in new_log:
@@ -1,33 +1,138 @@
+from __future__ import annotations
+
+import glob
+import math
+import os
+import tempfile
 import polars as pl
+
+from concurrent.futures import ThreadPoolExecutor
 import json
 import pkg_resources
 
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
-from tretools.datasets.base import Dataset
-from tretools.datasets.errors import ColumnsValidationError, DeduplicationError
+from tretools.datasets.base import Dataset, MAX_SHARD_WORKERS
+from tretools.datasets.dates import format_counts_message, parse_dates
+from tretools.datasets.errors import ColumnsValidationError, DeduplicationError, WriteOptionsInvalid
 from tretools.datasets.dataset_enums.dataset_types import DatasetType
 from tretools.codelists.codelist_types import CodelistType
 from tretools.datasets.dataset_enums.deduplication_options import DeduplicationOptions
 from tretools.datasets.processed_dataset import ProcessedDataset
+from tretools.utility.step_log import timed_step
 
+# Rough ratio between the size of data on disk and the memory used while it is parsed and
+# processed, used to size batches and partitions when processing in batches.
+MEMORY_EXPANSION_FACTOR = 4
+
+# Rough ratio between the decompressed and compressed size of a compressed raw file, used to
+# size partitions when processing a compressed file in batches.
+COMPRESSION_RATIO = 5
 
 class RawDataset(Dataset):
-    def __init__(self, path, dataset_type: DatasetType, coding_system: CodelistType) -> None:
-        super().__init__(path, dataset_type, coding_system)
+    # The shards are kept, so they are pre-processed at the same time (see _prepare_shards())
+    KEEP_SHARDS = True
+
+    def __init__(self, path, dataset_type: DatasetType, coding_system: CodelistType, lazy: bool = False,
+                 nhs_digital_subtype: Optional[str] = None, config_path: Optional[str] = None,
+                 persist_schema: bool = False, max_workers: int = MAX_SHARD_WORKERS) -> None:
+        """
+        Loads a raw dataset.
+
+        Args:
+            path (str | List[str]): The path to the raw file. A list of paths, or a glob pattern such as
+                "gp_extract_*.csv", loads a dataset that is split into several files (shards) as one dataset.
+                The shards are read, and later pre-processed, at the same time.
+            dataset_type (DatasetType): The type of the dataset.
+            coding_system (CodelistType): The coding system of the dataset.
+            lazy (bool, optional): If True, the file is scanned rather than read, and the processing steps
+                are built into a single query plan that is collected once when deduplicating. Defaults to False.
+            nhs_digital_subtype (str, optional): The NHS Digital subtype (CIV_REG, APC or OP). If given for an
+                NHS Digital dataset, only the columns named in its config are read from the file. Defaults to None.
+            config_path (str, optional): A config to use instead of the default config for the subtype. Defaults to None.
+            persist_schema (bool, optional): If True, the schema inferred for a delimited file is saved next to it
+                (as <path>.schema.json), so it is not inferred again the next time the file is loaded. Defaults to False.
+            max_workers (int, optional): The most shards that are read at the same time. Defaults to MAX_SHARD_WORKERS.
+        """
+        self.nhs_digital_subtype = nhs_digital_subtype
+        self.config_path = config_path
+        self._lazy_row_counts = {}
+        self._lazy_log = []
+
+        # For NHS Digital data we only need the columns in the config, so the reader can skip the rest
+        columns = None
+        if dataset_type == DatasetType.NHS_DIGITAL.value and nhs_digital_subtype is not None:
+            config = self._load_nhs_digital_config(nhs_digital_subtype, config_path)
+            columns = [config["nhs_number"], config["date"]] + config["column_to_expand"]
+
+        super().__init__(path, dataset_type, coding_system, lazy=lazy, columns=columns, persist_schema=persist_schema,
+                         max_workers=max_workers)
+        if columns is not None:
+            self.log.append(f"{datetime.now()}: Only the {len(columns)} columns in the {nhs_digital_subtype} config were read")
+
         self.column_validation: bool = self._validate_column_names()
 
         if self.column_validation:
             self.log.append(f"{datetime.now()}: Column names validated")
 
-    def _expand_cols_to_rows(self, hes_subtype: str, config_path: str = None):
-        # check the dataset type
-        if self.dataset_type != DatasetType.NHS_DIGITAL.value:
-            raise NotImplementedError("This method is only implemented for NHS Digital datasets")
+    @classmethod
+    def from_dataframe(cls, data: pl.DataFrame, dataset_type: DatasetType, coding_system: CodelistType,
+                       path: Optional[str] = None, log: Optional[List[str]] = None) -> RawDataset:
+        """
+        Creates a RawDataset from a polars DataFrame that is already in memory, validating
+        the column names as the constructor does.
+
+        Args:
+            data (pl.DataFrame): The raw data.
+            dataset_type (DatasetType): The type of the dataset.
+            coding_system (CodelistType): The coding system of the dataset.
+            path (str, optional): The path of the file the data originally came from. Defaults to None.
+            log (List[str], optional): The log to carry over to the new dataset. Defaults to None.
+
+        Returns:
+            RawDataset: A new RawDataset holding the data.
+        """
+        dataset = super().from_dataframe(data, dataset_type, coding_system, path=path, log=log)
+        dataset.nhs_digital_subtype = None
+        dataset.config_path = None
+        dataset._lazy_row_counts = {}
+        dataset._lazy_log = []
+        dataset.column_validation = dataset._validate_column_names()
+        return dataset
+
+    def _load_shard(self, path: str, lazy: bool = False, columns: Optional[List[str]] = None,
+                    persist_schema: bool = False, memory_map: bool = True) -> RawDataset:
+        """
+        Loads one shard of a sharded raw dataset as a raw dataset of its own, so it can be pre-processed on its own.
+
+        Args:
+            path (str): The path to the shard.
+            lazy (bool, optional): If True, the shard is scanned rather than read. Defaults to False.
+            columns (List[str], optional): Not used, as the columns are taken from the NHS Digital config of the shard.
+            persist_schema (bool, optional): If True, save the inferred schema next to the shard. Defaults to False.
+            memory_map (bool, optional): Not passed on, as a RawDataset has no memory_map option. The shard
+                is loaded with the default of Dataset, so an uncompressed feather shard is memory-mapped. Defaults to True.
+
+        Returns:
+            RawDataset: The shard.
+        """
+        return RawDataset(path, self.dataset_type, self.coding_system, lazy=lazy, nhs_digital_subtype=self.nhs_digital_subtype,
+                          config_path=self.config_path, persist_schema=persist_schema)
+
+    @staticmethod
+    def _load_nhs_digital_config(hes_subtype: str, config_path: str = None) -> Dict:
+        """
+        Loads the config that describes an NHS Digital dataset. The default config for
+        the subtype is used unless a config path is given.
 
-        # check if has overwritten config
+        Args:
+            hes_subtype (str): The NHS Digital subtype (CIV_REG, APC or OP).
+            config_path (str, optional): A config to use instead of the default. Defaults to None.
 
+        Returns:
+            Dict: The config.
+        """
         # if not, check default config
         if config_path is None:
             if hes_subtype == "CIV_REG":
@@ -39,10 +144,29 @@ class RawDataset(Dataset):
             # this loads the default config from the package files. We get these 
             # from the tretools package, which is installed in the environment
             config_path = pkg_resources.resource_filename(__name__, resource_path)
-        config = json.loads(open(config_path).read())
+        with open(config_path) as f:
+            return json.load(f)
+
+    @timed_step
+    def _expand_cols_to_rows(self, hes_subtype: str = None, config_path: str = None):
+        # check the dataset type
+        if self.dataset_type != DatasetType.NHS_DIGITAL.value:
+            raise NotImplementedError("This method is only implemented for NHS Digital datasets")
+
+        # fall back to the subtype and config given when the dataset was loaded
+        if hes_subtype is None:
+            hes_subtype = self.nhs_digital_subtype
+        if config_path is None:
+            config_path = self.config_path
+        config = self._load_nhs_digital_config(hes_subtype, config_path)
 
         # log the shape of the data
-        self.log.append(f"{datetime.now()}: Data shape before expanding wide columns into rows: {self.data.shape}")
+        num_cols_before = len(self.data.columns)
+        if self._is_lazy():
+            self._count_rows_when_collected("before_expanding")
+            self._lazy_log.append(lambda: f"Data shape before expanding wide columns into rows: {(self._lazy_row_counts['before_expanding'], num_cols_before)}")
+        else:
+            self.log.append(f"{datetime.now()}: Data shape before expanding wide columns into rows: {self.data.shape}")
 
         # melt the data
         self.data = self.data.melt(id_vars=[config["nhs_number"], config["date"]], 
@@ -65,8 +189,14 @@ class RawDataset(Dataset):
         )
 
         # log the action
-        self.log.append(f"{datetime.now()}: Data shape after expanding wide columns into rows: {self.data.shape}")
+        num_cols_after = len(self.data.columns)
+        if self._is_lazy():
+            self._count_rows_when_collected("after_expanding")
+            self._lazy_log.append(lambda: f"Data shape after expanding wide columns into rows: {(self._lazy_row_counts['after_expanding'], num_cols_after)}")
+        else:
+            self.log.append(f"{datetime.now()}: Data shape after expanding wide columns into rows: {self.data.shape}")
 
+    @timed_step
     def _standarise_column_names(self, column_maps: Dict[str, str]) -> None:
         """
         Standarises the column names of the DataFrame.
@@ -104,6 +234,7 @@ class RawDataset(Dataset):
             if extra_cols:
                 self.log.append(f"{datetime.now()}: Key columns are standardised, however extra columns found: {', '.join(extra_cols)}. Run _drop_unneeded_columns() to drop these columns.")
 
+    @timed_step
     def _standarise_date_format(self) -> None:
         """
         Standardises the date format of the 'date' column in the DataFrame.
@@ -116,28 +247,39 @@ class RawDataset(Dataset):
 
         date_col = "date"
 
-        # Convert the date strings using strptime. Convert integers to strings first.
-        date_converted = self.data.select(
-        pl.coalesce(
-            pl.col(date_col).str.strptime(pl.Date, "%Y%m%d", strict=False),
-            pl.col(date_col).str.strptime(pl.Date, "%F", strict=False),                   # "2018-10-05"
-            pl.col(date_col).str.strptime(pl.Date, "%F %T", strict=False),                # "2018-10-05 12:15:30"
-            pl.col(date_col).str.strptime(pl.Date, "%d/%m/%Y", strict=False),             # "05/11/2018"
-            pl.col(date_col).str.strptime(pl.Date, "%d-%m-%Y", strict=False),             # "12-02-2019"
-            pl.col(date_col).str.strptime(pl.Date, "%FT%T", strict=False),                # "2020-05-22T08:45:50"
-            pl.col(date_col).str.strptime(pl.Date, "%d.%m.%Y", strict=False),             # "21.11.2012"
-            pl.col(date_col).str.strptime(pl.Date, "%d-%m-%Y %H:%M", strict=False),      # "03-06-2013 15:23"
-            pl.col(date_col).str.strptime(pl.Date, "%d-%m-%Y %H:%M:%S", strict=False),   # "19/10/2015 17:25:00"
-            pl.col(date_col).str.strptime(pl.Date, "%B %d, %Y", strict=False),           # "July 19, 2016"
-            pl.col(date_col).str.strptime(pl.Date, "%Y-%m-%d %H:%M", strict=False),       # "2016-08-20 07:10"
-            pl.col(date_col).str.strptime(pl.Date, "%d/%m/%Y %H:%M", strict=False),      # "19/10/2015 17:25"
-            pl.col(date_col).str.strptime(pl.Date, "%FT%TZ", strict=False),               # "2016-08-20T07:10:00Z"
-            ).alias(date_col)
-        )
-        # Drop the original date column and concatenate the converted one
-        self.data = self.data.drop(date_col).hstack(date_converted)
+        # Convert the date strings, parsing only the formats that are used in the data
+        if self._is_lazy():
+            # The counts of each format are only known once the query is collected, so they are
+            # added up as the data is parsed and logged when the data is collected
+            self._date_format_counts = {}
+            date_converted = pl.col(date_col).map_batches(self._parse_dates_and_count, return_dtype=pl.Date)
+            self.data = self.data.select(pl.exclude(date_col), date_converted)
+            self._lazy_log.append(lambda: format_counts_message(self._date_format_counts))
+        else:
+            converted, counts = parse_dates(self.data[date_col])
+            # Replace the original date column with the converted one, moving it to the end
+            self.data = self.data.select(pl.exclude(date_col), converted)
         self.log.append(f"{datetime.now()}: Date format standarised")
+        if not self._is_lazy():
+            self.log.append(f"{datetime.now()}: {format_counts_message(counts)}")
 
+    def _parse_dates_and_count(self, dates: pl.Series) -> pl.Series:
+        """
+        Converts date strings to dates, adding the number of values parsed by each format to the
+        counts that are logged when lazy data is collected.
+
+        Args:
+            dates (pl.Series): The date strings.
+
+        Returns:
+            pl.Series: The dates.
+        """
+        converted, counts = parse_dates(dates)
+        for date_format, count in counts.items():
+            self._date_format_counts[date_format] = self._date_format_counts.get(date_format, 0) + count
+        return converted
+
+    @timed_step
     def _drop_all_null_rows(self) -> None:
         """
         Drops all rows where any cell has a missing value or the date column is an empty string.
@@ -145,22 +287,46 @@ class RawDataset(Dataset):
         date_col = "date"
 
         # Check if the date column is of integer type, if so, convert to string
-        if self.data[date_col].dtype == pl.Int64:
-            self.data = self.data.with_columns(self.data[date_col].cast(pl.Utf8))
+        if self.data.schema[date_col] == pl.Int64:
+            self.data = self.data.with_columns(pl.col(date_col).cast(pl.Utf8))
+
+        # Drop rows where the date column is an empty string
+        condition = pl.col(date_col) != ''
+
+        if self._is_lazy():
+            # The rows are counted as they pass through the query plan, so the data is only read once
+            self._count_rows_when_collected("before_dropping_nulls")
+            self.data = self.data.filter(condition).drop_nulls()
+            self._count_rows_when_collected("after_dropping_nulls")
+            self._lazy_log.append(lambda: f"Dropped {self._lazy_row_counts['before_dropping_nulls'] - self._lazy_row_counts['after_dropping_nulls']} rows with empty values or empty date strings")
+            return
 
         # Count the number of rows before dropping
         num_rows_before = self.data.shape[0]
 
-        # Drop rows where the date column is an empty string
-        condition = self.data[date_col] != ''
-        
         # Drop rows with any missing value
         self.data = self.data.filter(condition).drop_nulls()
         num_rows_after = self.data.shape[0]
         
         self.log.append(f"{datetime.now()}: Dropped {num_rows_before - num_rows_after} rows with empty values or empty date strings")
 
+    def _count_rows_when_collected(self, name: str) -> None:
+        """
+        Counts the rows of lazy data as they pass this point of the query plan, without reading the data
+        again. The count is in self._lazy_row_counts[name] once the query is collected.
 
+        Args:
+            name (str): The name of the count.
+        """
+        def count_rows(data: pl.DataFrame) -> pl.DataFrame:
+            self._lazy_row_counts[name] = self._lazy_row_counts.get(name, 0) + data.shape[0]
+            return data
+
+        # Filters after this point must not be moved before it, or the count would be of the filtered rows
+        self.data = self.data.map_batches(count_rows, predicate_pushdown=False, slice_pushdown=False)
+
+
+    @timed_step
     def _deduplicate(self, deduplication_options: List[DeduplicationOptions]) -> ProcessedDataset:
         """
         Deduplicates the DataFrame based on nhs_number and code, with an optional inclusion of term.
@@ -179,35 +345,47 @@ class RawDataset(Dataset):
         # Deduplicate based on the provided columns
         deduplicated_data = self.data.unique(subset=deduplication_options, keep="first")
 
+        # In lazy mode this is the end of the query plan, so collect it once here, then log the
+        # messages that needed the rows to be counted
+        if self._is_lazy():
+            deduplicated_data = deduplicated_data.collect()
+            for message in self._lazy_log:
+                self.log.append(f"{datetime.now()}: {message()}")
+
         # Create a new ProcessedDataset instance and return
-        processed_dataset = ProcessedDataset(path=self.path, dataset_type=self.dataset_type, coding_system=self.coding_system)
-        processed_dataset.data = deduplicated_data
-        processed_dataset.log = self.log
+        processed_dataset = ProcessedDataset.from_dataframe(deduplicated_data, dataset_type=self.dataset_type,
+                                                            coding_system=self.coding_system, path=self.path,
+                                                            log=self.log)
         processed_dataset.log.append(f"{datetime.now()}: Deduplicated data based on: {', '.join(deduplication_options)}")
 
         return processed_dataset
 
+    @timed_step
     def _drop_unneeded_columns(self) -> None:
         """
         Drops unneeded columns from the DataFrame.
         """
-        num_of_cols_before = self.data.shape[1]
+        num_of_cols_before = len(self.data.columns)
         self.data = self.data.select(["nhs_number", "code", "date"])
-        num_of_cols_after = self.data.shape[1]
+        num_of_cols_after = len(self.data.columns)
         self.log.append(f"{datetime.now()}: Unneeded {num_of_cols_before - num_of_cols_after} column(s) dropped")
 
-    def process_dataset(self, deduplication_options: List[DeduplicationOptions], column_maps: Dict[str, str] = None, nhs_digital_subtype: str = None) -> ProcessedDataset:
+    def _prepare_for_deduplication(self, column_maps: Dict[str, str] = None, nhs_digital_subtype: str = None) -> None:
         """
-        Processes a raw dataset by standarising the column names, dropping unneeded columns, standarising the date format and deduplicating.
+        Runs the processing steps that come before deduplication: standarising the column names (or
+        expanding the wide NHS Digital columns), dropping unneeded columns, dropping null rows and
+        standarising the date format.
 
         Args:
-            deduplication_options (List[str]): List containing columns to deduplicate on. Must include "nhs_number" and "code", 
-            can optionally include "term".
             column_maps (Dict[str, str]): A dictionary of column names to be renamed.
-
-        Returns:
-            ProcessedDataset: A new dataset containing processed data.
+            nhs_digital_subtype (str): The NHS Digital subtype, if this is an NHS Digital dataset.
         """
+        # The shards of a sharded dataset are pre-processed at the same time, unless the data has been
+        # changed since they were combined
+        if self.shards is not None and self.data is self.shard_data and not self._is_lazy():
+            self._prepare_shards(column_maps, nhs_digital_subtype)
+            return
+
         # if NHS Digital dataset, expand wide columns into rows
         if self.dataset_type == DatasetType.NHS_DIGITAL.value:
             self._expand_cols_to_rows(hes_subtype=nhs_digital_subtype)
@@ -228,15 +406,177 @@ class RawDataset(Dataset):
         # Time format the date
         self._standarise_date_format()
 
+    @timed_step
+    def _prepare_shards(self, column_maps: Dict[str, str] = None, nhs_digital_subtype: str = None) -> None:
+        """
+        Runs the processing steps that come before deduplication on each shard, at the same time in a pool
+        of threads, then combines the shards again. The time taken is then that of the slowest shards, not
+        the sum of all of them.
+
+        Args:
+            column_maps (Dict[str, str]): A dictionary of column names to be renamed.
+            nhs_digital_subtype (str): The NHS Digital subtype, if this is an NHS Digital dataset.
+        """
+        # Only the log entries and steps added while pre-processing are carried over, as the rest already were
+        log_lengths = [len(shard.log) for shard in self.shards]
+        step_lengths = [len(shard.steps) for shard in self.shards]
+
+        def prepare_shard(shard: RawDataset) -> RawDataset:
+            shard._prepare_for_deduplication(column_maps, nhs_digital_subtype)
+            return shard
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            shards = list(executor.map(prepare_shard, self.shards))
+
+        for shard, log_length, step_length in zip(shards, log_lengths, step_lengths):
+            self.log.extend(shard.log[log_length:])
+            self.steps.extend(shard.steps[step_length:])
+
+        self.data = pl.concat([shard.data for shard in shards], how="vertical_relaxed")
+        self.shards = None
+        self.shard_data = None
+        self.column_validation: bool = self._validate_column_names()
+        self.log.append(f"{datetime.now()}: Pre-processed {len(shards)} shards at the same time, and combined them into one dataset with {self.data.shape[0]} rows")
+
+    @timed_step
+    def process_dataset(self, deduplication_options: List[DeduplicationOptions], column_maps: Dict[str, str] = None, nhs_digital_subtype: str = None) -> ProcessedDataset:
+        """
+        Processes a raw dataset by standarising the column names, dropping unneeded columns, standarising the date format and deduplicating.
+
+        Args:
+            deduplication_options (List[str]): List containing columns to deduplicate on. Must include "nhs_number" and "code", 
+            can optionally include "term".
+            column_maps (Dict[str, str]): A dictionary of column names to be renamed.
+
+        Returns:
+            ProcessedDataset: A new dataset containing processed data.
+        """
+        self._prepare_for_deduplication(column_maps, nhs_digital_subtype)
+
         # Deduplicate
         processed_dataset = self._deduplicate(deduplication_options)
 
         # Create a new ProcessedDataset instance and return
         return processed_dataset
-    
 
+    def _plan_batches(self, memory_limit_mb: float) -> Tuple[int, int]:
+        """
+        Works out how many rows to read per batch and how many partitions to spill to so that
+        neither a batch nor a partition should need more than the memory limit.
 
+        Args:
+            memory_limit_mb (float): The memory ceiling in megabytes.
+
+        Returns:
+            Tuple[int, int]: The number of rows per batch and the number of partitions.
+        """
+        memory_limit = memory_limit_mb * 1024 * 1024
+        paths = self._shard_paths(self.path) or [self.path]
+        file_size = sum(os.path.getsize(path) for path in paths)
+
+        # Estimate the size of one row from the start of the (first) file
+        first_path = paths[0]
+        if first_path.endswith(".arrow") or first_path.endswith(".parquet"):
+            scan = pl.scan_ipc if first_path.endswith(".arrow") else pl.scan_parquet
+            num_rows = scan(first_path).select(pl.count()).collect().item()
+            bytes_per_row = os.path.getsize(first_path) / max(num_rows, 1)
+        else:
+            with self._open_decompressed(first_path) as f:
+                sample = f.read(1024 * 1024)
+            bytes_per_row = len(sample) / max(sample.count(b"\n"), 1)
+            # The rows take up more space once a compressed file is decompressed
+            if self._compression(first_path) is not None:
+                file_size *= COMPRESSION_RATIO
+
+        batch_rows = max(1, int(memory_limit // (bytes_per_row * MEMORY_EXPANSION_FACTOR)))
+        num_partitions = max(1, math.ceil(file_size * MEMORY_EXPANSION_FACTOR / memory_limit))
+        return batch_rows, num_partitions
+
+    @timed_step
+    def process_dataset_in_batches(self, output_path: str,
+                                   deduplication_options: List[DeduplicationOptions],
+                                   column_maps: Dict[str, str] = None,
+                                   nhs_digital_subtype: str = None,
+                                   memory_limit_mb: float = 1024,
+                                   spill_dir: Optional[str] = None) -> None:
+        """
+        Processes a raw dataset that is too big to fit in memory. The raw file is read in batches and each batch
+        goes through the same steps as process_dataset(). The processed rows are spilled to disk in partitions
+        by a hash of the deduplication columns, so all duplicates of a row end up in the same partition. Each
+        partition is then deduplicated on its own and the result is streamed to output_path.
 
+        The dataset should be created with lazy=True so the raw file is not read into memory when it is created.
 
+        Args:
+            output_path (str): The path to write the processed data to. Must end in .arrow or .parquet.
+            deduplication_options (List[str]): List containing columns to deduplicate on. Must include "nhs_number" and "code".
+            column_maps (Dict[str, str]): A dictionary of column names to be renamed.
+            nhs_digital_subtype (str): The NHS Digital subtype, if this is an NHS Digital dataset.
+            memory_limit_mb (float, optional): The memory ceiling in megabytes used to size the batches and
+                partitions. Defaults to 1024.
+            spill_dir (str, optional): The directory to write the temporary partitions to. Defaults to the
+                system temporary directory.
 
+        Raises:
+            DeduplicationError: If deduplication_options does not include "nhs_number" and "code".
+            WriteOptionsInvalid: If the output path is not an .arrow or .parquet file.
+        """
+        if "nhs_number" not in deduplication_options or "code" not in deduplication_options:
+            raise DeduplicationError("deduplication_options must include 'nhs_number' and 'code'")
 
+        if not (output_path.endswith(".arrow") or output_path.endswith(".parquet")):
+            raise WriteOptionsInvalid("Output path for batch processing must be either .arrow or .parquet")
+
+        batch_rows, num_partitions = self._plan_batches(memory_limit_mb)
+        self.log.append(f"{datetime.now()}: Processing data in batches of {batch_rows} rows, spilling to {num_partitions} partition(s) to stay within {memory_limit_mb}MB")
+
+        with tempfile.TemporaryDirectory(dir=spill_dir) as temp_dir:
+            # Process each batch and spill it to disk, split into partitions on the deduplication columns
+            num_batches, rows_read, rows_kept = 0, 0, 0
+            for batch in self._iter_batches(batch_rows):
+                batch_dataset = RawDataset.from_dataframe(batch, dataset_type=self.dataset_type,
+                                                          coding_system=self.coding_system, path=self.path)
+                batch_dataset.nhs_digital_subtype = self.nhs_digital_subtype
+                batch_dataset.config_path = self.config_path
+                batch_dataset._prepare_for_deduplication(column_maps, nhs_digital_subtype)
+
+                partitioned = batch_dataset.data.with_columns(
+                    (pl.struct(deduplication_options).hash(seed=0) % num_partitions).alias("partition")
+                )
+                for partition, partition_data in partitioned.partition_by("partition", as_dict=True).items():
+                    partition_dir = os.path.join(temp_dir, f"partition_{partition:05d}")
+                    os.makedirs(partition_dir, exist_ok=True)
+                    partition_data.drop("partition").write_parquet(os.path.join(partition_dir, f"batch_{num_batches:08d}.parquet"))
+
+                num_batches += 1
+                rows_read += batch.shape[0]
+                rows_kept += batch_dataset.data.shape[0]
+
+            self.log.append(f"{datetime.now()}: Processed {num_batches} batch(es) with {rows_read} rows read and {rows_kept} rows kept after standarising the data")
+
+            # Deduplicate each partition on its own. Every duplicate of a row is in the same partition.
+            deduplicated_dir = os.path.join(temp_dir, "deduplicated")
+            os.makedirs(deduplicated_dir)
+            rows_written = 0
+            for partition_dir in sorted(glob.glob(os.path.join(temp_dir, "partition_*"))):
+                partition_data = pl.read_parquet(os.path.join(partition_dir, "*.parquet"))
+                partition_data = partition_data.unique(subset=deduplication_options, keep="first", maintain_order=True)
+                partition_data.write_parquet(os.path.join(deduplicated_dir, f"{os.path.basename(partition_dir)}.parquet"))
+                rows_written += partition_data.shape[0]
+
+            # Stream the deduplicated partitions into a single output file
+            if rows_written > 0:
+                deduplicated = pl.scan_parquet(os.path.join(deduplicated_dir, "*.parquet"))
+                if output_path.endswith(".arrow"):
+                    deduplicated.sink_ipc(output_path, compression=None)
+                else:
+                    deduplicated.sink_parquet(output_path, statistics=True)
+            else:
+                empty = pl.DataFrame(schema={"nhs_number": pl.Utf8, "code": pl.Utf8, "date": pl.Date})
+                if output_path.endswith(".arrow"):
+                    empty.write_ipc(output_path)
+                else:
+                    empty.write_parquet(output_path)
+
+        self.log.append(f"{datetime.now()}: Deduplicated data based on: {', '.join(deduplication_options)}")
+        self.log.append(f"{datetime.now()}: {rows_written} processed rows written to {output_path}")
@@ -160,7 +160,9 @@ class PhenotypeReportEngine():
         if dataset_name in self.datasets.keys():
             dataset = self.datasets[dataset_name]
         else:
-            dataset = ProcessedDataset(path, dataset_type, codelist_type)
+            # A dataset partitioned by code prefix is scanned lazily, so each count only reads
+            # the partitions its codes fall in
+            dataset = ProcessedDataset(path, dataset_type, codelist_type, lazy=os.path.isdir(path))
             self.datasets[dataset_name] = dataset
         
         return dataset
@@ -5,7 +5,7 @@ import os
 import datetime as dt
 from datetime import datetime
 from itertools import combinations
-from typing import Optional
+from typing import Dict, Optional
 
 
 from tretools.counter.counter import EventCounter
@@ -26,7 +26,8 @@ class PhenotypeReport():
         self.overlaps = {}
         self.logs = []
 
-    def add_count(self, name_of_count: str, codelist: Codelist, dataset: Dataset, demographics: Optional[DemographicDataset] = None) -> None:
+    def add_count(self, name_of_count: str, codelist: Codelist, dataset: Dataset, demographics: Optional[DemographicDataset] = None,
+                  prefix_match: bool = False) -> None:
         """
         Count the events in the dataset for the codelist and add to the report.
 
@@ -35,6 +36,8 @@ class PhenotypeReport():
             codelist (Codelist): The codelist to count.
             dataset (Dataset): The dataset to count.
             demographics (DemographicDataset, optional): The demographic data to add to the report. Defaults to None.
+            prefix_match (bool, optional): If True, each code in an ICD10 or OPCS codelist also counts every code in the
+                dataset that starts with it (see EventCounter.count_events()). Defaults to False.
 
         Raises:
             ReportAlreadyExists: If the report already exists.
@@ -44,12 +47,42 @@ class PhenotypeReport():
             raise ReportAlreadyExists(f"Report {name_of_count} already exists in this report.")
 
         counter = EventCounter(dataset)
-        counter.count_events(name_of_count=name_of_count, codelist=codelist, demographics=demographics)
+        counter.count_events(name_of_count=name_of_count, codelist=codelist, demographics=demographics, prefix_match=prefix_match)
 
         self.counts[name_of_count] = counter.counts[name_of_count]
 
         self.logs.append(f"Codelist {name_of_count} added to report {self.name} at {datetime.now()}. Log below from this count to follow.")
-        self.logs.append(counter.counts[name_of_count]["log"])
+        self.logs.append(counter.counts[name_of_count]["log"] + [step.to_log_line() for step in counter.steps])
+
+    def add_counts(self, codelists: Dict[str, Codelist], dataset: Dataset, demographics: Optional[DemographicDataset] = None,
+                   prefix_match: bool = False) -> None:
+        """
+        Count the events in the dataset for many codelists in one pass over the dataset, and add them to the report.
+        This gives the same counts as calling add_count() for each codelist, but the dataset is only read, joined
+        and grouped once (see EventCounter.count_events_batch()).
+
+        Args:
+            codelists (Dict[str, Codelist]): The codelists to count, keyed on the name of each count.
+            dataset (Dataset): The dataset to count.
+            demographics (DemographicDataset, optional): The demographic data to add to the report. Defaults to None.
+            prefix_match (bool, optional): If True, each code in an ICD10 or OPCS codelist also counts every code in the
+                dataset that starts with it (see EventCounter.count_events()). Defaults to False.
+
+        Raises:
+            ReportAlreadyExists: If any of the counts already exists.
+        """
+        # Check none of the codelists have already been counted
+        for name_of_count in codelists.keys():
+            if name_of_count in self.counts.keys():
+                raise ReportAlreadyExists(f"Report {name_of_count} already exists in this report.")
+
+        counter = EventCounter(dataset)
+        counter.count_events_batch(codelists=codelists, demographics=demographics, prefix_match=prefix_match)
+
+        for name_of_count in codelists.keys():
+            self.counts[name_of_count] = counter.counts[name_of_count]
+        self.logs.append(f"Codelists {', '.join(codelists.keys())} added to report {self.name} at {datetime.now()}. Log below from these counts to follow.")
+        self.logs.append(counter.log + [step.to_log_line() for step in counter.steps])
 
     def save_to_json(self, path: str, overwrite: bool = True) -> None:
         """
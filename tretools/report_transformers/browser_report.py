@@ -13,7 +13,8 @@ import csv
 
 from tretools.phenotype_report.report import PhenotypeReport
 from tretools.report_transformers.base import ReportTransformer
-from tretools.counter.counter import categorise_age
+from tretools.counter.counter import AGE_RANGE_LABELS, age_range_expr, select_first_events
+from tretools.datasets.base import decode_compact
 
 
 class BrowserReportTransformer(ReportTransformer):
@@ -131,17 +132,7 @@ class BrowserReportTransformer(ReportTransformer):
 
         # add counts based on year of event
         year_of_event = {}
-        age_of_event = {
-            "<18": 0,
-            "18-24": 0,
-            "25-34": 0,
-            "35-44": 0,
-            "45-54": 0,
-            "55-64": 0,
-            "65-74": 0,
-            "75-84": 0,
-            "85+": 0
-        }
+        age_of_event = {age_range: 0 for age_range in AGE_RANGE_LABELS}
 
         gender_of_event = {
             "F": 0,
@@ -161,20 +152,20 @@ class BrowserReportTransformer(ReportTransformer):
         for named_count, count_details in report.counts.items():
 
             # Add extra columns to the dataframe for year of event for date
-            temp_df = count_details['nhs_numbers'].with_columns([
+            temp_df = decode_compact(count_details['nhs_numbers']).with_columns([
                 pl.col("date").dt.year().alias("year_of_event")
             ])
 
             # add extra column of age category
-            temp_df = temp_df.with_columns([pl.col("age_at_event").apply(categorise_age).alias("age_group")])
+            temp_df = temp_df.with_columns([age_range_expr("age_at_event").alias("age_group")])
 
             # drop code, date and age_at_event
             temp_df = temp_df.drop(["code", "date", "age_at_event"])
             final_df = pl.concat([final_df, temp_df])
 
         # Nowe get rid of duplicates, and take the earliest year of event for
-        # each nhs_number so we sort by year of event
-        final_df = (final_df.sort(["nhs_number", "year_of_event"]).group_by("nhs_number").first())
+        # each nhs_number. Events in the same year are split by age group then gender.
+        final_df = select_first_events(final_df, order_by=["year_of_event", "age_group", "gender"])
 
         # Now we can count the number of events for each year, age and gender
         # Count occurrences per year
@@ -21,6 +21,7 @@ import os
 from tretools.phenotype_report.report import PhenotypeReport
 from tretools.report_transformers.base import ReportTransformer
 from tretools.report_transformers.utils import logs_to_markdown_table, codelist_to_markdown_table
+from tretools.datasets.base import decode_compact
 
 
 class RegenieReportTransformer(ReportTransformer):
@@ -149,7 +150,7 @@ class RegenieReportTransformer(ReportTransformer):
             for i, j in phenotype.counts.items():
 
                 # append the counts to the results DataFrame
-                nhs_numbers = j['nhs_numbers'].select(pl.col("nhs_number"))
+                nhs_numbers = decode_compact(j['nhs_numbers'].select(pl.col("nhs_number")))
                 results = results.vstack(nhs_numbers)
                 self.log.append(f"{datetime.now()}: Added {len(nhs_numbers)} NHS numbers for {i} to the Regenie report.")
 
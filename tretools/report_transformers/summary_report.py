@@ -23,6 +23,7 @@ from datetime import datetime
 from typing import List, Dict
 import os
 
+from tretools.counter.counter import select_first_events
 from tretools.report_transformers.base import ReportTransformer
 from tretools.phenotype_report.report import PhenotypeReport
 from tretools.report_transformers.utils import logs_to_markdown_table, codelist_to_markdown_table
@@ -91,9 +92,7 @@ class SummaryReportTransformer(ReportTransformer):
             log.append(f"{datetime.now()}: Total number of events prior to filtering for first event for {phenotype.name} is {total_events}, with {len(df['nhs_number'].unique())} unique patients.")
 
             # For each nhs number get the first event and drop the rows that have a date that is not the first event
-            df = df.sort(["nhs_number", "date"]).group_by("nhs_number").first()
-            first_events = (df.sort(["nhs_number", "date"])
-                            .group_by("nhs_number").first())
+            first_events = select_first_events(df)
 
             # log the number of events and unique patients after filtering for first event
             total_events = len(first_events)
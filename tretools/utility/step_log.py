@@ -0,0 +1,241 @@
+"""
+This module contains the StepRecord class and the timed_step decorator, which record how long each step
+of a pipeline took, how many rows went in and out, and how the memory of the process changed.
+
+The free-text logs (Dataset.log, EventCounter.log) are unchanged. The records are kept next to them in
+a steps list, so the slow steps of a large run can be found by loading the records into a dataframe
+with steps_to_dataframe().
+"""
+import os
+import sys
+import threading
+
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from functools import wraps
+from typing import Callable, List, Optional
+
+import polars as pl
+
+
+@dataclass
+class StepRecord:
+    """
+    A record of one step of a pipeline, such as loading, deduplicating or counting a dataset.
+    Rows are None when they are not known without reading the data, e.g. for a lazy dataset.
+    Memory is None on platforms where it cannot be measured. The peak is the most memory the process
+    used while the step ran. Where the peak of the process cannot be reset (anywhere but Linux), it is
+    only known for the steps that raised the peak of the process, and is None for the others. Memory
+    is only measured for steps run on the main thread, as steps run at the same time in other threads
+    (such as the shards of a dataset) share the memory of the process; it is None for those steps.
+    """
+    step: str
+    start: datetime
+    end: datetime
+    rows_in: Optional[int] = None
+    rows_out: Optional[int] = None
+    rss_delta_bytes: Optional[int] = None
+    peak_rss_bytes: Optional[int] = None
+
+    @property
+    def duration_seconds(self) -> float:
+        return (self.end - self.start).total_seconds()
+
+    def to_log_line(self) -> str:
+        """
+        Renders the record in the same form as the lines of the free-text logs.
+
+        Returns:
+            str: The log line.
+        """
+        line = f"{self.end}: Step {self.step} took {self.duration_seconds:.3f}s"
+        if self.rows_in is not None or self.rows_out is not None:
+            line += f", {self.rows_in} rows in and {self.rows_out} rows out"
+        if self.rss_delta_bytes is not None:
+            line += f", memory changed by {self.rss_delta_bytes / 1024 ** 2:+.1f} MB"
+        if self.peak_rss_bytes is not None:
+            line += f", peak memory {self.peak_rss_bytes / 1024 ** 2:.1f} MB"
+        return line
+
+
+def current_rss() -> Optional[int]:
+    """
+    Gets the resident set size (the memory in use) of this process.
+
+    Returns:
+        int: The resident set size in bytes, or None if it cannot be read on this platform.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Gets the largest resident set size this process has had, since it started or since the peak was
+    last reset with reset_peak_rss().
+
+    Returns:
+        int: The peak resident set size in bytes, or None if it cannot be read on this platform.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident set size of this process to its current size, so the peak of a step can be
+    measured on its own. This is only possible on Linux.
+
+    Returns:
+        bool: True if the peak was reset, False otherwise.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# The peak memory seen so far by each step that is running, the innermost step last. A step resets the
+# peak of the process when it starts, so the steps it runs inside are given the peak before the reset.
+# Only steps on the main thread measure memory, but the list is kept per thread so threads never share it.
+_running_steps = threading.local()
+
+
+def _running_peaks() -> List[int]:
+    """
+    Gets the peak memory of the steps running on this thread.
+
+    Returns:
+        List[int]: The peak of each running step in bytes, the innermost step last.
+    """
+    if not hasattr(_running_steps, "peaks"):
+        _running_steps.peaks = []
+    return _running_steps.peaks
+
+
+def _raise_running_peaks(peak: Optional[int]) -> None:
+    """
+    Raises the peak memory of the running steps to at least a peak of the process.
+
+    Args:
+        peak (int): The peak of the process in bytes, or None if it is not known.
+    """
+    if peak is None:
+        return
+    running_peaks = _running_peaks()
+    for i, running_peak in enumerate(running_peaks):
+        running_peaks[i] = max(running_peak, peak)
+
+
+def count_rows(obj) -> Optional[int]:
+    """
+    Counts the rows of a dataframe, or of the data of a dataset or counter, without collecting lazy data.
+
+    Args:
+        obj: A polars DataFrame, a Dataset, an EventCounter, or anything else.
+
+    Returns:
+        int: The number of rows, or None if they are not known.
+    """
+    if isinstance(obj, pl.DataFrame):
+        return obj.shape[0]
+    if isinstance(getattr(obj, "data", None), pl.DataFrame):
+        return obj.data.shape[0]
+    if getattr(obj, "dataset", None) is not None:
+        return count_rows(obj.dataset)
+    return None
+
+
+def timed_step(method: Callable) -> Callable:
+    """
+    Decorates a method of a class with a steps list (a Dataset or an EventCounter), so that each call adds
+    a StepRecord to the list. If the method returns a new dataset, the records are passed on to it, in the
+    same way as the log is.
+
+    Args:
+        method (Callable): The method.
+
+    Returns:
+        Callable: The decorated method.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        rows_in = count_rows(self)
+        # The memory of the process cannot be split between steps running at the same time in other
+        # threads, and resetting the peak there would wipe the peak of the steps on the main thread
+        measure_memory = threading.current_thread() is threading.main_thread()
+        rss_before, rss_after, step_peak = None, None, None
+        if measure_memory:
+            rss_before = current_rss()
+            peak_before = peak_rss()
+            _raise_running_peaks(peak_before)
+            peak_reset = reset_peak_rss()
+            _running_peaks().append(0)
+        start = datetime.now()
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            end = datetime.now()
+            if measure_memory:
+                step_peak = max(_running_peaks().pop(), peak_rss() or 0)
+                _raise_running_peaks(step_peak)
+
+        if measure_memory:
+            rss_after = current_rss()
+            # Without a reset, the peak of the process is only the peak of the step if the step raised it
+            if not peak_reset and (peak_before is None or step_peak <= peak_before):
+                step_peak = None
+
+        record = StepRecord(
+            step=f"{type(self).__name__}.{method.__name__}",
+            start=start,
+            end=end,
+            rows_in=rows_in,
+            rows_out=count_rows(self if result is None else result),
+            rss_delta_bytes=None if rss_before is None or rss_after is None else rss_after - rss_before,
+            peak_rss_bytes=step_peak,
+        )
+        self.steps.append(record)
+
+        # A new dataset carries on the history of the dataset it was made from
+        result_steps = getattr(result, "steps", None)
+        if result is not self and isinstance(result_steps, list) and result_steps is not self.steps:
+            if result_steps:
+                result_steps.append(record)
+            else:
+                result_steps.extend(self.steps)
+        return result
+    return wrapper
+
+
+def steps_to_dataframe(steps: List[StepRecord]) -> pl.DataFrame:
+    """
+    Puts step records into a dataframe, with one row per step and its duration in seconds.
+
+    Args:
+        steps (List[StepRecord]): The step records.
+
+    Returns:
+        polars.DataFrame: The steps.
+    """
+    rows = [{**asdict(step), "duration_seconds": step.duration_seconds} for step in steps]
+    schema = {"step": pl.Utf8, "start": pl.Datetime, "end": pl.Datetime, "rows_in": pl.Int64, "rows_out": pl.Int64,
+              "rss_delta_bytes": pl.Int64, "peak_rss_bytes": pl.Int64, "duration_seconds": pl.Float64}
+    return pl.DataFrame(rows, schema=schema)